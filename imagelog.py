@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import queue
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+from datetime import datetime
+import powerlog
+from powerlog import debug_print, error_print, warning_print, info_print
+
+# j2k2pdfが書く画像情報のログ (JSON Lines)。実行ごとに1つの.imglogファイルを開いたままにし、
+# 行はキューに入れてバックグラウンドのスレッドがまとめて書き込む。同じ内容をSQLiteにも書き、本とページで検索できるようにする
+imagelog_folder = './TEMP/imagelogs'
+
+# SQLiteのファイル名 (imagelog_folderの中)
+database_name = 'imagelog.sqlite'
+
+# まとめて書き込む行数と、行が少ない場合に書き込むまでの最大の待ち時間 (秒)
+default_batch_size = 500
+default_flush_interval = 1.0
+
+# 1行 (1ページ) をSQLiteの列にする。本・PDFフォルダ・ファイル名ごとに最新の記録だけを残す
+create_table_sql = '''
+CREATE TABLE IF NOT EXISTS images (
+    book TEXT NOT NULL,
+    pdf_directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    page INTEGER,
+    dpi INTEGER,
+    estimated_dpi INTEGER,
+    format TEXT,
+    lossless TEXT,
+    width INTEGER,
+    height INTEGER,
+    run TEXT,
+    record TEXT NOT NULL,
+    PRIMARY KEY (book, pdf_directory, filename)
+)'''
+create_index_sql = 'CREATE INDEX IF NOT EXISTS images_book_page ON images (book, page)'
+insert_sql = 'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+def get_database_path(folder=imagelog_folder):
+    return os.path.join(folder, database_name)
+
+# SQLiteに接続してテーブルを作る関数 (別のプロセスが書き込み中でも待つ)
+def connect(folder=imagelog_folder):
+    connection = sqlite3.connect(get_database_path(folder), timeout=30)
+    connection.execute(create_table_sql)
+    connection.execute(create_index_sql)
+    return connection
+
+# 画像情報の辞書をSQLiteの行にする関数
+def record_to_row(record, run):
+    dpi = record.get('DPI')
+    resolution = record.get('Resolution') or [None, None]
+    return (
+        os.path.splitext(record.get('PDF file name', ''))[0],
+        record.get('PDF directory name') or '',
+        os.path.basename(record.get('Filename', '')),
+        record.get('PDF page number'),
+        dpi if isinstance(dpi, int) else None,
+        record.get('Estimated DPI'),
+        record.get('Encoding Format'),
+        str(record.get('Is Lossless')),
+        resolution[0],
+        resolution[1],
+        run,
+        json.dumps(record, ensure_ascii=False),
+    )
+
+# 実行ごとに1つの.imglogファイルへ書き込むクラス。writeはキューに入れるだけで待たない
+# closeで残りの行を書き込んでスレッドを終了する
+class ImageLogWriter:
+    def __init__(self, folder=imagelog_folder, batch_size=default_batch_size, flush_interval=default_flush_interval):
+        self.folder = folder
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        self.run = datetime.now().strftime("%Y%m%d%H%M%S")
+        self.path = os.path.join(folder, f'{self.run}.imglog')
+        self.queue = queue.Queue()
+        self.written = 0
+        self.thread = threading.Thread(target=self.flush_loop, name='imagelog', daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def write_many(self, records):
+        for record in records:
+            self.queue.put(record)
+
+    # キューから行を集めてまとめて書き込むスレッド。Noneで終了
+    def flush_loop(self):
+        connection = None
+        try:
+            connection = connect(self.folder)
+        except sqlite3.Error as e:
+            warning_print(f"Image log database is not available: {e}")
+        with open(self.path, 'a', encoding='utf-8') as imagelog_file:
+            closing = False
+            while not closing:
+                batch = []
+                try:
+                    record = self.queue.get(timeout=self.flush_interval)
+                    while record is not None:
+                        batch.append(record)
+                        if len(batch) >= self.batch_size:
+                            break
+                        record = self.queue.get_nowait()
+                    closing = record is None
+                except queue.Empty:
+                    pass
+                if batch:
+                    self.flush(batch, imagelog_file, connection)
+        if connection is not None:
+            connection.close()
+
+    def flush(self, batch, imagelog_file, connection):
+        try:
+            imagelog_file.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in batch))
+            imagelog_file.flush()
+        except Exception as e:
+            error_print(f"Error writing image info to {self.path}: {e}")
+        if connection is not None:
+            try:
+                with connection:
+                    connection.executemany(insert_sql, [record_to_row(record, self.run) for record in batch])
+            except sqlite3.Error as e:
+                error_print(f"Error writing image info to {get_database_path(self.folder)}: {e}")
+        self.written += len(batch)
+        debug_print(f"Wrote {len(batch)} image log lines to {self.path}")
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        # 1行も書かなかった実行のファイルは残さない
+        if self.written == 0 and os.path.exists(self.path) and os.path.getsize(self.path) == 0:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+# 本の画像情報をページ順に返す関数。pdf_directoryを指定するとOriginalPDFまたはOptimizedPDFだけ
+def query_book(book, pdf_directory=None, folder=imagelog_folder):
+    if not os.path.exists(get_database_path(folder)):
+        return []
+    connection = connect(folder)
+    try:
+        sql = 'SELECT record FROM images WHERE book = ?'
+        parameters = [book]
+        if pdf_directory is not None:
+            sql += ' AND pdf_directory = ?'
+            parameters.append(pdf_directory)
+        sql += ' ORDER BY pdf_directory, page IS NULL, page, filename'
+        return [json.loads(row[0]) for row in connection.execute(sql, parameters)]
+    finally:
+        connection.close()
+
+# 既存の.imglogファイルをSQLiteに読み込む関数 (古い実行のログを含めて作り直す)。読み込んだ行数を返す
+def rebuild_database(folder=imagelog_folder):
+    database_path = get_database_path(folder)
+    if os.path.exists(database_path):
+        os.remove(database_path)
+    connection = connect(folder)
+    count = 0
+    try:
+        # ファイル名は実行日時なので、名前順に読めば新しい記録で上書きされる
+        for imagelog_path in sorted(Path(folder).glob('*.imglog')):
+            rows = []
+            with open(imagelog_path, 'r', encoding='utf-8') as imagelog_file:
+                for line in imagelog_file:
+                    if not line.strip():
+                        continue
+                    try:
+                        rows.append(record_to_row(json.loads(line), imagelog_path.stem))
+                    except ValueError as e:
+                        warning_print(f"Skipping a broken line in {imagelog_path}: {e}")
+            with connection:
+                connection.executemany(insert_sql, rows)
+            count += len(rows)
+    finally:
+        connection.close()
+    return count
+
+if __name__ == '__main__':
+    # コマンドライン引数を解析する
+    parser = argparse.ArgumentParser(description='List the image information j2k2pdf logged for the pages of a book.')
+    parser.add_argument('book', nargs='?', help='Book (folder) name to list')
+    parser.add_argument('--directory', '-d', choices=['OriginalPDF', 'OptimizedPDF'], help='Only list pages of this PDF folder')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the database from the .imglog files')
+    parser.add_argument('--folder', default=imagelog_folder, help=f'Image log folder. Default: {imagelog_folder}')
+    parser.add_argument('--log-level', '-log', default='INFO', choices=['DEBUG', 'VERBOSE', 'INFO', 'WARNING'],
+                        help='Set the logging level (default: INFO)')
+    parser.add_argument('-debug', action='store_const', const='DEBUG', dest='log_level',
+                        help='Set the logging level to DEBUG')
+    args = parser.parse_args()
+    powerlog.set_log_level(args)
+
+    if args.rebuild:
+        info_print(f"Loaded {rebuild_database(args.folder)} image log lines into {get_database_path(args.folder)}")
+    if args.book:
+        records = query_book(args.book, args.directory, args.folder)
+        if not records:
+            error_print(f"No image log for {args.book}")
+            sys.exit(1)
+        for record in records:
+            print(f"{record['PDF directory name']}\t{record['PDF page number']}\t{os.path.basename(record['Filename'])}\tDPI {record['DPI']}\tEstimated DPI {record['Estimated DPI']}\t{record['Encoding Format']}\t{record.get('Compression ratio', 'N/A')}")
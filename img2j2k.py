@@ -1,9 +1,12 @@
 import os
+import sys
 import tempfile
 import queue
 import threading
 import psutil
 import argparse
+import configparser
+import time
 from pathlib import Path
 from colorama import Fore, Style
 import traceback
@@ -14,10 +17,18 @@ import numpy as np
 import ctypes
 import glymur
 import uuid
+import math
 import io
+import re
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory, resource_tracker
 from lxml import etree as ET
 import powerlog
-from powerlog import logger,verbose_print, info_print, error_print, variable_str, debug_print
+import jp2digest
+import pageindex
+from powerlog import logger,verbose_print, info_print, error_print, warning_print, variable_str, debug_print
 
 # コマンドライン引数を解析する
 parser = powerlog.create_parser()
@@ -30,15 +41,50 @@ parser.add_argument('--dpi', type=int, help='DPI for the output image. Default e
 
 group_check = parser.add_mutually_exclusive_group()
 group_check.add_argument('--quick', '-q', action='store_true', help='Skip bit-perfect lossless conversion check.')
-group_check.add_argument("--check", choices=["fast", "slow"], default="slow", help="Check for bit-perfect lossless conversion. Default = slow 'fast' uses glymur before renaming tmp file, 'slow' uses pillow/numpy after final output. This is to avoid Japanese input to glymur")
+group_check.add_argument("--check", choices=["fast", "slow", "hash"], default="slow", help="Check for bit-perfect lossless conversion. Default = slow 'fast' uses glymur before renaming tmp file, 'slow' uses pillow/numpy after final output. This is to avoid Japanese input to glymur. 'hash' compares a BLAKE2 digest of the source pixels with the digest of the tmp file decoded strip by strip, on separate verification workers")
 parser.add_argument("--temp", "-t", default='./TEMP/tmp', help="Specify the temporary directory path. Default:'./TEMP/tmp'Use 'system' for system's temp directory. Using same drive as output folder is recommended.")
 group_encode_method = parser.add_mutually_exclusive_group()
 group_encode_method.add_argument("--lossless", "-l", action="store_true", help="Perform only lossless conversion.")
 group_encode_method.add_argument("--optimize", "-o", action="store_true", help="Perform only optimized conversion.")
+parser.add_argument("--processes", "-P", nargs="?", const=0, type=int, default=None, help="Use worker processes instead of threads. Each image is decoded once into shared memory and the lossless encode, optimized encode and check read that buffer. Optional value sets the number of processes. Default: physical cores // glymur threads")
+parser.add_argument("--glymur-threads", type=int, help="Number of threads glymur (openjpeg) uses per encode. Default: [glymur] glymur_threads in settings.ini/default.ini, or 2")
+parser.add_argument("--calibrate", nargs="?", const=8, type=int, help="Encode a sample of the input pages (default 8) with several worker/glymur thread combinations, measure pages per second and peak RSS, and store the best combination in settings.ini. No conversion is done.")
+parser.add_argument("--memory-fraction", type=float, default=0.7, help="Fraction of available memory that concurrent image conversions may use. Default: 0.7")
+parser.add_argument("--memory-budget", type=int, help="Memory budget for concurrent image conversions in MB. Overrides --memory-fraction.")
+parser.add_argument("--verify-workers", type=int, help="Number of verification threads for --check hash. Default: physical cores // 4")
+parser.add_argument("--tile-threshold", type=float, default=64, help="Images with more megapixels than this are read in strips and encoded in tiles so memory use follows the tile size. 0 disables. Default: 64")
+parser.add_argument("--tile-size", type=int, default=1024, help="Tile size in pixels for tiled encoding. Default: 1024")
+parser.add_argument("--ocr-proxy", action="store_true", help="Also write a grayscale, reduced JP2 for OCR to ./TEMP/ocr from the same decoded image.")
+parser.add_argument("--ocr-reduce", type=int, default=2, help="Reduction factor (integer) of the OCR proxy. Must divide --tile-size. Default: 2")
+parser.add_argument("--ocr-cratio", type=int, default=20, help="Compression ratio of the OCR proxy. Default: 20")
+parser.add_argument("--detect-gray", action="store_true", help="Detect pages that are effectively grayscale or bilevel (black and white) and encode the optimized output with one channel. The lossless output is not changed; the detected content is recorded in its XML box.")
+parser.add_argument("--gray-tolerance", type=int, default=8, help="A pixel counts as gray when its RGB channels differ by at most this value. Default: 8")
+parser.add_argument("--gray-fraction", type=float, default=0.001, help="A page is gray when at most this fraction of pixels is not gray. Default: 0.001")
+parser.add_argument("--bilevel-fraction", type=float, default=0.02, help="A gray page is bilevel when at most this fraction of pixels is a midtone (between 64 and 191). Default: 0.02")
+group_rate = parser.add_mutually_exclusive_group()
+group_rate.add_argument("--target-psnr", type=float, help="Rate control for the optimized output: choose the highest compression ratio per page that keeps this PSNR (dB), searched on a downsampled trial encode. Default: fixed ratio 80")
+group_rate.add_argument("--target-size", type=float, help="Rate control for the optimized output: compression ratio per page aimed at this size in KB. Default: fixed ratio 80")
+parser.add_argument("--min-cratio", type=float, default=10, help="Lowest compression ratio rate control may choose. Default: 10")
+parser.add_argument("--max-cratio", type=float, default=200, help="Highest compression ratio rate control may choose. Default: 200")
+parser.add_argument("--trial-reduce", type=int, default=4, help="Downsampling factor of the trial image used by --target-psnr. Default: 4")
+parser.add_argument("--no-passthrough", action="store_true", help="Re-encode JPEG and reversible JP2 inputs instead of linking them into the lossless folder as they are.")
+parser.add_argument("--force", "-f", action="store_true", help="Convert all images even if the manifest in ./TEMP/manifest says their outputs are up to date. The manifest is still updated.")
 args = parser.parse_args()
+if args.ocr_proxy and (args.ocr_reduce < 1 or args.tile_size % args.ocr_reduce):
+    parser.error("--ocr-reduce must be a positive integer that divides --tile-size")
+if args.calibrate is not None and args.calibrate < 1:
+    parser.error("--calibrate must be at least 1 page")
 
 powerlog.set_log_level(args)
 
+# ダイジェストによる確認を検証ワーカーで行うか (--check hash)
+hash_check = args.check == "hash" and not args.quick and not args.optimize
+
+# 最適化出力の圧縮率をページごとに決めるか (--target-psnr / --target-size)
+rate_control = args.target_psnr is not None or args.target_size is not None
+# PSNRの二分探索の回数
+rate_search_steps = 6
+
 
 #DLLの存在を確認する関数
 def check_dll(openjpeg_dll_path):
@@ -49,188 +95,1411 @@ def check_dll(openjpeg_dll_path):
         error_print("Failed to load "+openjpeg_dll_name+" from system PATH.")
 
 #ディレクトリ内のサブディレクトリを扱う関数を定義
+# 全サブディレクトリの画像を1つのキューにまとめて変換する
 def convert_all_images(input_folder, lossless_folder, optimized_folder):
-    global lossless_count, optimized_count, lossless_OK, lossless_NO, lossless_CHK, img_per_subdir_count, subdir_count, lossless_total, optimized_total, img_total
-    for subdir in os.listdir(input_folder):
-        with count_lock:
-            subdir_count += 1
+    jobs = []
+    for subdir in sorted(os.listdir(input_folder)):
         input_subdir = os.path.join(input_folder, subdir)
+        if not os.path.isdir(input_subdir):
+            continue
         lossless_subdir = os.path.join(lossless_folder, subdir)
         optimized_subdir = os.path.join(optimized_folder, subdir)
         os.makedirs(lossless_subdir, exist_ok=True)
         os.makedirs(optimized_subdir, exist_ok=True)
-        convert_image_subdir(input_subdir, lossless_subdir, optimized_subdir)
+        jobs.extend(scan_book(input_subdir, lossless_subdir, optimized_subdir))
+    run_jobs(jobs)
 
+# 1つのサブディレクトリだけを変換する
 def convert_image_subdir(input_subdir, lossless_subdir, optimized_subdir):
-    global lossless_count, optimized_count, lossless_OK, lossless_NO, lossless_CHK, img_per_subdir_count, subdir_count, lossless_total, optimized_total, img_total
-    lossless_count = optimized_count = img_per_subdir_count = 0
-    # ファイルキューの作成
-    file_queue = queue.Queue()
+    run_jobs(scan_book(input_subdir, lossless_subdir, optimized_subdir))
+
+# 本の出力ごとのサブディレクトリ {出力名: パス} を作成する関数
+def get_output_subdirs(book, lossless_subdir, optimized_subdir):
+    output_subdirs = {}
+    for spec in output_specs:
+        if spec['name'] == 'lossless':
+            output_subdir = lossless_subdir
+        elif spec['name'] == 'optimized':
+            output_subdir = optimized_subdir
+        else:
+            output_subdir = os.path.join(spec['folder'], book)
+        os.makedirs(output_subdir, exist_ok=True)
+        output_subdirs[spec['name']] = output_subdir
+    return output_subdirs
+
+# サブディレクトリ内の画像のヘッダーだけを読み、ジョブのリストを作成する関数
+# use_manifestの場合、マニフェストで出力が最新と分かる画像はジョブにしない (キャリブレーションでは使わない)
+def scan_book(input_subdir, lossless_subdir, optimized_subdir, use_manifest=True):
+    global img_skipped
+    book = os.path.basename(os.path.normpath(input_subdir))
+    output_subdirs = get_output_subdirs(book, lossless_subdir, optimized_subdir)
+    if use_manifest:
+        load_manifest(book)
+    jobs = []
+    skipped = 0
     # 入力フォルダ内のすべてのファイルを取得
-    for filename in os.listdir(input_subdir):
+    for filename in sorted(os.listdir(input_subdir)):
         if filename.endswith(supported_extensions):
-            output_path = os.path.join(lossless_subdir, filename)
-            output_path_opt = os.path.join(optimized_subdir, filename)
-            # 入力ファイルのパスと出力ファイルのパスの両方をキューに追加
-            file_queue.put((os.path.join(input_subdir, filename), output_path, output_path_opt))
-            img_per_subdir_count += 1
-    verbose_print(f"Total images in {input_subdir}: {img_per_subdir_count}")
-
-    threads = []
-    # スレッドの作成と開始
-    for _ in range(num_threads):  # num_threadsの数だけスレッドを作成
-        t = threading.Thread(target=convert_image,args=(file_queue,lossless_subdir,optimized_subdir))
-        t.daemon = True
-        t.start()
-        threads.append(t)
-
-    # すべてのスレッドが終了するのを待つ
-    for t in threads:
-        t.join()
+            file_path = os.path.join(input_subdir, filename)
+            if use_manifest and not args.force and is_up_to_date(book, filename, file_path):
+                debug_print(f"{file_path} is up to date. Skipping.")
+                skipped += 1
+                continue
+            job = {
+                'file_path': file_path,
+                'book': book,
+                'lossless_subdir': lossless_subdir,
+                'optimized_subdir': optimized_subdir,
+                'output_subdirs': output_subdirs,
+                'size': None,
+                'mode': None,
+                'pixels': 0,
+                'raw_strips': False,
+                'tiled': False,
+                'passthrough': None,
+                'manifest': book if use_manifest else None,
+                'failed': False,
+            }
+            # ヘッダーのみ読み込み (Pillowはここではデコードしない)
+            try:
+                with Image.open(job['file_path']) as img:
+                    job['size'] = img.size
+                    job['mode'] = img.mode
+                    job['pixels'] = img.size[0] * img.size[1]
+                    job['raw_strips'] = get_raw_strips(img) is not None
+                    # PDFにそのまま埋め込める入力はロスレス出力を変換しない
+                    job['passthrough'] = get_passthrough(img, job['file_path'])
+                    # 大きな画像はタイル単位でエンコード (パススルーでロスレスのみならデコードしない)
+                    job['tiled'] = args.tile_threshold > 0 and img.mode in shared_array_modes and job['pixels'] > args.tile_threshold * 10**6 and not (job['passthrough'] and args.lossless)
+            except Exception as e:
+                logger.error(f"Error reading header of {job['file_path']}: {e}")
+            job['memory'] = estimate_job_memory(job)
+            jobs.append(job)
+    register_book(book, lossless_subdir, optimized_subdir, len(jobs))
+    if use_manifest:
+        # 全ページが最新でもインデックスがなければ書き込む
+        if not jobs and not os.path.exists(pageindex.get_index_path(book)):
+            write_index(book)
+        save_manifest(book)
+    with count_lock:
+        img_skipped += skipped
+    if skipped:
+        info_print(f"Skipped {variable_str(skipped)} up-to-date images in {input_subdir}")
+    verbose_print(f"Total images in {input_subdir}: {len(jobs)}")
+    return jobs
 
+# マニフェストのパス (本ごとに1つ)
+def get_manifest_path(book):
+    return os.path.join(manifest_folder, book + '.json')
 
-# 画像変換関数を定義
-def convert_image(file_queue, lossless_subdir, optimized_subdir):
-    global lossless_count, optimized_count, lossless_OK, lossless_NO, lossless_CHK, img_per_subdir_count, subdir_count, lossless_total, optimized_total, img_total
+# 本のマニフェストを読み込む関数。なければ、または壊れていれば空のマニフェストから始める
+def load_manifest(book):
+    manifest = {'version': manifest_version, 'book': book, 'pages': {}}
+    manifest_path = get_manifest_path(book)
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+                loaded = json.load(manifest_file)
+            if loaded.get('version') == manifest_version:
+                manifest = loaded
+            else:
+                warning_print(f"Manifest {manifest_path} has an unknown version. Converting all images of {book}.")
+        except (OSError, ValueError) as e:
+            warning_print(f"Could not read manifest {manifest_path}: {e}. Converting all images of {book}.")
+    with manifest_lock:
+        manifests[book] = {'data': manifest, 'dirty': False, 'saved': time.monotonic()}
 
-    while not file_queue.empty():
-        # 入力ファイルのパスと出力ファイルのパスの両方を取得
-        file_path,output_path, output_path_opt = file_queue.get()
+# 本のマニフェストを書き込む関数。途中で中断しても壊れないように一時ファイルから置き換える
+def save_manifest(book, force=True):
+    with manifest_lock:
+        manifest = manifests.get(book)
+        if manifest is None or not manifest['dirty']:
+            return
+        if not force and time.monotonic() - manifest['saved'] < manifest_save_interval:
+            return
+        manifest_path = get_manifest_path(book)
+        os.makedirs(manifest_folder, exist_ok=True)
+        tmp_manifest_path = manifest_path + '.tmp'
+        with open(tmp_manifest_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(manifest['data'], manifest_file, ensure_ascii=False, indent=1)
+        os.replace(tmp_manifest_path, manifest_path)
+        manifest['dirty'] = False
+        manifest['saved'] = time.monotonic()
+
+# 全ての本のマニフェストの未保存の変更を書き込む関数
+def save_all_manifests():
+    for book in list(manifests):
+        save_manifest(book)
+
+# 中断された変換が一時フォルダに残したファイル (uuid名の一時JP2とキャリブレーションのフォルダ) を削除する関数
+def cleanup_tmp_files(tmp_path):
+    removed = 0
+    for filename in os.listdir(tmp_path):
+        if tmp_file_pattern.match(filename):
+            try:
+                os.remove(os.path.join(tmp_path, filename))
+                removed += 1
+            except OSError as e:
+                warning_print(f"Could not remove temporary file {filename}: {e}")
+    calibration_folder = os.path.join(tmp_path, 'calibration')
+    if os.path.isdir(calibration_folder):
+        shutil.rmtree(calibration_folder, ignore_errors=True)
+    if removed:
+        info_print(f"Removed {variable_str(removed)} temporary files left by an interrupted run from {tmp_path}")
+
+# ファイルの内容のダイジェストを計算する関数
+def file_digest(file_path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(file_path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# マニフェストに記録する元画像の大きさ、更新日時、ダイジェストを返す関数
+# 変換を始める前にワーカーで計算する (変換中に書き換えられた元画像を新しい内容で記録しないため)
+def source_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_digest(file_path)}
+
+# 出力ごとのエンコード設定。マニフェストに記録し、変わった出力は作り直す
+def get_output_settings(spec):
+    settings = {key: spec[key] for key in ('cratios', 'color', 'reduce', 'auto_color', 'rate_control')}
+    settings['dpi'] = args.dpi
+    settings['tile'] = [args.tile_threshold, args.tile_size]
+    settings['detect_gray'] = [args.gray_tolerance, args.gray_fraction, args.bilevel_fraction] if args.detect_gray else None
+    if spec['name'] == 'lossless':
+        settings['passthrough'] = not args.no_passthrough
+    if spec['rate_control'] and rate_control:
+        settings['rate'] = {'target_psnr': args.target_psnr, 'target_size': args.target_size, 'min_cratio': args.min_cratio, 'max_cratio': args.max_cratio, 'trial_reduce': args.trial_reduce}
+    # JSONで読み直した値と比べられるように揃える
+    return json.loads(json.dumps(settings))
+
+# 画像の出力が最新か確認する関数
+# 全ての出力が同じ設定で記録されて存在し、元画像のサイズと更新日時が同じなら最新。更新日時だけ違う場合は内容のダイジェストで比べる
+def is_up_to_date(book, filename, file_path):
+    with manifest_lock:
+        entry = manifests[book]['data']['pages'].get(filename)
+    if entry is None:
+        return False
+    for spec in output_specs:
+        output = entry['outputs'].get(spec['name'])
+        if output is None or output['settings'] != output_settings[spec['name']] or not os.path.exists(output['path']):
+            return False
+    stat = os.stat(file_path)
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime_ns == entry['mtime_ns']:
+        return True
+    if file_digest(file_path) != entry['hash']:
+        return False
+    # 内容が同じなら更新日時だけ記録し直す
+    with manifest_lock:
+        entry['mtime_ns'] = stat.st_mtime_ns
+        manifests[book]['dirty'] = True
+    return True
+
+# ジョブの出力ファイルのパス
+def get_output_path(job, name):
+    stem = os.path.splitext(os.path.basename(job['file_path']))[0]
+    if name == 'lossless' and job['passthrough']:
+        return os.path.join(job['lossless_subdir'], stem + ('.jpg' if job['passthrough'] == 'jpeg' else '.jp2'))
+    return os.path.join(job['output_subdirs'][name], stem + '.jp2')
+
+# 変換に成功したジョブをマニフェストに記録する関数。元画像が同じなら今回作らなかった出力の記録も残す
+def record_manifest(job):
+    file_path = job['file_path']
+    filename = os.path.basename(file_path)
+    fingerprint = job.get('fingerprint') or source_fingerprint(file_path)
+    outputs = {}
+    for spec in output_specs:
+        output_path = get_output_path(job, spec['name'])
+        if not os.path.exists(output_path):
+            return
+        outputs[spec['name']] = {'path': output_path, 'settings': output_settings[spec['name']], 'info': pageindex.read_image_info(output_path, spec['name'])}
+    with manifest_lock:
+        manifest = manifests[job['manifest']]
+        pages = manifest['data']['pages']
+        previous = pages.get(filename)
+        if previous is not None and previous['hash'] == fingerprint['hash']:
+            outputs = {**previous['outputs'], **outputs}
+        pages[filename] = {
+            'source': file_path,
+            'size': fingerprint['size'],
+            'mtime_ns': fingerprint['mtime_ns'],
+            'hash': fingerprint['hash'],
+            'algorithm': jp2digest.digest_algorithm,
+            'outputs': outputs,
+        }
+        manifest['dirty'] = True
+
+# マニフェストから本のヘッダー情報のインデックスを書き込む関数 (j2k2pdfなどが画像を開き直さないため)
+# 記録がない、または出力ファイルが記録と違う場合はヘッダーを読み直す
+def write_index(book):
+    with manifest_lock:
+        pages = manifests[book]['data']['pages']
+        outputs = [(name, output) for page in pages.values() for name, output in page['outputs'].items()]
+    entries = []
+    for name, output in outputs:
+        if not os.path.exists(output['path']):
+            continue
+        info = output.get('info')
+        if info is None or not pageindex.is_current(info, output['path']):
+            info = pageindex.read_image_info(output['path'], name)
+            with manifest_lock:
+                output['info'] = info
+                manifests[book]['dirty'] = True
+        entries.append(info)
+    pageindex.write_book_index(book, entries)
+
+# 本(サブディレクトリ)ごとの進捗を登録する関数。変換する画像がない本は完了として数える
+def register_book(book, lossless_subdir, optimized_subdir, total):
+    global subdir_count
+    books[book] = {
+        'total': total,
+        'done': 0,
+        'lossless': 0,
+        'lossless_subdir': lossless_subdir,
+        'optimized_subdir': optimized_subdir,
+    }
+    # 派生出力ごとの完了数
+    for spec in derived_specs:
+        books[book][spec['name']] = 0
+    if total == 0:
+        with count_lock:
+            subdir_count += 1
+
+# ジョブの全ての出力が書き込まれたら呼ぶ関数。本の最後のページなら本の完了を表示する
+def finish_job(job):
+    global subdir_count
+    book = books[job['book']]
+    # 全ての出力が書き込めたページだけマニフェストに記録する (保存は一定間隔か本の完了時)
+    if job.get('manifest') is not None and not job['failed']:
         try:
-            with Image.open(file_path) as img:
-                # 元画像の解像度を取得
-                original_img_dpi = img.info.get('dpi', None)
-                if original_img_dpi is None:
-                    estimated_img_dpi = 600
-                else:
-                    # 72と150以上の50の倍数のうち、original_img_dpiに一番近いものを選択
-                    estimated_img_dpi = min([72] + list(range(150, 1000, 50)), key=lambda x:abs(x-original_img_dpi[0]))
-
-                # dpiの設定
-                if args.dpi is None:
-                    write_img_dpi = estimated_img_dpi
-                elif args.dpi == 0:
-                    write_img_dpi = original_img_dpi
-                elif args.dpi < 0:
-                    write_img_dpi = abs(args.dpi)
-                else:
-                    if original_img_dpi is None and args.dpi > 0:
-                        write_img_dpi = abs(args.dpi)
-                    else:
-                        write_img_dpi = estimated_img_dpi
-                verbose_print(Fore.YELLOW + f"DPI" + Fore.WHITE + " of "+file_path+"Original: "+variable_str(original_img_dpi)+", Estimated: "+variable_str(estimated_img_dpi)+", Write: "+variable_str(write_img_dpi))
-
-                # DPI情報をXMLデータとして作成
-                dpi_str = str(write_img_dpi)
-                xml_data = f"""
-                <info>
-                    <dpi>{dpi_str}</dpi>
-                </info>
-                """
-                # XMLデータをパース
-                xml = io.BytesIO(xml_data.encode())
-                tree = ET.parse(xml)
-
-                # XMLBoxを作成
-                xmlbox = glymur.jp2box.XMLBox(xml=tree)
-
-                
-                # Pillow Imageをnumpy arrayに変換
-                img_array = np.array(img)
-
-                if not args.optimize:
-                    # 一時的なファイル名を作成（日本語をglymurに渡さないため）
-                    tmp_filename = os.path.join(tmp_path, str(uuid.uuid4()) + '_temp.jp2')
-
-                    # ロスレス画像の変換と出力
-                    jp2Lossless = glymur.Jp2k(tmp_filename, data=img_array, cratios=[1])
-
-                    # XMLBoxを追加
-                    jp2Lossless.append(xmlbox)
-
-                    # メタデータを読む関数を定義
-                    jp2Read = glymur.Jp2k(tmp_filename)
-
-                    #デバッグ用作成ファイルメタデータ確認＆詳細出力
-                    #if log_level == logging.DEBUG:
-                        #埋め込んだメタデータ確認
-                        #glymur.set_option('print.codestream', False)
-                        #debug_print(f"Metadata for converted {file_path}: {jp2Read.box}")
-                        
-                    # メタデータのboxを検索
-                    for box in jp2Read.box:
-                        # XMLBoxを探す
-                        if isinstance(box, glymur.jp2box.XMLBox):
-                            # XMLを解析
-                            root = box.xml.getroot()
-                            # dpi要素を探す
-                            dpi_elements = root.findall('.//dpi')
-                            for read_dpi in dpi_elements:
-                                verbose_print(f"Confirming"+Fore.YELLOW+" DPI "+Style.RESET_ALL+"for"+file_path +Fore.CYAN+ read_dpi.text+Style.RESET_ALL)
-
-                    #チェックの方法に基づいて画像を読み込み
-                    if args.check == "fast" and not args.quick:
-                        debug_print("Checking bit-perfect conversion using glymur...")
-                        # glymurを使用して画像を読み込み
-                        converted_img_array = glymur.Jp2k(tmp_filename)[:]
-
-                        # 元画像と変換後の画像がビットパーフェクトに一致するかどうかを確認
-                        is_bitperfect = np.array_equal(img_array, converted_img_array)
-
-                    # 一時的なファイルを最終的な出力パスにリネーム
-                    output_path = os.path.join(lossless_subdir, os.path.splitext(os.path.basename(file_path))[0] + '.jp2')
-                    shutil.move(tmp_filename, output_path)
-                    with count_lock:
-                        lossless_count += 1
-                        verbose_print(f"Lossless conversion for "+file_path+" complete!")
-                        print(Fore.BLUE + "Lossless conversion" + Fore.CYAN+ str(lossless_count) + Fore.WHITE +"/" + Fore.CYAN + str(img_per_subdir_count)+Style.RESET_ALL+"for subdir"+Fore.CYAN+str(subdir_count)+" / "+str(subdir_total)+Style.RESET_ALL)
-
-                    if not args.check == "fast" and not args.quick:
-                        debug_print("Checking bit-perfect conversion using Pillow...")
-                        # Pillowを使用して画像を読み込み
-                        converted_img = Image.open(output_path)
-                        converted_img_array = np.array(converted_img)
-
-                        # 元画像と変換後の画像がビットパーフェクトに一致するかどうかを確認
-                        is_bitperfect = np.array_equal(img_array, converted_img_array)
-
-                    with count_lock:
-                        lossless_CHK += 1
-                        if is_bitperfect:
-                            lossless_OK += 1
-                            verbose_print(f"Bitperfect conversion for {file_path} verified!")
-                            print(Fore.YELLOW + "Bitperfect " + Fore.GREEN + " OK " + variable_str(lossless_OK) + Fore.WHITE +"/" +  Fore.RED + "NO " + Fore.CYAN + variable_str(lossless_NO) + Fore.WHITE + "/" + Fore.MAGENTA + "Total " + Fore.CYAN + variable_str(lossless_CHK) + Style.RESET_ALL)
-                        else:
-                            lossless_NO += 1
-                            error_print(f"Bitperfect conversion for {file_path}: Failed!")
-                            print(Fore.YELLOW + "Bitperfect " + Fore.GREEN + " OK " + variable_str(lossless_OK) + Fore.WHITE +"/" +  Fore.RED + "NO " + Fore.CYAN + variable_str(lossless_NO) + Fore.WHITE + "/" + Fore.MAGENTA + "Total " + Fore.CYAN + variable_str(lossless_CHK) + Style.RESET_ALL)
-                
-                if not args.lossless:
-                    # 一時的なファイル名を作成（日本語をglymurに渡さないため）
-                    tmp_filename_opt = os.path.join(tmp_path, str(uuid.uuid4()) + '_temp_opt.jp2')
+            record_manifest(job)
+        except Exception as e:
+            logger.error(f"Error recording {job['file_path']} in the manifest: {e}")
+    with count_lock:
+        book['done'] += 1
+        is_complete = book['done'] == book['total']
+        if is_complete:
+            subdir_count += 1
+    if job.get('manifest') is not None:
+        if is_complete:
+            try:
+                write_index(job['manifest'])
+            except Exception as e:
+                logger.error(f"Error writing the index of {job['book']}: {e}")
+        save_manifest(job['manifest'], force=is_complete)
+    if is_complete:
+        info_print(Fore.GREEN + "All images written for " + Style.RESET_ALL + job['book'] + " (" + variable_str(subdir_count) + "/" + variable_str(subdir_total) + ")")
+
+# ヘッダー情報からジョブのピークメモリを見積もる関数 (画素数 × 1画素のバイト数 × 同時に存在するコピー数)
+def estimate_job_memory(job):
+    if job['mode'] in shared_array_modes:
+        dtype, channels = shared_array_modes[job['mode']]
+        bytes_per_pixel = np.dtype(dtype).itemsize * max(1, channels)
+    else:
+        bytes_per_pixel = 4
+    # Pillowの画像とnumpy配列 (共有メモリ)
+    copies = 2
+    # glymurのエンコード用バッファ
+    if not args.optimize and not job['passthrough']:
+        copies += 1
+    # 派生出力は色の削減や縮小をした配列とエンコード用バッファ (縮小後は小さいが多めに数える)
+    copies += len(derived_specs)
+    # ビットパーフェクト確認の再デコード (ダイジェストならストリップ単位なので数えない)
+    if not args.quick and not args.optimize and not hash_check and not job['passthrough']:
+        copies += 1
+    if job['tiled']:
+        # タイル1行分のストリップ。無圧縮でなければPillowの画像全体も保持する
+        width, height = job['size']
+        memory = width * min(args.tile_size, height) * bytes_per_pixel * copies
+        if not job['raw_strips']:
+            memory += job['pixels'] * bytes_per_pixel
+        return memory
+    return job['pixels'] * bytes_per_pixel * copies
+
+# メモリ予算に収まればジョブを受け入れる関数。実行中のジョブがなければ予算を超えても受け入れる
+def try_admit_job(job):
+    global memory_in_use
+    with memory_condition:
+        if memory_in_use == 0 or memory_in_use + job['memory'] <= memory_budget:
+            memory_in_use += job['memory']
+            if job['memory'] > memory_budget:
+                warning_print(f"{job['file_path']} needs about {job['memory'] / 2**20:.1f} MB, which exceeds the memory budget of {memory_budget / 2**20:.1f} MB. Converting it alone.")
+            return True
+        return False
+
+# メモリ予算に収まるまで待ってジョブを受け入れる関数 (スレッドモード)
+def admit_job(job):
+    with memory_condition:
+        while not try_admit_job(job):
+            debug_print(f"Waiting for memory to convert {job['file_path']} ({job['memory'] / 2**20:.1f} MB, in use {memory_in_use / 2**20:.1f} MB)")
+            memory_condition.wait()
+
+# ジョブが使っていたメモリ予算を返す関数
+def release_job_memory(job):
+    global memory_in_use
+    with memory_condition:
+        memory_in_use -= job['memory']
+        memory_condition.notify_all()
+
+# ジョブを画素数の多い順に1つのキューに入れ、スレッドまたはプロセスで変換する関数
+def run_jobs(jobs):
+    global img_total
+    img_total += len(jobs)
+    # 大きいページから先に開始する (Longest job first)
+    file_queue = queue.Queue()
+    for job in sorted(jobs, key=lambda job: job['pixels'], reverse=True):
+        file_queue.put(job)
+
+    # ダイジェストの確認はエンコードとは別の検証ワーカーで行う
+    verify_pool = None
+    if hash_check:
+        verify_pool = ThreadPoolExecutor(max_workers=num_verify_workers, thread_name_prefix='verify')
+
+    # プロセスモード
+    if args.processes is not None:
+        convert_image_process(file_queue, verify_pool)
+    else:
+        threads = []
+        # スレッドの作成と開始
+        for _ in range(num_threads):  # num_threadsの数だけスレッドを作成
+            t = threading.Thread(target=convert_image,args=(file_queue, verify_pool))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        # すべてのスレッドが終了するのを待つ
+        for t in threads:
+            t.join()
+
+    # 残っている確認が終わるのを待つ
+    if verify_pool is not None:
+        verify_pool.shutdown(wait=True)
+
+
+# 書き込むDPIを決定する関数
+def get_write_dpi(img, file_path):
+    # 元画像の解像度を取得
+    original_img_dpi = img.info.get('dpi', None)
+    if original_img_dpi is None:
+        estimated_img_dpi = 600
+    else:
+        # 72と150以上の50の倍数のうち、original_img_dpiに一番近いものを選択
+        estimated_img_dpi = min([72] + list(range(150, 1000, 50)), key=lambda x:abs(x-original_img_dpi[0]))
+
+    # dpiの設定
+    if args.dpi is None:
+        write_img_dpi = estimated_img_dpi
+    elif args.dpi == 0:
+        write_img_dpi = original_img_dpi
+    elif args.dpi < 0:
+        write_img_dpi = abs(args.dpi)
+    else:
+        if original_img_dpi is None and args.dpi > 0:
+            write_img_dpi = abs(args.dpi)
+        else:
+            write_img_dpi = estimated_img_dpi
+    verbose_print(Fore.YELLOW + f"DPI" + Fore.WHITE + " of "+file_path+"Original: "+variable_str(original_img_dpi)+", Estimated: "+variable_str(estimated_img_dpi)+", Write: "+variable_str(write_img_dpi))
+    return write_img_dpi
+
+# DPI情報を含むXMLBoxを作成する関数
+# sourceには元画像の幅・高さ・モード・画素ダイジェスト、specとtilesizeにはエンコード設定を記録する
+# 画素ダイジェストがあれば元画像なしでロスレスJP2を確認できる (jp2digest.py)
+# rateにはレート制御の目標と試し画像のPSNRを記録する
+def create_xmlbox(write_img_dpi, source=None, spec=None, tilesize=None, rate=None):
+    # DPI情報をXMLデータとして作成
+    dpi_str = str(write_img_dpi)
+    xml_data = f"""
+    <info>
+        <dpi>{dpi_str}</dpi>
+    </info>
+    """
+    # XMLデータをパース
+    xml = io.BytesIO(xml_data.encode())
+    tree = ET.parse(xml)
+    root = tree.getroot()
+
+    # 元画像の情報
+    if source is not None:
+        source_element = ET.SubElement(root, 'source')
+        ET.SubElement(source_element, 'width').text = str(source['width'])
+        ET.SubElement(source_element, 'height').text = str(source['height'])
+        ET.SubElement(source_element, 'mode').text = source['mode']
+        if source.get('content') is not None:
+            ET.SubElement(source_element, 'content').text = source['content']
+        if source['digest'] is not None:
+            ET.SubElement(source_element, 'digest', algorithm=jp2digest.digest_algorithm).text = source['digest']
+
+    # エンコード設定
+    if spec is not None:
+        encoder_element = ET.SubElement(root, 'encoder', name='openjpeg', version=glymur.version.openjpeg_version)
+        ET.SubElement(encoder_element, 'glymur').text = glymur.__version__
+        ET.SubElement(encoder_element, 'output').text = spec['name']
+        ET.SubElement(encoder_element, 'cratios').text = ','.join(str(cratio) for cratio in spec['cratios'])
+        ET.SubElement(encoder_element, 'lossless').text = 'true' if spec['name'] == 'lossless' else 'false'
+        color = spec['color']
+        if spec['auto_color'] and source is not None and source.get('content') in ('gray', 'bilevel'):
+            color = 'L'
+        if color is not None:
+            ET.SubElement(encoder_element, 'color').text = color
+        if spec['auto_color'] and source is not None and source.get('content') == 'bilevel':
+            ET.SubElement(encoder_element, 'threshold').text = '128'
+        if spec['reduce'] > 1:
+            ET.SubElement(encoder_element, 'reduce').text = str(spec['reduce'])
+        if tilesize is not None:
+            ET.SubElement(encoder_element, 'tilesize').text = f"{tilesize[1]}x{tilesize[0]}"
+        if rate is not None:
+            ET.SubElement(encoder_element, 'rate', {key: str(value) for key, value in rate.items()})
+
+    # XMLBoxを作成
+    return glymur.jp2box.XMLBox(xml=tree)
+
+# XMLBoxに記録する元画像の情報を作成する関数。digestはロスレス出力を作らない場合None
+# contentは--detect-grayで判定した内容 ('color' / 'gray' / 'bilevel')。判定しない場合None
+def make_source_info(size, mode, digest, content=None):
+    return {'width': size[0], 'height': size[1], 'mode': mode, 'digest': digest, 'content': content}
+
+# 内容判定に使う中間調の範囲 (この範囲の画素が少なければ白黒とみなす)
+bilevel_margin = 64
+
+# 内容判定の集計を作成する関数。判定できるのは8ビットのRGBとLだけ
+def new_content_stats(mode):
+    if not args.detect_gray or mode not in ('RGB', 'L'):
+        return None
+    return {'mode': mode, 'pixels': 0, 'color': 0, 'hist': np.zeros(256, dtype=np.int64)}
+
+# 行ストリップの画素を集計する関数 (色のずれがある画素数と輝度のヒストグラム)
+def update_content_stats(stats, strip):
+    if stats['mode'] == 'RGB':
+        rgb = strip[..., :3]
+        spread = rgb.max(axis=-1) - rgb.min(axis=-1)
+        stats['color'] += int(np.count_nonzero(spread > args.gray_tolerance))
+        del spread
+        # ITU-R 601の輝度 (Pillowのconvert('L')と同じ係数)
+        gray = (rgb[..., 0].astype(np.uint32) * 299 + rgb[..., 1].astype(np.uint32) * 587 + rgb[..., 2].astype(np.uint32) * 114) // 1000
+    else:
+        gray = strip
+    stats['pixels'] += gray.size
+    stats['hist'] += np.bincount(gray.ravel(), minlength=256)[:256]
+
+# 集計から内容を判定する関数。'color' / 'gray' / 'bilevel'
+def classify_content(stats):
+    if stats is None:
+        return None
+    pixels = max(1, stats['pixels'])
+    if stats['color'] > pixels * args.gray_fraction:
+        return 'color'
+    midtones = int(stats['hist'][bilevel_margin:256 - bilevel_margin].sum())
+    if midtones <= pixels * args.bilevel_fraction:
+        return 'bilevel'
+    return 'gray'
+
+# 判定した内容を表示する関数
+def report_content(file_path, content, mode):
+    # もともと1チャンネルのグレーは変わらないので表示しない
+    if content == 'bilevel' or (content == 'gray' and mode != 'L'):
+        verbose_print(f"Detected {content} content in {file_path}. Optimized output will use one channel.")
+
+# デコード済みの配列の内容をストリップ単位で判定する関数 (一時配列をストリップの大きさに抑える)
+def analyze_content(img_array, mode):
+    stats = new_content_stats(mode)
+    if stats is None:
+        return None
+    for y0 in range(0, img_array.shape[0], args.tile_size):
+        update_content_stats(stats, img_array[y0:y0 + args.tile_size])
+    return classify_content(stats)
+
+# PDFにそのまま埋め込める入力か、ヘッダーだけで判定する関数。'jpeg' / 'jp2' / None
+# JPEGはimg2pdfが再圧縮せずに埋め込み、可逆JP2はどのデコーダでも同じ画素になる
+def get_passthrough(img, file_path):
+    if args.no_passthrough or not file_path.lower().endswith(skip_conversion_extensions):
+        return None
+    if img.format == 'JPEG' and img.mode in ('L', 'RGB', 'CMYK'):
+        return 'jpeg'
+    if img.format == 'JPEG2000' and getattr(img, 'codec', None) == 'jp2' and img.mode in ('L', 'RGB') and is_reversible_jp2(file_path):
+        return 'jp2'
+    return None
+
+# JP2のコードストリームが可逆 (5/3ウェーブレット、量子化なし) か確認する関数
+def is_reversible_jp2(file_path):
+    with jp2digest.ascii_path(file_path) as path:
+        codestream = glymur.Jp2k(path).get_codestream(header_only=True)
+    segments = {segment.marker_id: segment for segment in codestream.segment}
+    # xform 1 = 5/3可逆ウェーブレット、sqcdの下位5ビット0 = 量子化なし
+    return segments['COD'].xform == 1 and segments['QCD'].sqcd & 0x1f == 0
+
+# パススルー: 入力をそのままロスレスフォルダにハードリンク (できなければコピー) する関数
+def passthrough_lossless(job):
+    file_path = job['file_path']
+    extension = '.jpg' if job['passthrough'] == 'jpeg' else '.jp2'
+    output_path = os.path.join(job['lossless_subdir'], os.path.splitext(os.path.basename(file_path))[0] + extension)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    try:
+        os.link(file_path, output_path)
+    except OSError:
+        shutil.copyfile(file_path, output_path)
+    verbose_print(f"Passed through {file_path} ({job['passthrough']}) to {output_path}")
+    return output_path
+
+# 一時ファイルを最終的な出力パスにリネームする関数
+def move_to_output(tmp_filename, file_path, output_subdir):
+    output_path = os.path.join(output_subdir, os.path.splitext(os.path.basename(file_path))[0] + '.jp2')
+    shutil.move(tmp_filename, output_path)
+    return output_path
+
+# ロスレス画像を変換して出力する関数。--check fastの場合はリネーム前にglymurで確認する
+# keep_tmpの場合は確認とリネームを検証ワーカーに任せるため一時ファイルのパスを返す
+def encode_lossless(img_array, xmlbox, file_path, lossless_subdir, keep_tmp=False):
+    # 一時的なファイル名を作成（日本語をglymurに渡さないため）
+    tmp_filename = os.path.join(tmp_path, str(uuid.uuid4()) + '_temp.jp2')
+
+    # ロスレス画像の変換と出力
+    jp2Lossless = glymur.Jp2k(tmp_filename, data=img_array, cratios=[1])
+
+    # XMLBoxを追加
+    jp2Lossless.append(xmlbox)
+
+    # メタデータを読む関数を定義
+    jp2Read = glymur.Jp2k(tmp_filename)
+
+    # メタデータのboxを検索
+    for box in jp2Read.box:
+        # XMLBoxを探す
+        if isinstance(box, glymur.jp2box.XMLBox):
+            # XMLを解析
+            root = box.xml.getroot()
+            # dpi要素を探す
+            dpi_elements = root.findall('.//dpi')
+            for read_dpi in dpi_elements:
+                verbose_print(f"Confirming"+Fore.YELLOW+" DPI "+Style.RESET_ALL+"for"+file_path +Fore.CYAN+ read_dpi.text+Style.RESET_ALL)
+
+    #チェックの方法に基づいて画像を読み込み
+    is_bitperfect = None
+    if args.check == "fast" and not args.quick:
+        debug_print("Checking bit-perfect conversion using glymur...")
+        # glymurを使用して画像を読み込み
+        converted_img_array = glymur.Jp2k(tmp_filename)[:]
+
+        # 元画像と変換後の画像がビットパーフェクトに一致するかどうかを確認
+        is_bitperfect = np.array_equal(img_array, converted_img_array)
+
+    if keep_tmp:
+        return tmp_filename, None
+
+    # 一時的なファイルを最終的な出力パスにリネーム
+    output_path = move_to_output(tmp_filename, file_path, lossless_subdir)
+    return output_path, is_bitperfect
+
+# ロスレス変換とチェック方法に応じた確認を行い、結果を辞書で返す関数
+# --check hashの場合は元画像のダイジェストと一時ファイルを返し、確認は検証ワーカーで行う
+def encode_lossless_checked(img_array, xmlbox, file_path, lossless_subdir, digest):
+    if hash_check:
+        tmp_filename, _ = encode_lossless(img_array, xmlbox, file_path, lossless_subdir, keep_tmp=True)
+        return {'lossless_hash': (tmp_filename, digest)}
+    output_path, is_bitperfect = encode_lossless(img_array, xmlbox, file_path, lossless_subdir)
+    if not args.check == "fast" and not args.quick:
+        is_bitperfect = check_bitperfect_slow(img_array, output_path)
+    return {'lossless': is_bitperfect}
+
+# 検証ワーカー: 一時ファイルをストリップ単位でデコードしたダイジェストを元画像のダイジェストと比較してからリネームする
+def verify_lossless_hash(file_path, tmp_filename, digest, lossless_subdir):
+    debug_print(f"Checking bit-perfect conversion of {file_path} using pixel digest...")
+    is_bitperfect = jp2digest.jp2_digest(tmp_filename, args.tile_size) == digest
+    move_to_output(tmp_filename, file_path, lossless_subdir)
+    return is_bitperfect
+
+# Pillowで最終出力を読み込んでビットパーフェクトか確認する関数 (--check slow)
+def check_bitperfect_slow(img_array, output_path):
+    debug_print("Checking bit-perfect conversion using Pillow...")
+    # Pillowを使用して画像を読み込み
+    with Image.open(output_path) as converted_img:
+        converted_img_array = np.array(converted_img)
+
+    # 元画像と変換後の画像がビットパーフェクトに一致するかどうかを確認
+    return np.array_equal(img_array, converted_img_array)
+
+# 名前から出力の仕様を返す関数
+def get_output_spec(name):
+    for spec in output_specs:
+        if spec['name'] == name:
+            return spec
+    raise KeyError(name)
+
+# numpy配列を元のモードのPillow Imageに戻す関数 (Pillowのモードとnumpyの形が1対1でないモードはバイト列から作る)
+def array_to_image(img_array, mode):
+    if mode in ('1', 'L', 'LA', 'RGB', 'RGBA', 'I;16'):
+        return Image.fromarray(img_array)
+    height, width = img_array.shape[:2]
+    return Image.frombuffer(mode, (width, height), np.ascontiguousarray(img_array), 'raw', mode, 0, 1)
+
+# 出力の仕様に従って色の削減と縮小をした配列を返す関数。仕様がそのままなら同じ配列を返す
+# auto_colorの出力は、contentがgrayなら1チャンネル、bilevelなら1チャンネルの白黒 (0/255) にする
+# 行ストリップに対しても使える (縮小率で割り切れる行数なら画像全体を縮小した結果と同じ)
+def derive_array(spec, img_array, mode, content=None):
+    color = spec['color']
+    bilevel = False
+    if spec['auto_color'] and content in ('gray', 'bilevel'):
+        color = 'L'
+        bilevel = content == 'bilevel'
+    if color is None and spec['reduce'] == 1:
+        return img_array
+    if color == 'L' and img_array.ndim == 2 and img_array.dtype.itemsize == 2:
+        # 16ビットのグレーは上位8ビットを使う (convertでは255で飽和するため)
+        img = Image.fromarray((img_array >> 8).astype(np.uint8))
+    else:
+        img = array_to_image(img_array, mode)
+    if color is not None and img.mode != color:
+        img = img.convert(color)
+    if bilevel:
+        img = img.point(lambda value: 255 if value >= 128 else 0)
+    if spec['reduce'] > 1:
+        img = img.reduce(spec['reduce'])
+    return np.asarray(img)
+
+# 配列を縦横factor画素ごとの平均で縮小する関数 (レート制御の試し画像用。端の余りは切り捨てる)
+def reduce_array(img_array, factor):
+    height = img_array.shape[0] // factor * factor
+    width = img_array.shape[1] // factor * factor
+    if factor <= 1 or height == 0 or width == 0:
+        return img_array
+    blocks = img_array[:height, :width].reshape(height // factor, factor, width // factor, factor, *img_array.shape[2:])
+    return blocks.mean(axis=(1, 3)).astype(img_array.dtype)
+
+# 2つの配列のPSNR (dB) を返す関数
+def compute_psnr(reference, decoded):
+    mse = np.mean((reference.astype(np.float64) - decoded.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    peak = np.iinfo(reference.dtype).max if reference.dtype.kind in 'ui' else 1.0
+    return 10 * math.log10(peak ** 2 / mse)
+
+# 試し画像を圧縮率cratioでエンコード・デコードしてPSNRを返す関数
+def trial_psnr(trial_array, cratio):
+    tmp_filename = os.path.join(tmp_path, str(uuid.uuid4()) + '_trial.jp2')
+    try:
+        # 小さい試し画像では解像度レベル数を減らす
+        numres = max(1, min(6, min(trial_array.shape[:2]).bit_length()))
+        glymur.Jp2k(tmp_filename, data=trial_array, cratios=[cratio], numres=numres)
+        return compute_psnr(trial_array, glymur.Jp2k(tmp_filename)[:])
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+# レート制御で出力の圧縮率を決める関数。戻り値は (cratios, XMLBoxに記録する情報またはNone)
+# --target-sizeは元の大きさから直接、--target-psnrは試し画像で目標を満たす最大の圧縮率を対数の二分探索で探す
+def choose_cratios(spec, trial_array, output_nbytes):
+    if not rate_control or not spec['rate_control']:
+        return spec['cratios'], None
+    if args.target_size is not None:
+        cratio = min(max(output_nbytes / (args.target_size * 1024), args.min_cratio), args.max_cratio)
+        return [round(cratio, 1)], {'target': 'size', 'value': args.target_size}
+
+    # 白紙などは最大の圧縮率でも目標を満たす
+    best_cratio = args.max_cratio
+    best_psnr = trial_psnr(trial_array, best_cratio)
+    if best_psnr < args.target_psnr:
+        best_cratio = args.min_cratio
+        best_psnr = trial_psnr(trial_array, best_cratio)
+        low, high = math.log(args.min_cratio), math.log(args.max_cratio)
+        for _ in range(rate_search_steps):
+            cratio = math.exp((low + high) / 2)
+            value = trial_psnr(trial_array, cratio)
+            if value >= args.target_psnr:
+                best_cratio, best_psnr = cratio, value
+                low = math.log(cratio)
+            else:
+                high = math.log(cratio)
+    return [round(best_cratio, 1)], {'target': 'psnr', 'value': args.target_psnr, 'trial_psnr': round(best_psnr, 2)}
+
+# レート制御で選んだ圧縮率を表示・記録する関数
+def report_cratios(file_path, spec, cratios, rate):
+    if rate is None:
+        return
+    message = f"Compression ratio for {file_path} ({spec['name']}): {cratios[0]}"
+    if 'trial_psnr' in rate:
+        message += f" (trial PSNR {rate['trial_psnr']} dB, target {rate['value']} dB)"
+    else:
+        message += f" (target {rate['value']} KB)"
+    verbose_print(message)
+
+# 派生出力 (最適化・OCR用など) を変換して出力する関数。XMLBoxはレート制御で選んだ圧縮率を入れてここで作る
+def encode_output(spec, img_array, mode, write_img_dpi, source, file_path, output_subdir):
+    # 一時的なファイル名を作成（日本語をglymurに渡さないため）
+    tmp_filename = os.path.join(tmp_path, str(uuid.uuid4()) + '_temp_' + spec['name'] + '.jp2')
+
+    # 仕様どおりの配列に変換して、圧縮率を決めて出力
+    output_array = derive_array(spec, img_array, mode, source['content'])
+    trial_array = reduce_array(output_array, args.trial_reduce) if rate_control and spec['rate_control'] else None
+    cratios, rate = choose_cratios(spec, trial_array, output_array.nbytes)
+    report_cratios(file_path, spec, cratios, rate)
+    jp2Output = glymur.Jp2k(tmp_filename, data=output_array, cratios=cratios)
+    del output_array, trial_array
+
+    # XMLBoxを追加
+    jp2Output.append(create_xmlbox(get_output_dpi(spec, write_img_dpi), source, dict(spec, cratios=cratios), rate=rate))
+
+    # 一時的なファイルを最終的な出力パスにリネーム
+    return move_to_output(tmp_filename, file_path, output_subdir)
+
+# 出力のDPI。縮小した出力はその分DPIを下げてページサイズを保つ
+def get_output_dpi(spec, write_img_dpi):
+    return round(write_img_dpi / spec['reduce'])
+
+# カウンターを更新して進捗を表示する関数
+def count_lossless(job):
+    global lossless_count
+    book = books[job['book']]
+    with count_lock:
+        lossless_count += 1
+        book['lossless'] += 1
+        verbose_print(f"Lossless conversion for "+job['file_path']+" complete!")
+        print(Fore.BLUE + "Lossless conversion" + Fore.CYAN+ str(book['lossless']) + Fore.WHITE +"/" + Fore.CYAN + str(book['total'])+Style.RESET_ALL+"for "+job['book']+Fore.CYAN+" ("+str(lossless_count)+" / "+str(img_total)+")"+Style.RESET_ALL)
+
+def count_bitperfect(job, is_bitperfect):
+    global lossless_OK, lossless_NO, lossless_CHK
+    file_path = job['file_path']
+    with count_lock:
+        lossless_CHK += 1
+        if is_bitperfect:
+            lossless_OK += 1
+            verbose_print(f"Bitperfect conversion for {file_path} verified!")
+            print(Fore.YELLOW + "Bitperfect " + Fore.GREEN + " OK " + variable_str(lossless_OK) + Fore.WHITE +"/" +  Fore.RED + "NO " + Fore.CYAN + variable_str(lossless_NO) + Fore.WHITE + "/" + Fore.MAGENTA + "Total " + Fore.CYAN + variable_str(lossless_CHK) + Style.RESET_ALL)
+        else:
+            lossless_NO += 1
+            job['failed'] = True
+            error_print(f"Bitperfect conversion for {file_path}: Failed!")
+            print(Fore.YELLOW + "Bitperfect " + Fore.GREEN + " OK " + variable_str(lossless_OK) + Fore.WHITE +"/" +  Fore.RED + "NO " + Fore.CYAN + variable_str(lossless_NO) + Fore.WHITE + "/" + Fore.MAGENTA + "Total " + Fore.CYAN + variable_str(lossless_CHK) + Style.RESET_ALL)
+
+def count_output(job, name):
+    global optimized_count
+    book = books[job['book']]
+    with count_lock:
+        output_counts[name] = output_counts.get(name, 0) + 1
+        if name == 'optimized':
+            optimized_count += 1
+        book[name] += 1
+        verbose_print(f"{name.capitalize()} conversion for {job['file_path']} complete!")
+        print(Fore.BLUE + name.capitalize() + " conversion" + Fore.CYAN+ str(book[name]) + Fore.WHITE +"/" + Fore.CYAN + str(book['total'])+Style.RESET_ALL+"for "+job['book']+Style.RESET_ALL)
 
-                    # 最適化された画像の変換と出力
-                    jp2Optimized = glymur.Jp2k(tmp_filename_opt, data=img_array, cratios=[80])
+# 1枚の変換結果 {'lossless': ビットパーフェクトか, 派生出力名: True} をカウンターに反映する関数
+def count_results(job, results):
+    if 'lossless' in results:
+        count_lossless(job)
+        if not args.quick:
+            count_bitperfect(job, results['lossless'])
+    for spec in derived_specs:
+        if spec['name'] in results:
+            count_output(job, spec['name'])
 
-                    # XMLBoxを追加
-                    jp2Optimized.append(xmlbox)
+# 1枚の画像を変換して結果を辞書で返す関数 (スレッドモードと、共有メモリに置けない画像のプロセスモード)
+def convert_image_file(job):
+    file_path = job['file_path']
+    results = {}
+    if job['manifest'] is not None:
+        results['fingerprint'] = source_fingerprint(file_path)
+    # パススルーの入力はそのままリンクし、最適化出力だけ変換する
+    if job['passthrough'] and not args.optimize:
+        passthrough_lossless(job)
+        results['lossless'] = True
+        if not derived_specs:
+            return results
+    encode_lossless_output = not args.optimize and not job['passthrough']
 
-                    # 一時的なファイルを最終的な出力パスにリネーム
-                    output_path_opt = os.path.join(optimized_subdir, os.path.splitext(os.path.basename(file_path))[0] + '.jp2')
-                    shutil.move(tmp_filename_opt, output_path_opt)
+    with Image.open(file_path) as img:
+        write_img_dpi = get_write_dpi(img, file_path)
 
-                    with count_lock:
-                        optimized_count += 1
-                        verbose_print(f"Optimized conversion for {file_path} complete!")
-                        print(Fore.BLUE + "Optimized conversion" + Fore.CYAN+ str(optimized_count) + Fore.WHITE +"/" + Fore.CYAN + str(img_per_subdir_count)+Style.RESET_ALL)
+        # Pillow Imageをnumpy arrayに変換
+        img_array = np.array(img)
+
+    # ロスレス出力には元画像の画素ダイジェストを記録する
+    digest = jp2digest.array_digest(img_array, args.tile_size) if encode_lossless_output else None
+    content = analyze_content(img_array, job['mode'])
+    report_content(file_path, content, job['mode'])
+    source = make_source_info(job['size'], job['mode'], digest, content)
+
+    if encode_lossless_output:
+        xmlbox = create_xmlbox(write_img_dpi, source, get_output_spec('lossless'))
+        results.update(encode_lossless_checked(img_array, xmlbox, file_path, job['lossless_subdir'], digest))
+
+    # 同じ配列から派生出力を作る
+    for spec in derived_specs:
+        encode_output(spec, img_array, job['mode'], write_img_dpi, source, file_path, job['output_subdirs'][spec['name']])
+        results[spec['name']] = True
+    return results
+
+# スレッドモード: ダイジェストの確認を検証ワーカーに投入する。ジョブは確認が終わってから完了になる
+def submit_hash_verify(verify_pool, job, tmp_filename, digest):
+    future = verify_pool.submit(verify_lossless_hash, job['file_path'], tmp_filename, digest, job['lossless_subdir'])
+    future.add_done_callback(lambda future: finish_hash_verify(job, future))
+
+def finish_hash_verify(job, future):
+    try:
+        is_bitperfect = future.result()
+        count_lossless(job)
+        count_bitperfect(job, is_bitperfect)
+    except Exception as e:
+        job['failed'] = True
+        logger.error(f"Error verifying file {job['file_path']}: {e}")
+        logger.error(traceback.format_exc())
+    finally:
+        finish_job(job)
+
+# 画像変換関数を定義
+def convert_image(file_queue, verify_pool=None):
+    while not file_queue.empty():
+        # ジョブ (入力ファイルと出力先のサブディレクトリ) を取得
+        job = file_queue.get()
+        file_path = job['file_path']
+        verify_pending = False
+        admit_job(job)
+        try:
+            # 大きな画像はタイル単位でエンコード
+            if job['tiled']:
+                results = convert_image_tiled(job)
+            else:
+                results = convert_image_file(job)
+            job['fingerprint'] = results.pop('fingerprint', None)
+            # ダイジェストの確認は検証ワーカーに任せて次の画像に進む
+            if 'lossless_hash' in results:
+                submit_hash_verify(verify_pool, job, *results.pop('lossless_hash'))
+                verify_pending = True
+            count_results(job, results)
 
         except Exception as e:
+            job['failed'] = True
             logger.error(f"Error converting file {file_path}: {e}")
             logger.error(traceback.format_exc())
         finally:
+            release_job_memory(job)
+            if not verify_pending:
+                finish_job(job)
             file_queue.task_done()
 
 
+# 共有メモリに置ける画像モードとnumpyのdtype,チャンネル数 (np.array(img)と同じ形になるもの)
+shared_array_modes = {
+    '1': (np.bool_, 0),
+    'L': (np.uint8, 0),
+    'P': (np.uint8, 0),
+    'LA': (np.uint8, 2),
+    'RGB': (np.uint8, 3),
+    'RGBA': (np.uint8, 4),
+    'CMYK': (np.uint8, 4),
+    'YCbCr': (np.uint8, 3),
+    'I;16': (np.dtype('<u2'), 0),
+    'I;16B': (np.dtype('>u2'), 0),
+    'I': (np.int32, 0),
+    'F': (np.float32, 0),
+}
+
+# 事前に読んだヘッダーから共有メモリ用の形とdtypeを返す関数。対応しないモードはNone
+def get_shared_array_spec(job):
+    if job['mode'] not in shared_array_modes:
+        return None
+    width, height = job['size']
+    dtype, channels = shared_array_modes[job['mode']]
+    shape = (height, width, channels) if channels else (height, width)
+    return shape, np.dtype(dtype).str
+
+# ワーカープロセスから既存の共有メモリに接続する関数
+def attach_shared_memory(shm_name):
+    try:
+        # Python 3.13以降はresource_trackerに登録しない
+        return shared_memory.SharedMemory(name=shm_name, track=False)
+    except TypeError:
+        # resource_trackerは親プロセスと共有なので、親のunlinkで登録も消える
+        return shared_memory.SharedMemory(name=shm_name)
+
+# ワーカープロセスの初期化。glymurのスレッド数をワーカー数と合わせて設定する
+def init_process_worker(glymur_threads):
+    glymur.set_option('lib.num_threads', glymur_threads)
+
+# ワーカープロセス: 画像を一度だけデコードして共有メモリに書き込み、書き込むDPIとダイジェストと内容の判定を返す
+def decode_worker(file_path, shm_name, shape, dtype, use_manifest=False):
+    shm = attach_shared_memory(shm_name)
+    try:
+        fingerprint = source_fingerprint(file_path) if use_manifest else None
+        shm_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        with Image.open(file_path) as img:
+            write_img_dpi = get_write_dpi(img, file_path)
+            mode = img.mode
+            img_array = np.asarray(img)
+            if img_array.shape != shm_array.shape or img_array.dtype != shm_array.dtype:
+                raise ValueError(f"Decoded array {img_array.shape} {img_array.dtype} does not match header {shape} {dtype}")
+            shm_array[...] = img_array
+        del img_array
+        # ロスレス出力のXMLBoxに記録する画素ダイジェストもここで計算する
+        digest = None if args.optimize else jp2digest.array_digest(shm_array, args.tile_size)
+        # --detect-grayの内容判定もデコードしたワーカーで行う
+        content = analyze_content(shm_array, mode)
+        report_content(file_path, content, mode)
+        del shm_array
+        return write_img_dpi, digest, content, fingerprint
+    finally:
+        shm.close()
+
+# ワーカープロセス: 共有メモリの画像を出力の仕様どおりにエンコードする (lossless / 派生出力)
+def encode_worker(kind, file_path, output_subdir, shm_name, shape, dtype, write_img_dpi, source):
+    shm = attach_shared_memory(shm_name)
+    try:
+        img_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        spec = get_output_spec(kind)
+        if kind == 'lossless':
+            xmlbox = create_xmlbox(write_img_dpi, source, spec)
+            result = encode_lossless(img_array, xmlbox, file_path, output_subdir, keep_tmp=hash_check)
+        else:
+            result = encode_output(spec, img_array, source['mode'], write_img_dpi, source, file_path, output_subdir)
+        del img_array
+        return result
+    finally:
+        shm.close()
+
+# ワーカープロセス: 共有メモリの画像と最終出力を比較する (--check slow)
+def verify_worker(output_path, shm_name, shape, dtype):
+    shm = attach_shared_memory(shm_name)
+    try:
+        img_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        is_bitperfect = check_bitperfect_slow(img_array, output_path)
+        del img_array
+        return is_bitperfect
+    finally:
+        shm.close()
+
+# 無圧縮(raw)画像のrawmodeごとの1画素のビット数
+raw_mode_bits = {
+    '1': 1, '1;I': 1,
+    'L': 8, 'L;I': 8, 'P': 8,
+    'LA': 16, 'I;16': 16, 'I;16B': 16, 'I;16L': 16, 'I;16N': 16,
+    'RGB': 24, 'BGR': 24,
+    'RGBA': 32, 'RGBX': 32, 'BGRA': 32, 'BGRX': 32, 'CMYK': 32, 'I;32': 32, 'I;32B': 32, 'F;32F': 32, 'F;32BF': 32,
+}
+
+# 画像が全幅の無圧縮ストリップだけでできていれば、行範囲を直接読むための情報を返す関数。それ以外はNone
+def get_raw_strips(img):
+    width = img.size[0]
+    strips = []
+    for tile in img.tile:
+        codec, extents, offset, tile_args = tile[:4]
+        if codec != 'raw':
+            return None
+        x0, y0, x1, y1 = extents
+        if x0 != 0 or x1 != width:
+            return None
+        if isinstance(tile_args, str):
+            tile_args = (tile_args,)
+        rawmode = tile_args[0]
+        stride = tile_args[1] if len(tile_args) > 1 else 0
+        orientation = tile_args[2] if len(tile_args) > 2 else 1
+        if rawmode not in raw_mode_bits or orientation not in (1, -1):
+            return None
+        if not stride:
+            stride = (width * raw_mode_bits[rawmode] + 7) // 8
+        strips.append((y0, y1, offset, rawmode, stride, orientation))
+    return strips or None
+
+# 画像を上から行ストリップ単位で読み込むジェネレーター (y0, ストリップの配列)
+# 無圧縮ならファイルから必要な行だけを読み、それ以外はPillowで一度だけデコードしてcropする
+def iter_image_strips(file_path, strip_height):
+    with Image.open(file_path) as img:
+        width, height = img.size
+        mode = img.mode
+        raw_strips = get_raw_strips(img)
+        if raw_strips is None:
+            debug_print(f"{file_path} is compressed. Decoding once and cropping strips.")
+            img.load()
+            for y0 in range(0, height, strip_height):
+                y1 = min(y0 + strip_height, height)
+                yield y0, np.asarray(img.crop((0, y0, width, y1)))
+            return
+
+    with open(file_path, 'rb') as f:
+        for y0 in range(0, height, strip_height):
+            y1 = min(y0 + strip_height, height)
+            pieces = []
+            for strip_y0, strip_y1, offset, rawmode, stride, orientation in raw_strips:
+                top = max(y0, strip_y0)
+                bottom = min(y1, strip_y1)
+                if top >= bottom:
+                    continue
+                # 下から上に保存されている画像(BMP)は行の位置が逆になる
+                if orientation == 1:
+                    f.seek(offset + (top - strip_y0) * stride)
+                else:
+                    f.seek(offset + (strip_y1 - bottom) * stride)
+                data = f.read((bottom - top) * stride)
+                piece = Image.frombytes(mode, (width, bottom - top), data, 'raw', rawmode, stride, orientation)
+                pieces.append(np.asarray(piece))
+            yield y0, pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+# タイル単位で書いたJP2と元画像をストリップごとに比較する関数
+def check_bitperfect_tiled(file_path, jp2_path, strip_height):
+    debug_print("Checking bit-perfect conversion tile by tile using glymur...")
+    jp2 = glymur.Jp2k(jp2_path)
+    for y0, strip in iter_image_strips(file_path, strip_height):
+        if not np.array_equal(strip, jp2[y0:y0 + strip.shape[0], :]):
+            return False
+    return True
+
+# 出力の仕様を適用した後の画像の形とタイルの大きさを返す関数 (縮小は切り上げ)
+def get_derived_shape(spec, shape, dtype, mode, tilesize, content=None):
+    reduce = spec['reduce']
+    probe = derive_array(spec, np.zeros((reduce, reduce) + tuple(shape[2:]), dtype=dtype), mode, content)
+    derived_shape = (-(-shape[0] // reduce), -(-shape[1] // reduce)) + probe.shape[2:]
+    derived_tilesize = (-(-tilesize[0] // reduce), -(-tilesize[1] // reduce))
+    return derived_shape, derived_tilesize
+
+# 大きな画像をストリップ単位で読み、全ての出力のJP2をタイル単位で同時に書く関数
+# メモリ使用量は画像全体ではなくタイル1行分に比例する
+def convert_image_tiled(job):
+    file_path = job['file_path']
+    with Image.open(file_path) as img:
+        write_img_dpi = get_write_dpi(img, file_path)
+
+    width, height = job['size']
+    dtype, channels = shared_array_modes[job['mode']]
+    shape = (height, width, channels) if channels else (height, width)
+    tilesize = (min(args.tile_size, height), min(args.tile_size, width))
+    verbose_print(f"Encoding {file_path} in tiles of {tilesize[1]} x {tilesize[0]}")
+
+    results = {}
+    if job['manifest'] is not None:
+        results['fingerprint'] = source_fingerprint(file_path)
+    # パススルーの入力はそのままリンクし、派生出力だけ変換する
+    if job['passthrough'] and not args.optimize:
+        passthrough_lossless(job)
+        results['lossless'] = True
+
+    # 派生出力のチャンネル数と圧縮率を決めるため、--detect-grayの内容判定とレート制御の試し画像は先にストリップを1回読んで作る
+    content = None
+    stats = new_content_stats(job['mode']) if derived_specs else None
+    rate_specs = [spec for spec in derived_specs if rate_control and spec['rate_control']]
+    trial_strips = []
+    if stats is not None or rate_specs:
+        for y0, strip in iter_image_strips(file_path, tilesize[0]):
+            if stats is not None:
+                update_content_stats(stats, strip)
+            if rate_specs:
+                trial_strips.append(reduce_array(strip, args.trial_reduce))
+            del strip
+        content = classify_content(stats)
+        report_content(file_path, content, job['mode'])
+    trial_source = np.concatenate(trial_strips) if trial_strips else None
+    del trial_strips
+
+    # 一時的なファイル名を作成（日本語をglymurに渡さないため）
+    outputs = {}
+    for spec in output_specs:
+        if spec['name'] == 'lossless' and job['passthrough']:
+            continue
+        tmp_filename = os.path.join(tmp_path, str(uuid.uuid4()) + '_temp_' + spec['name'] + '.jp2')
+        output_shape, output_tilesize = get_derived_shape(spec, shape, dtype, job['mode'], tilesize, content)
+        # レート制御の試し画像は縮小した元画像に出力の仕様を適用して作る
+        trial_array = derive_array(spec, trial_source, job['mode'], content) if spec in rate_specs else None
+        output_nbytes = int(np.prod(output_shape)) * derive_array(spec, np.zeros((1, 1) + tuple(shape[2:]), dtype=dtype), job['mode'], content).dtype.itemsize
+        cratios, rate = choose_cratios(spec, trial_array, output_nbytes)
+        report_cratios(file_path, spec, cratios, rate)
+        # 縮小した出力のタイルが小さい場合は解像度レベル数を減らす (タイルは2^(numres-1)画素以上が必要)
+        numres = max(1, min(6, min(output_tilesize).bit_length()))
+        jp2 = glymur.Jp2k(tmp_filename, shape=output_shape, tilesize=output_tilesize, cratios=cratios, numres=numres)
+        outputs[spec['name']] = (tmp_filename, dict(spec, cratios=cratios, rate=rate), output_tilesize, iter(jp2.get_tilewriters()))
+
+    # ロスレス出力のXMLBoxに記録する画素ダイジェストを、読み込んだストリップから計算する
+    digest = jp2digest.new_pixel_digest(shape, dtype) if 'lossless' in outputs else None
+
+    # ストリップを1回読むごとに、全ての出力へ仕様どおりのタイルを書き込む
+    for y0, strip in iter_image_strips(file_path, tilesize[0]):
+        if digest is not None:
+            jp2digest.update_pixel_digest(digest, strip)
+        for tmp_filename, spec, output_tilesize, tile_writer in outputs.values():
+            output_strip = derive_array(spec, strip, job['mode'], content)
+            for x0 in range(0, output_strip.shape[1], output_tilesize[1]):
+                next(tile_writer)[:] = np.ascontiguousarray(output_strip[:, x0:x0 + output_tilesize[1]])
+            del output_strip
+        del strip
+    # 最後のnextでglymurがファイルを確定する
+    for tmp_filename, spec, output_tilesize, tile_writer in outputs.values():
+        next(tile_writer, None)
+
+    digest = None if digest is None else digest.hexdigest()
+    source = make_source_info(job['size'], job['mode'], digest, content)
+
+    for kind, (tmp_filename, spec, output_tilesize, tile_writer) in outputs.items():
+        # XMLBoxを追加
+        glymur.Jp2k(tmp_filename).append(create_xmlbox(get_output_dpi(spec, write_img_dpi), source, spec, output_tilesize, spec.get('rate')))
+        if kind == 'lossless' and hash_check:
+            # 確認とリネームは検証ワーカーで行う
+            results['lossless_hash'] = (tmp_filename, digest)
+            continue
+        if kind == 'lossless':
+            # タイル単位ではglymurで一時ファイルを確認する
+            results['lossless'] = None if args.quick else check_bitperfect_tiled(file_path, tmp_filename, tilesize[0])
+        else:
+            results[kind] = True
+        # 一時的なファイルを最終的な出力パスにリネーム
+        move_to_output(tmp_filename, file_path, job['output_subdirs'][kind])
+    return results
+
+# プロセスプールを作成する関数。ワーカー数とglymurのスレッド数はここで同時に決める
+def get_process_pool():
+    global process_pool
+    if process_pool is None:
+        info_print(f"Starting process pool: {variable_str(num_processes)} processes x {variable_str(glymur_threads)} glymur threads")
+        # ワーカーが親と同じresource_trackerを使うように、プール作成前に起動しておく
+        if os.name != 'nt':
+            resource_tracker.ensure_running()
+        process_pool = ProcessPoolExecutor(max_workers=num_processes, initializer=init_process_worker, initargs=(glymur_threads,))
+    return process_pool
+
+# プロセスプールでキュー内の画像を変換する関数。各ステージの完了は親プロセスで集計する
+def convert_image_process(file_queue, verify_pool=None):
+    pool = get_process_pool()
+    # 同時にデコード済みで保持する画像数 (共有メモリの上限)
+    max_in_flight = num_processes
+    pending = {}
+    jobs_in_flight = 0
+    # メモリ予算に収まらず待機しているジョブ
+    deferred_jobs = []
+
+    # 画素を使うステージが完了したら共有メモリを解放し、全ステージ (ダイジェストの確認を含む) が完了したらジョブを完了にする
+    def release_job(job, stage):
+        nonlocal jobs_in_flight
+        job['stages'] -= 1
+        if stage != 'hash':
+            job['shm_stages'] -= 1
+            if job['shm_stages'] == 0:
+                if job['shm'] is not None:
+                    job['shm'].close()
+                    job['shm'].unlink()
+                jobs_in_flight -= 1
+                release_job_memory(job)
+        if job['stages'] == 0:
+            finish_job(job)
+
+    def submit(job, stage, fn, *fn_args):
+        job['stages'] += 1
+        if stage == 'hash':
+            # ダイジェストの確認は共有メモリを使わないので検証スレッドで行う
+            future = verify_pool.submit(fn, *fn_args)
+        else:
+            job['shm_stages'] += 1
+            future = pool.submit(fn, *fn_args)
+        pending[future] = (job, stage)
+
+    def submit_hash(job, tmp_filename, digest):
+        submit(job, 'hash', verify_lossless_hash, job['file_path'], tmp_filename, digest, job['lossless_subdir'])
+
+    # メモリ予算に収まる次のジョブを返す関数。大きいページが待つ間も小さいページは先に進める
+    def next_admissible_job():
+        for job in deferred_jobs:
+            if try_admit_job(job):
+                deferred_jobs.remove(job)
+                return job
+        while not file_queue.empty() and len(deferred_jobs) < max_in_flight:
+            job = file_queue.get()
+            file_queue.task_done()
+            if try_admit_job(job):
+                return job
+            debug_print(f"Deferring {job['file_path']} until memory is available ({job['memory'] / 2**20:.1f} MB)")
+            deferred_jobs.append(job)
+        return None
+
+    while not file_queue.empty() or pending or deferred_jobs:
+        # 上限まで新しい画像のデコードを投入
+        while jobs_in_flight < max_in_flight:
+            job = next_admissible_job()
+            if job is None:
+                break
+            file_path = job['file_path']
+            job['shm'] = None
+            job['stages'] = 0
+            job['shm_stages'] = 0
+            job['digest'] = None
+            try:
+                spec = get_shared_array_spec(job)
+                if job['tiled']:
+                    submit(job, 'file', convert_image_tiled, dict(job))
+                elif spec is None or job['passthrough']:
+                    debug_print(f"{file_path} is passed through or its mode is not supported for shared memory. Converting in one process.")
+                    submit(job, 'file', convert_image_file, dict(job))
+                else:
+                    job['shape'], job['dtype'] = spec
+                    nbytes = max(1, int(np.prod(job['shape'])) * np.dtype(job['dtype']).itemsize)
+                    job['shm'] = shared_memory.SharedMemory(create=True, size=nbytes)
+                    submit(job, 'decode', decode_worker, file_path, job['shm'].name, job['shape'], job['dtype'], job['manifest'] is not None)
+                jobs_in_flight += 1
+            except Exception as e:
+                job['failed'] = True
+                logger.error(f"Error converting file {file_path}: {e}")
+                logger.error(traceback.format_exc())
+                if job['shm'] is not None:
+                    job['shm'].close()
+                    job['shm'].unlink()
+                release_job_memory(job)
+                finish_job(job)
+
+        if not pending:
+            continue
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            job, stage = pending.pop(future)
+            file_path = job['file_path']
+            try:
+                result = future.result()
+                if stage == 'decode':
+                    write_img_dpi, job['digest'], content, job['fingerprint'] = result
+                    shm_args = (job['shm'].name, job['shape'], job['dtype'])
+                    source = make_source_info(job['size'], job['mode'], job['digest'], content)
+                    # デコードが終わったら全ての出力のエンコードを同時に投入
+                    for spec in output_specs:
+                        submit(job, spec['name'], encode_worker, spec['name'], file_path, job['output_subdirs'][spec['name']], *shm_args, write_img_dpi, source)
+                elif stage == 'lossless' and hash_check:
+                    # 一時ファイルの確認とリネームは検証スレッドで行い、共有メモリはすぐ解放する
+                    tmp_filename, _ = result
+                    submit_hash(job, tmp_filename, job['digest'])
+                elif stage == 'hash':
+                    count_lossless(job)
+                    count_bitperfect(job, result)
+                elif stage == 'lossless':
+                    output_path, is_bitperfect = result
+                    count_lossless(job)
+                    if not args.quick:
+                        if args.check == "fast":
+                            count_bitperfect(job, is_bitperfect)
+                        else:
+                            submit(job, 'verify', verify_worker, output_path, job['shm'].name, job['shape'], job['dtype'])
+                elif stage == 'verify':
+                    count_bitperfect(job, result)
+                elif stage in job['output_subdirs']:
+                    count_output(job, stage)
+                elif stage == 'file':
+                    job['fingerprint'] = result.pop('fingerprint', None)
+                    if 'lossless_hash' in result:
+                        submit_hash(job, *result.pop('lossless_hash'))
+                    count_results(job, result)
+            except Exception as e:
+                job['failed'] = True
+                logger.error(f"Error converting file {file_path}: {e}")
+                logger.error(traceback.format_exc())
+            finally:
+                release_job(job, stage)
+
+# キャリブレーションで試すワーカー数とglymurのスレッド数の組み合わせ (物理コアを使い切る組と半分の組)
+def get_calibration_combinations():
+    combinations = []
+    threads = 1
+    while threads <= num_physical_cores:
+        workers = max(1, num_physical_cores // threads)
+        for combination in ((workers, threads), (max(1, workers // 2), threads)):
+            if combination not in combinations:
+                combinations.append(combination)
+        threads *= 2
+    return combinations
+
+# 本処理のプロセスとワーカープロセスのRSSの合計の最大値を測るスレッド
+def monitor_peak_rss(stop_event, result):
+    process = psutil.Process()
+    while not stop_event.is_set():
+        rss = 0
+        for proc in [process] + process.children(recursive=True):
+            try:
+                rss += proc.memory_info().rss
+            except psutil.Error:
+                pass
+        result['peak_rss'] = max(result['peak_rss'], rss)
+        stop_event.wait(0.05)
+
+# キャリブレーション: 入力のページの見本を組み合わせごとに変換し、速度とピークRSSを測って最良の組み合わせをsettings.iniに保存する
+def calibrate(input_folder, sample_count):
+    global num_threads, num_processes, glymur_threads, process_pool
+    calibration_folder = os.path.join(tmp_path, 'calibration')
+    # 全ての本のヘッダーを読み、ページを均等な間隔で選ぶ
+    all_jobs = []
+    for subdir in sorted(os.listdir(input_folder)):
+        input_subdir = os.path.join(input_folder, subdir)
+        if os.path.isdir(input_subdir):
+            all_jobs.extend(scan_book(input_subdir, os.path.join(calibration_folder, 'lossless'), os.path.join(calibration_folder, 'optimized'), use_manifest=False))
+    if not all_jobs:
+        error_print("No input images found for calibration.")
+        return None
+    step = max(1, len(all_jobs) // sample_count)
+    sample_jobs = all_jobs[::step][:sample_count]
+    mode = 'processes' if args.processes is not None else 'threads'
+    info_print(f"Calibrating with {variable_str(len(sample_jobs))} sample pages in {mode} mode on {variable_str(num_physical_cores)} physical cores")
+
+    results = []
+    for workers, threads in get_calibration_combinations():
+        # 出力は一時フォルダに書き、組み合わせごとに消す
+        shutil.rmtree(calibration_folder, ignore_errors=True)
+        output_subdirs = {}
+        for spec in output_specs:
+            output_subdirs[spec['name']] = os.path.join(calibration_folder, spec['name'])
+            os.makedirs(output_subdirs[spec['name']])
+        jobs = []
+        for job in sample_jobs:
+            job = dict(job, book='calibration', lossless_subdir=output_subdirs.get('lossless'), optimized_subdir=output_subdirs.get('optimized'), output_subdirs=output_subdirs)
+            jobs.append(job)
+        register_book('calibration', output_subdirs.get('lossless'), output_subdirs.get('optimized'), len(jobs))
+
+        # 組み合わせを設定 (プロセスプールは作り直す)
+        num_threads = num_processes = workers
+        glymur_threads = threads
+        glymur.set_option('lib.num_threads', threads)
+        if process_pool is not None:
+            process_pool.shutdown()
+            process_pool = None
+
+        rss = {'peak_rss': 0}
+        stop_event = threading.Event()
+        monitor = threading.Thread(target=monitor_peak_rss, args=(stop_event, rss), daemon=True)
+        monitor.start()
+        start_time = time.perf_counter()
+        run_jobs(jobs)
+        elapsed = time.perf_counter() - start_time
+        stop_event.set()
+        monitor.join()
+
+        result = {'workers': workers, 'glymur_threads': threads, 'pages_per_second': len(jobs) / elapsed, 'peak_rss': rss['peak_rss']}
+        results.append(result)
+        info_print(f"Calibration {variable_str(workers)} workers x {variable_str(threads)} glymur threads: {variable_str(format(result['pages_per_second'], '.2f'))} pages/s, peak RSS {variable_str(result['peak_rss'] // 2**20)} MB")
+
+    shutil.rmtree(calibration_folder, ignore_errors=True)
+    if process_pool is not None:
+        process_pool.shutdown()
+        process_pool = None
+
+    # メモリ予算に収まる中で最も速い組み合わせ。収まるものがなければ最もRSSが小さい組み合わせ
+    within_budget = [result for result in results if result['peak_rss'] <= memory_budget]
+    if within_budget:
+        best = max(within_budget, key=lambda result: result['pages_per_second'])
+    else:
+        warning_print("No combination stayed within the memory budget. Choosing the one with the lowest peak RSS.")
+        best = min(results, key=lambda result: result['peak_rss'])
+    save_calibration(best, mode, len(sample_jobs))
+    return best
+
+# キャリブレーションの結果をsettings.iniに保存する関数 (既存の設定は残す)
+def save_calibration(best, mode, sample_count):
+    settings = configparser.ConfigParser()
+    settings.read(settings_path, encoding='utf-8')
+    for section in ('glymur', 'image conversion', 'calibration'):
+        if not settings.has_section(section):
+            settings.add_section(section)
+    settings.set('glymur', 'glymur_threads', str(best['glymur_threads']))
+    settings.set('image conversion', 'num_processes' if mode == 'processes' else 'num_threads', str(best['workers']))
+    settings.set('calibration', 'date', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    settings.set('calibration', 'mode', mode)
+    settings.set('calibration', 'physical_cores', str(num_physical_cores))
+    settings.set('calibration', 'sample_pages', str(sample_count))
+    settings.set('calibration', 'pages_per_second', f"{best['pages_per_second']:.2f}")
+    settings.set('calibration', 'peak_rss_mb', str(best['peak_rss'] // 2**20))
+    with open(settings_path, 'w', encoding='utf-8') as settings_file:
+        settings.write(settings_file)
+    info_print(Fore.GREEN + "Best combination: " + Style.RESET_ALL + f"{variable_str(best['workers'])} workers x {variable_str(best['glymur_threads'])} glymur threads. Saved to {settings_path}")
+
+
 #def check_openjpeg_dll(openjpeg_dll_path):
 
 #def run (input_folder,lossless_folder,optimized_folder,tmp_path,skip_conversion_extensions,supported_extensions,openjpeg_dll_name,):
@@ -252,6 +1521,38 @@ if not os.path.exists(optimized_folder):
 if not os.path.exists(tmp_path):
     os.makedirs(tmp_path)
 
+# img2j2kが一時フォルダに作るファイル名 (uuid_temp.jp2, uuid_temp_出力名.jp2, uuid_trial.jp2, uuid_verify.jp2)
+tmp_file_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}_(temp|temp_\w+|trial|verify)\.jp2$')
+
+# OCR用の縮小グレー画像の出力フォルダ (--ocr-proxy)
+ocr_folder = './TEMP/ocr'
+
+# 出力の仕様リスト。1回デコードした画像から全ての出力を作る
+# name: 出力名, folder: 出力フォルダ, cratios: glymurの圧縮率, color: 色の削減 (None / 'L'), reduce: 縮小率 (整数)
+# auto_color: --detect-grayでグレー・白黒と判定したページを1チャンネルにする
+# rate_control: --target-psnr / --target-sizeでページごとに圧縮率を決める
+# losslessは元画像そのままの可逆出力で、ビットパーフェクト確認と画素ダイジェストの対象になる
+output_specs = []
+if not args.optimize:
+    output_specs.append({'name': 'lossless', 'folder': lossless_folder, 'cratios': [1], 'color': None, 'reduce': 1, 'auto_color': False, 'rate_control': False})
+if not args.lossless:
+    output_specs.append({'name': 'optimized', 'folder': optimized_folder, 'cratios': [80], 'color': None, 'reduce': 1, 'auto_color': True, 'rate_control': True})
+if args.ocr_proxy:
+    output_specs.append({'name': 'ocr', 'folder': ocr_folder, 'cratios': [args.ocr_cratio], 'color': 'L', 'reduce': args.ocr_reduce, 'auto_color': False, 'rate_control': False})
+# lossless以外の派生出力
+derived_specs = [spec for spec in output_specs if spec['name'] != 'lossless']
+# 出力ごとのエンコード設定 (マニフェストとの比較用)
+output_settings = {spec['name']: get_output_settings(spec) for spec in output_specs}
+
+# 本ごとのマニフェスト (元画像のサイズ・更新日時・ダイジェスト、出力のパスとエンコード設定) のフォルダ
+manifest_folder = './TEMP/manifest'
+manifest_version = 1
+# 変換中のマニフェストを書き込む最短の間隔 (秒)。中断しても書き込み済みのページは次回スキップされる
+manifest_save_interval = 5
+# {本: {'data': マニフェスト, 'dirty': 未保存の変更があるか, 'saved': 最後に保存した時刻}}
+manifests = {}
+manifest_lock = threading.Lock()
+
 # 変換をスキップする拡張子リスト
 skip_conversion_extensions = (
     '.j2c', '.j2k', '.jpc', '.jp2', '.jpf', '.jpg', '.jpeg', 
@@ -264,40 +1565,9 @@ supported_extensions = (
     '.jpm', '.jpg2', '.jpx', '.mj2', '.png', '.psd', '.tif', '.tiff', '.webp'
 )
 
-#本処理開始前の確認事項
-# DLLの名前を指定
-openjpeg_dll_name = 'openjp2.dll'
-
-# システムのPATHからDLLを探す
-for path in os.environ['PATH'].split(os.pathsep):
-    full_openjpeg_dll_path = os.path.join(path, openjpeg_dll_name)
-    if os.path.exists(full_openjpeg_dll_path):
-        check_dll(full_openjpeg_dll_path)
-# glymurの確認
-try:
-    import glymur
-    print("Glymur is installed correctly.")
-except ImportError:
-    print("Glymur is not installed.")
-if glymur.lib.openjp2.OPENJP2:
-    print("OpenJPEG is available. JP2K conversion is supported.")
-else:
-    print("OpenJPEG is not available. JP2K conversion is not supported.")
-
-# glymurの設定ファイルの場所を確認する
-glymur_config_path = os.path.join(os.path.expanduser('~'), 'glymur', 'glymurrc')
-if os.path.isfile(glymur_config_path):
-    # 設定ファイルが存在する場合、その場所を表示
-    info_print("glymur setting file in " + glymur_config_path)
-else:
-    # 設定ファイルが存在しない場合、エラーメッセージを表示
-    error_print("glymur setting file not found in "+glymur_config_path)
-
-
 # グローバル変数とロックを初期化
 lossless_count = 0
 optimized_count = 0
-img_per_subdir_count = 0
 subdir_count = 0
 subdir_total = 0
 lossless_OK = 0
@@ -306,32 +1576,130 @@ lossless_CHK = 0
 count_lock = threading.Lock()
 lossless_total = 0
 optimized_total = 0
+# 派生出力ごとの完了数
+output_counts = {}
 img_total = 0
+# マニフェストで最新と分かりスキップした画像の数
+img_skipped = 0
 
+# 本(サブディレクトリ)ごとの進捗
+books = {}
 
-# Glymurのスレッド数を2に設定 (JPEG2000は2 core以上はあまり効果がない)
-glymur.set_option('lib.num_threads', 2)
 
-# 物理コア数を取得
-num_physical_cores = psutil.cpu_count(logical=False)
+# 設定ファイルのパス (main.pyと同じくdefault.iniの後にsettings.iniで上書きする)
+default_path = './default.ini'
+settings_path = './settings.ini'
 
-# Pythonのスレッド数（またはプロセス数）を物理コア数の半分に設定
-num_threads = num_physical_cores // 2
+# 設定ファイルを読み込む
+def load_config(default_path, settings_path):
+    config = configparser.ConfigParser(inline_comment_prefixes=('#',))
+    config.read(default_path, encoding='utf-8')  # デフォルトの設定を読み込む
+    config.read(settings_path, encoding='utf-8')  # ユーザーの設定を読み込む（存在する場合）
+    return config
 
+# 設定ファイルの整数を読む関数。空欄や不正な値ならNone
+def config_int(config, section, key):
+    try:
+        return int(config.get(section, key, fallback=''))
+    except ValueError:
+        return None
+
+config = load_config(default_path, settings_path)
 
-#本処理開始
-subdir_total = len([name for name in os.listdir(input_folder) if os.path.isdir(os.path.join(input_folder, name))])
+# Glymurのスレッド数を設定 (JPEG2000は2 core以上はあまり効果がない)。--glymur-threads、設定ファイル、2の順
+glymur_threads = args.glymur_threads or config_int(config, 'glymur', 'glymur_threads') or 2
+glymur.set_option('lib.num_threads', glymur_threads)
 
-convert_all_images(input_folder, lossless_folder, optimized_folder)
+# 物理コア数を取得
+num_physical_cores = psutil.cpu_count(logical=False) or os.cpu_count()
 
-current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-info_print(f"Conversion complete! {current_time}")
-info_print(f"Total subdirectories processed: {subdir_count} / {subdir_total}")
-info_print(f"Total images processed: {optimized_count} / {img_total}")
+# Pythonのスレッド数は設定ファイル (--calibrateの結果)、なければ物理コア数の半分に設定
+num_threads = config_int(config, 'image conversion', 'num_threads') or max(1, num_physical_cores // 2)
 
-if args.quick or args.optimize:
-    info_print("Note: Lossless check was skipped due to --quick or --optimize option.")
+# プロセス数は指定値、設定ファイル (--calibrateの結果)、なければ物理コア数をglymurのスレッド数で割った数
+if args.processes:
+    num_processes = args.processes
 else:
-    info_print(Fore.YELLOW + "Bitperfect " +Fore.WHITE+"lossless convertion check"+ Fore.GREEN + " OK " + variable_str(lossless_OK) + Fore.WHITE +"/" +  Fore.RED + "NO " + Fore.CYAN + variable_str(lossless_NO) + Fore.WHITE + "/" + Fore.MAGENTA + "Total " + Fore.CYAN + variable_str(lossless_CHK) + Style.RESET_ALL)
+    num_processes = config_int(config, 'image conversion', 'num_processes') or max(1, num_physical_cores // max(1, glymur_threads))
+process_pool = None
+
+# --check hashの検証スレッド数
+num_verify_workers = args.verify_workers or max(1, num_physical_cores // 4)
+
+# 同時に変換する画像のメモリ予算 (MB指定、なければ空きメモリの割合)
+if args.memory_budget:
+    memory_budget = args.memory_budget * 2**20
+else:
+    memory_budget = int(psutil.virtual_memory().available * args.memory_fraction)
+memory_in_use = 0
+memory_condition = threading.Condition()
+
+
+
+# ワーカープロセスからimportされた場合は実行しない
+if __name__ == '__main__':
+    #本処理開始前の確認事項
+    # DLLの名前を指定
+    openjpeg_dll_name = 'openjp2.dll'
+
+    # システムのPATHからDLLを探す
+    for path in os.environ['PATH'].split(os.pathsep):
+        full_openjpeg_dll_path = os.path.join(path, openjpeg_dll_name)
+        if os.path.exists(full_openjpeg_dll_path):
+            check_dll(full_openjpeg_dll_path)
+    # glymurの確認
+    try:
+        import glymur
+        print("Glymur is installed correctly.")
+    except ImportError:
+        print("Glymur is not installed.")
+    if glymur.lib.openjp2.OPENJP2:
+        print("OpenJPEG is available. JP2K conversion is supported.")
+    else:
+        print("OpenJPEG is not available. JP2K conversion is not supported.")
+
+    # glymurの設定ファイルの場所を確認する
+    glymur_config_path = os.path.join(os.path.expanduser('~'), 'glymur', 'glymurrc')
+    if os.path.isfile(glymur_config_path):
+        # 設定ファイルが存在する場合、その場所を表示
+        info_print("glymur setting file in " + glymur_config_path)
+    else:
+        # 設定ファイルが存在しない場合、エラーメッセージを表示
+        error_print("glymur setting file not found in "+glymur_config_path)
+
+    #本処理開始
+    info_print(f"Memory budget for image conversion: {variable_str(memory_budget // 2**20)} MB")
+    subdir_total = len([name for name in os.listdir(input_folder) if os.path.isdir(os.path.join(input_folder, name))])
+
+    # キャリブレーションのみ行って終了
+    if args.calibrate is not None:
+        calibrate(input_folder, args.calibrate)
+        sys.exit(0)
+
+    # 前回中断された変換の一時ファイルを削除
+    cleanup_tmp_files(tmp_path)
+
+    try:
+        convert_all_images(input_folder, lossless_folder, optimized_folder)
+    finally:
+        # 中断された場合も変換済みのページを記録する
+        save_all_manifests()
+    if process_pool is not None:
+        process_pool.shutdown()
+
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    info_print(f"Conversion complete! {current_time}")
+    info_print(f"Total subdirectories processed: {subdir_count} / {subdir_total}")
+    info_print(f"Total images processed: {optimized_count} / {img_total}")
+    if img_skipped:
+        info_print(f"Up-to-date images skipped: {img_skipped}")
+    for name, count in output_counts.items():
+        if name != 'optimized':
+            info_print(f"Total {name} images: {count} / {img_total}")
+
+    if args.quick or args.optimize:
+        info_print("Note: Lossless check was skipped due to --quick or --optimize option.")
+    else:
+        info_print(Fore.YELLOW + "Bitperfect " +Fore.WHITE+"lossless convertion check"+ Fore.GREEN + " OK " + variable_str(lossless_OK) + Fore.WHITE +"/" +  Fore.RED + "NO " + Fore.CYAN + variable_str(lossless_NO) + Fore.WHITE + "/" + Fore.MAGENTA + "Total " + Fore.CYAN + variable_str(lossless_CHK) + Style.RESET_ALL)
 
 
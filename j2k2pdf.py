@@ -1,17 +1,22 @@
 import os
+import sys
 import argparse
 from pathlib import Path
 import logging
 import glob
-from datetime import datetime
 import img2pdf
-from PIL import Image
-from PyPDF2 import PdfReader
-import json
 import re
+import psutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from colorama import Fore, Style
 import powerlog
-from powerlog import logger,verbose_print, info_print, error_print, variable_str, debug_print
+import jp2digest
+import pageindex
+import pdfstream
+import pdfinspect
+import partplan
+import imagelog
+from powerlog import logger,verbose_print, info_print, error_print, warning_print, variable_str, debug_print
 
 
 #####!!!!!!!!!!!!!!!!can't get estimated dpi in some cases? fix needed
@@ -26,12 +31,34 @@ parser.add_argument('--log-level', '-log', default='INFO', choices=['DEBUG', 'VE
 parser.add_argument('-debug', action='store_const', const='DEBUG', dest='log_level',
                     help='Set the logging level to DEBUG')
 parser.add_argument('--dpi', type=int, help='DPI for the output image. Default estimates dpi and rounds read DPI to typical integer DPI values or 600 if read DPI N/A. Positive integer will use set value if read DPI is N/A. Negative integer will force set value. --dpi 0 will use read DPI without rounding.')
+parser.add_argument('--verify-digest', action='store_true',
+                    help='Verify every lossless JP2 in TEMP/lossless against the pixel digest recorded by img2j2k before creating PDFs. The original images are not needed.')
+parser.add_argument('--processes', '-P', nargs='?', const=0, type=int, default=None,
+                    help='Create the PDFs of several books at once in worker processes. Lossless and optimized PDFs are separate jobs. Optional value sets the number of processes. Default: min(cpu count, 4)')
+parser.add_argument('--stream-threshold', type=int, default=1024,
+                    help='Books whose images add up to more than this many MB are written page by page to the PDF file instead of being built in memory by img2pdf. 0 streams every book. Default: 1024')
+parser.add_argument('--memory-fraction', type=float, default=0.7,
+                    help='Fraction of available memory that books built at once with --processes may use. Default: 0.7')
+parser.add_argument('--ocr-parts', nargs='?', const=partplan.default_max_pages, type=int, default=None,
+                    help=f'Also write OCR part PDFs of each optimized book to TEMP/divPDF for pdf3json, with at most this many pages per part. Default when given without a value: {partplan.default_max_pages}')
+parser.add_argument('--ocr-part-mb', type=float, default=None,
+                    help=f'Also write OCR part PDFs, each at most this many MB (a page larger than this is a part by itself). Can be combined with --ocr-parts. Default: {partplan.default_max_mb}')
 args = parser.parse_args()
 
 powerlog.set_log_level(args)
 
 default_dpi = 600  # デフォルトのDPI
 
+# -Pで同時にPDFを作る本の数。img2pdfはコードストリームをほぼコピーするだけでディスクが律速になるので、コア数が多くても4までにする
+max_io_processes = 4
+num_processes = args.processes or min(os.cpu_count() or 1, max_io_processes)
+# 同時に作る本のメモリ予算 (img2pdfはPDF全体をメモリ上に作る)
+memory_budget = int(psutil.virtual_memory().available * args.memory_fraction)
+
+# OCR用の分割PDFのフォルダ (pdf3jsonが分割PDFを置くフォルダと同じ) と分割のページ数の上限 (pdf3jsonと同じ)
+ocr_part_folder = Path('./TEMP/divPDF')
+ocr_part_max_pages = partplan.default_max_pages
+
 # 簡易チェックの結果を保存するカウンター
 logger.debug('Setting up counters for simple check results.')  # ログメッセージの追加
 successful_lossless_pdfs = 0
@@ -50,13 +77,21 @@ optpdf_folder = Path('./OptimizedPDF')
 
 # 画像情報フォルダのパス
 logger.debug('Setting up image info folder path.')  # ログメッセージの追加
-imagelog_folder = Path('./TEMP/imagelogs')
+imagelog_folder = Path(imagelog.imagelog_folder)
+
+# 画像情報のファイル名はスクリプトのあるディレクトリからの相対パスで記録する
+base_path = os.path.dirname(os.path.abspath(__file__))
+
+# 処理中の本の画像情報 (build_book_pdfが本ごとに作り直して結果と一緒に返す)
+imagelog_records = []
 
 # 出力フォルダと画像情報フォルダが存在しない場合は作成
 logger.debug('Creating output and image info folders if they do not exist.')  # ログメッセージの追加
 origpdf_folder.mkdir(parents=True, exist_ok=True)
 optpdf_folder.mkdir(parents=True, exist_ok=True)
 imagelog_folder.mkdir(parents=True, exist_ok=True)
+if args.ocr_parts or args.ocr_part_mb:
+    ocr_part_folder.mkdir(parents=True, exist_ok=True)
 
 # 対応する画像ファイルの拡張子
 logger.debug('Setting up image file extensions.')  # ログメッセージの追加
@@ -93,21 +128,11 @@ def is_lossless(img):
         logger.warning('Unknown image format: %s', encoding_format)  # ログメッセージの追加
         return 'Unknown'
 
-# 画像情報を取得する関数
+# 画像情報を取得する関数。画像情報はimagelog_recordsに追加し、本が終わったらメインのプロセスがまとめて書き込む
 def imagelog_image_info(img,total_p):
-    logger.debug('Getting image information.')  # ログメッセージの追加
-    # 画像情報ファイルのパス
-    imagelog_file_path = './imagelog_folder/imagelog_file.imglog'
-    logger.debug('Image log file path: %s', imagelog_file_path)  # ログメッセージの追加
-
     filename = img.filename
-    logger.debug('Image filename: %s', filename)  # ログメッセージの追加
-
     resolution = img.size
-    logger.debug('Image resolution: %s', resolution)  # ログメッセージの追加
-
     encoding_format = img.format
-    logger.debug('Image encoding format: %s', encoding_format)  # ログメッセージの追加
 
     # filenameからページ番号を抽出
     match_p = re.search(r'_p(\d+)', filename)
@@ -124,13 +149,12 @@ def imagelog_image_info(img,total_p):
     else:
         filename_page = None
 
-    logger.debug('Filename page: %s', filename_page)  # ログメッセージの追加
-    
-    # DPIを取得
+    # DPIを取得 (JPEGなどは(横, 縦)のタプルなので横のDPIを使う)
     dpi = img.info.get('dpi', None)
+    if isinstance(dpi, tuple):
+        dpi = round(dpi[0])
 
     # Estimated DPIを計算
-    logger.debug('Calculating estimated DPI.')  # ログメッセージの追加
     if args.dpi != None and args.dpi<0:
         estimated_dpi = -args.dpi
     else:            
@@ -147,31 +171,38 @@ def imagelog_image_info(img,total_p):
         debug_print("DPI is"+variable_str(dpi)+"Estimated DPI is"+variable_str(estimated_dpi))
 
     # ロスレスかどうかを判断
-    logger.debug('Determining if the image is lossless.')  # ログメッセージの追加
     try:
         is_lossless_result = is_lossless(img)
     except Exception as e:
         logger.error("Error in is_lossless_result: {}".format(e))
         is_lossless_result = 'N/A'
 
-    # 画像情報ファイル名を生成
-    logger.debug('Generating image info filename.')  # ログメッセージの追加
-    now = datetime.now()
-    imagelog_filename = f'{now.strftime("%Y%m%d%H%M%S")}.imglog'
-
-    # スクリプトのあるディレクトリのパスを取得
-    logger.debug('Getting the path of the directory where the script is located.')  # ログメッセージの追加
-    base_path = os.path.dirname(os.path.abspath(__file__))
-
-    # filenameを相対パスに変換
-    logger.debug('Converting filename to relative path.')  # ログメッセージの追加
+    # img2j2kがXMLBoxに記録した圧縮率とレート制御の結果を取得
+    compression_ratio = "N/A"
+    rate_control = "N/A"
+    index_entry = getattr(img, 'index_entry', None)
+    if index_entry is not None:
+        # img2j2kのインデックスに記録された値を使う
+        logger.debug('Reading encoder settings from the index.')  # ログメッセージの追加
+        if index_entry['cratios'] is not None:
+            compression_ratio = index_entry['cratios'][0]
+        if index_entry['rate'] is not None:
+            rate_control = index_entry['rate']
+    elif encoding_format == 'JPEG2000':
+        logger.debug('Reading encoder settings from the XML box.')  # ログメッセージの追加
+        try:
+            jp2_info = jp2digest.read_jp2_file_info(filename)
+            if jp2_info['cratios'] is not None:
+                compression_ratio = jp2_info['cratios'][0]
+            if jp2_info['rate'] is not None:
+                rate_control = jp2_info['rate']
+        except Exception as e:
+            logger.error("Error reading encoder settings: {}".format(e))
+
+    # filenameをスクリプトのあるディレクトリからの相対パスに変換
     filename = os.path.relpath(filename, base_path)
 
-    imagelog_filepath = imagelog_folder / imagelog_filename
-    logger.debug('Image log file path: %s', imagelog_filepath)  # ログメッセージの追加
-
     # 画像情報を辞書に格納
-    logger.debug('Storing image info in a dictionary.')  # ログメッセージの追加
     image_info = {
         "Filename": filename,
         "Resolution": resolution,
@@ -182,53 +213,21 @@ def imagelog_image_info(img,total_p):
         "Image format": img.format,
         "Image size": img.size,
         "Image mode": img.mode,
+        "Compression ratio": compression_ratio,
+        "Rate control": rate_control,
         "PDF page number": filename_page,
         "PDF file name": subdirectory_name+'.pdf',
         "PDF directory name": pdf_directory_name,
         "PDF file path": './'+pdf_directory_name+'/'+subdirectory_name+'.pdf',
     }
 
-    # スクリプトのあるディレクトリのパスを取得
-    logger.debug('Getting the path of the directory where the script is located.')  # ログメッセージの追加
-    base_path = os.path.dirname(os.path.abspath(__file__))
-
-    # filenameを相対パスに変換
-    logger.debug('Converting filename to relative path.')  # ログメッセージの追加
-    filename = os.path.relpath(filename, base_path)
-
-    # 画像情報ファイルに書き込む
-    logger.debug('Writing image info to imagelog file.')  # ログメッセージの追加
-    try:
-        with open(imagelog_filepath, 'a', encoding='utf-8') as imagelog_file:
-            json.dump(image_info, imagelog_file, ensure_ascii=False)
-            imagelog_file.write('\n')  # Add a newline after each image info
-    except Exception as e:
-        logger.error("Error writing image info to imagelog file: {}".format(e))
+    imagelog_records.append(image_info)
 
     logger.debug('Returning estimated DPI: %s', estimated_dpi)  # ログメッセージの追加
     debug_print("Test before return Estimated DPI"+variable_str(estimated_dpi))
     return estimated_dpi
 
 
-def layout_fun(img_width_px, img_height_px, ndpi):
-    logger.debug('Entering function layout_fun with parameters img_width_px=%s, img_height_px=%s, ndpi=%s', img_width_px, img_height_px, ndpi)  # 関数の開始をログに記録
-
-    # 背景ページのサイズをポイントからピクセルに変換
-    page_width_pt, page_height_pt = closest_page_size_pt
-    logger.debug('Converted page size from points to pixels: page_width_pt=%s, page_height_pt=%s', page_width_pt, page_height_pt)  # 変換結果をログに記録
-
-    # 画像をそのままのサイズで表示
-    img_width_pt, img_height_pt = img_width_px * 72 / ndpi, img_height_px * 72 / ndpi
-    logger.debug('Displayed image at its original size: img_width_pt=%s, img_height_pt=%s', img_width_pt, img_height_pt)  # 表示結果をログに記録
-
-    # 画像を中央に配置
-    x = (page_width_pt - img_width_pt) / 2
-    y = (page_height_pt - img_height_pt) / 2
-    logger.debug('Centered image: x=%s, y=%s', x, y)  # 配置結果をログに記録
-
-    logger.debug('Exiting function layout_fun.')  # 関数の終了をログに記録
-    return (page_width_pt, page_height_pt, x, y, x + img_width_pt, y + img_height_pt)
-
 # lossless_folderとoptimized_folder内のサブディレクトリの総数を取得
 logger.debug('Getting subdirectories in lossless_folder.')  # ログメッセージの追加
 total_subdirs = [subdir for subdir in lossless_folder.iterdir() if subdir.is_dir()]
@@ -243,8 +242,9 @@ total_optimized_subdirs_count = len(total_optimized_subdirs)
 def get_images(subdir, image_extensions):
     images = []
     for extension in image_extensions:
-        images.extend(sorted(subdir.glob('*{}'.format(extension))))
-    return images
+        images.extend(subdir.glob('*{}'.format(extension)))
+    # 拡張子が混在する本 (パススルーのJPEGなど) でもページ順になるようにファイル名で並べる
+    return sorted(images)
 
 #サブディレクトリのメインページ画像数を取得する関数を定義
 def get_total_p(subdir, image_extensions,total_p=0):
@@ -281,8 +281,13 @@ def get_dpi_info(img, total_p):
     height_pt = height_px / estimated_dpi * 72  # 高さをポイントで計算
     return dpi, estimated_dpi, width_pt, height_pt, width_px, height_px
 
-# lossless_folderとoptimized_folder内の各サブディレクトリをループ処理
-for index, subdir in enumerate(total_subdirs + total_optimized_subdirs, start=1):
+# 1冊 (サブディレクトリ) の画像を1つのPDFにまとめる関数。ロスレスと最適化は別のジョブ
+# カウンターはプロセスをまたいで集計できないので簡易チェックの結果を返す
+# {'kind': 'lossless' / 'optimized', 'checked': 簡易チェックをしたか, 'passed': ページ数が一致したか, 'imagelog': 画像情報のリスト}
+def build_book_pdf(subdir, index):
+    global subdirectory_name, pdf_directory_name, imagelog_records
+    imagelog_records = []
+    result = {'kind': 'lossless' if subdir in total_subdirs else 'optimized', 'checked': False, 'passed': False, 'imagelog': imagelog_records}
     if subdir.is_dir():
         logger.debug('Processing subdir %s of %s: %s', index, total_subdirs_count + total_optimized_subdirs_count, subdir.name)  # ログメッセージの追加
         total_p = 0  # total_pを初期化
@@ -299,6 +304,10 @@ for index, subdir in enumerate(total_subdirs + total_optimized_subdirs, start=1)
         # PDFファイル名を取得
         pdf_filename = get_pdf_filename(subdir, total_subdirs, origpdf_folder, optpdf_folder)
 
+        # img2j2kのインデックス (あれば画像をPillowで開き直さずヘッダー情報を使う)
+        book_index = pageindex.load_book_index(subdir.name)
+        index_entries = book_index['pages'].get(result['kind'], {})
+
         # 画像ファイルがある場合のみPDFに結合
         if images:
             image_files = []
@@ -308,7 +317,7 @@ for index, subdir in enumerate(total_subdirs + total_optimized_subdirs, start=1)
             for image_index, image_path in enumerate(images, start=1):
                 logger.debug('Converting image %s of %s in subdir %s', image_index, total_images_count, subdir.name)  # ログメッセージの追加
 
-                with Image.open(image_path) as img:
+                with pageindex.open_image(image_path, index_entries) as img:
 
                     # 画像ファイルのパス
                     img_path = Path(img.filename)
@@ -380,50 +389,200 @@ for index, subdir in enumerate(total_subdirs + total_optimized_subdirs, start=1)
                 logger.debug('Appended image path to image_files: %s', str(image_path))  # ログメッセージの追加
                 image_files.append(str(image_path))
 
-            # img2pdfのconvert関数にページサイズを渡す
-            with open(pdf_filename, "wb") as f:
-                logger.debug('Converting images to PDF: %s', [str(image_path) for image_path in image_files])  # ログメッセージの追加
-                f.write(img2pdf.convert([str(image_path) for image_path in image_files], layout_fun=layout_fun, dpi=estimated_dpi))
+            # 大きな本はページごとにファイルへ書く (img2pdfはPDF全体をメモリ上に作るため)
+            write_images_pdf(image_files, pdf_filename, layout_fun, estimated_dpi, should_stream(image_files))
+
+            # ページ数とページサイズをインデックスに記録 (json3pdfとpdf3jsonがPDFを開き直さないため)
+            try:
+                pageindex.append_pdf_record(subdir.name, result['kind'], pdf_filename, len(image_files), closest_page_size_pt)
+            except Exception as e:
+                logger.error("Error writing PDF record to index: {}".format(e))
+
+            # OCR用の分割PDFを画像から直接作成 (pdf3jsonがPDFを読み直して分割しないため)
+            if result['kind'] == 'optimized' and (args.ocr_parts or args.ocr_part_mb):
+                try:
+                    write_ocr_parts(subdir.name, image_files, pdf_filename, layout_fun, estimated_dpi)
+                except Exception as e:
+                    logger.error("Error writing OCR parts for {}: {}".format(pdf_filename, e))
+                    error_print("Error writing OCR parts for {}: {}".format(pdf_filename, e))
 
             # 簡易チェックの実行
+            # PdfReaderで全体を解析せず、xrefとページツリーだけを読んでページ数とページサイズを書いた内容と照合する
             if args.simple_check:
-                with open(pdf_filename, 'rb') as f:
-                    pdf = PdfReader(f)
-                    logger.debug('Read PDF file: %s', pdf_filename)  # ログメッセージの追加
-                    if subdir in total_subdirs:
-                        total_lossless_pdfs += 1
-                    else:
-                        total_optimized_pdfs += 1
-                    if len(pdf.pages) == total_images_count:
-                        logger.debug('Simple check passed for: %s', pdf_filename)  # ログメッセージの追加
-                        info_print("Simple check passed for {}".format(pdf_filename))
-                        if subdir in total_subdirs:
-                            successful_lossless_pdfs += 1
-                        else:
-                            successful_optimized_pdfs += 1
-                    else:
-                        logger.debug('Simple check failed for: %s', pdf_filename)  # ログメッセージの追加
-                        info_print("Simple check failed for {}".format(pdf_filename))
-                        if subdir in total_subdirs:
-                            failed_lossless_pdfs += 1
-                        else:
-                            failed_optimized_pdfs += 1
-
-
-# 全てのPDFが作成された後の結果の表示
-if args.simple_check == 1:
-    logging.info('Simple check results:')  # ログメッセージの追加
-    info_print("\nSimple check results:")
-    logging.info('Number of successfully created lossless PDFs: %s / %s', successful_lossless_pdfs, total_lossless_pdfs)  # ログメッセージの追加
-    info_print("Number of successfully created lossless PDFs: {} / {}".format(successful_lossless_pdfs, total_lossless_pdfs))
-    logging.info('Number of failed lossless PDFs: %s / %s', failed_lossless_pdfs, total_lossless_pdfs)  # ログメッセージの追加
-    info_print("Number of failed lossless PDFs: {} / {}".format(failed_lossless_pdfs, total_lossless_pdfs))
-    logging.info('Number of successfully created optimized PDFs: %s / %s', successful_optimized_pdfs, total_optimized_pdfs)  # ログメッセージの追加
-    info_print("Number of successfully created optimized PDFs: {} / {}".format(successful_optimized_pdfs, total_optimized_pdfs))
-    logging.info('Number of failed optimized PDFs: %s / %s', failed_optimized_pdfs, total_optimized_pdfs)  # ログメッセージの追加
-    info_print("Number of failed optimized PDFs: {} / {}".format(failed_optimized_pdfs, total_optimized_pdfs))
-    logging.info('Conversion completed.')  # ログメッセージの追加
-    info_print("\nConversion completed.")
-else:
-    logging.info('Conversion completed. Simple check was skipped.')  # ログメッセージの追加
-    info_print("\nConversion completed. Simple check was skipped.")
\ No newline at end of file
+                result['checked'] = True
+                try:
+                    pdf_info = pdfinspect.inspect_pdf(pdf_filename, read_mediaboxes=True)
+                    logger.debug('Inspected PDF file: %s %s', pdf_filename, pdf_info)  # ログメッセージの追加
+                    problems = check_pdf_structure(pdf_info, len(image_files), closest_page_size_pt)
+                except (pdfinspect.PdfInspectError, OSError) as e:
+                    problems = ["could not be inspected: {}".format(e)]
+                if not problems:
+                    logger.debug('Simple check passed for: %s', pdf_filename)  # ログメッセージの追加
+                    info_print("Simple check passed for {}".format(pdf_filename))
+                    result['passed'] = True
+                else:
+                    logger.debug('Simple check failed for: %s %s', pdf_filename, problems)  # ログメッセージの追加
+                    info_print("Simple check failed for {} ({})".format(pdf_filename, ', '.join(problems)))
+    return result
+
+# 書いたPDFの構造を確認する関数。ページ数と全ページの/MediaBoxを書いた内容と比べ、問題のリストを返す (空なら合格)
+# 14400ptを超えるページはimg2pdfと同じく/UserUnitで縮小されているので、同じ倍率で比べる
+def check_pdf_structure(pdf_info, page_count, page_size_pt):
+    problems = []
+    if pdf_info['pages'] != page_count:
+        problems.append("{} pages instead of {}".format(pdf_info['pages'], page_count))
+    expected_width, expected_height = page_size_pt
+    if expected_width > 14400.0 or expected_height > 14400.0:
+        userunit = img2pdf.find_scale(expected_width, expected_height)
+        expected_width, expected_height = expected_width / userunit, expected_height / userunit
+    for page_number, mediabox in enumerate(pdf_info['mediaboxes'], 1):
+        width, height = mediabox[2] - mediabox[0], mediabox[3] - mediabox[1]
+        if abs(width - expected_width) > 1 or abs(height - expected_height) > 1:
+            problems.append("page {} is {} x {} pt instead of {} x {} pt".format(page_number, width, height, expected_width, expected_height))
+            break
+    return problems
+
+# 画像のリストから1つのPDFを書く関数。streamならページごとにファイルへ書き、書けない画像があればimg2pdfで作る
+def write_images_pdf(image_files, pdf_filename, layout_fun, estimated_dpi, stream):
+    if stream:
+        logger.debug('Streaming images to PDF: %s', image_files)  # ログメッセージの追加
+        try:
+            pdfstream.write_pdf(image_files, pdf_filename, layout_fun)
+            return
+        except pdfstream.UnsupportedImageError as e:
+            warning_print("Cannot stream {}: {}. Building it with img2pdf.".format(pdf_filename, e))
+
+    # img2pdfのconvert関数にページサイズを渡す
+    with open(pdf_filename, "wb") as f:
+        logger.debug('Converting images to PDF: %s', image_files)  # ログメッセージの追加
+        f.write(img2pdf.convert(image_files, layout_fun=layout_fun, dpi=estimated_dpi))
+
+# OCR用に本をページ順の分割に分ける関数。1つの分割はmax_pagesページ以下、max_bytes以下で、分割の大きさをそろえる (partplan)
+# PDFの大きさは画像のファイルサイズの合計とページごとのオブジェクト分で見積もる。1ページで上限を超える画像は1つの分割にする
+def plan_ocr_parts(image_files, max_pages, max_bytes):
+    page_sizes = [os.path.getsize(image_file) + partplan.page_overhead for image_file in image_files]
+    return [image_files[start:end] for start, end in partplan.plan_parts(page_sizes, max_pages, max_bytes)]
+
+# 本のOCR用の分割PDFをocr_part_folderに書いてインデックスに記録する関数
+# 分割が1つだけならpdf3jsonは本のPDFをそのまま送るので書かない。前回の分割PDFは先に消す
+def write_ocr_parts(book, image_files, pdf_filename, layout_fun, estimated_dpi):
+    part_pattern = re.compile(re.escape(book) + r'_part\d+\.pdf')
+    for old_part in ocr_part_folder.iterdir():
+        if part_pattern.fullmatch(old_part.name):
+            old_part.unlink()
+    parts = plan_ocr_parts(image_files, args.ocr_parts or ocr_part_max_pages, int((args.ocr_part_mb or partplan.default_max_mb) * 2**20))
+    if len(parts) < 2:
+        verbose_print("{} fits in one OCR request. No parts written.".format(pdf_filename))
+        return
+    part_records = []
+    first_page = 1
+    for part_number, part_files in enumerate(parts, start=1):
+        part_filename = ocr_part_folder / "{}_part{}.pdf".format(book, part_number)
+        # 分割は小さいのでメモリに関係なく書ける形式ならストリーミングで書く (内容はimg2pdfと同じ)
+        write_images_pdf(part_files, part_filename, layout_fun, estimated_dpi, pdfstream.can_stream(part_files))
+        part_records.append((part_filename, first_page, len(part_files)))
+        first_page += len(part_files)
+    pageindex.append_parts_record(book, 'optimized', pdf_filename, part_records)
+    info_print("Wrote " + variable_str(len(parts)) + " OCR parts for " + variable_str(pdf_filename))
+
+# 本をストリーミングで書くか判定する関数 (画像の合計が--stream-thresholdを超え、全てJPEGかJPEG2000)
+def should_stream(image_files):
+    if not pdfstream.can_stream(image_files):
+        return False
+    return sum(os.path.getsize(image_file) for image_file in image_files) > args.stream_threshold * 2**20
+
+# 本のPDFを作るのに必要なメモリの見積もり。ストリーミングなら最大のページ1枚分、img2pdfなら画像とPDFで本の約2倍
+def get_book_memory(subdir):
+    images = get_images(subdir, image_extensions)
+    sizes = [image_path.stat().st_size for image_path in images]
+    if pdfstream.can_stream(images) and sum(sizes) > args.stream_threshold * 2**20:
+        return max(sizes, default=0)
+    return sum(sizes) * 2
+
+# 本ごとのPDFをプロセスプールで並列に作成する関数。結果は本の順に返す
+# img2pdfはコードストリームをほぼコピーするだけなのでCPUよりディスクが律速になる。同時に作る本の数はnum_processesに抑え、
+# 同時に作る本のメモリの見積もりの合計がメモリ予算に収まるまで次の本を待たせる
+def build_books_parallel(book_jobs, imagelog_writer):
+    book_memory = {index: get_book_memory(subdir) for index, subdir in book_jobs}
+    # 大きい本から開始する
+    waiting = sorted(book_jobs, key=lambda job: book_memory[job[0]], reverse=True)
+    results = {}
+    pending = {}
+    memory_in_use = 0
+    with ProcessPoolExecutor(max_workers=num_processes) as pool:
+        while waiting or pending:
+            while waiting and len(pending) < num_processes:
+                index, subdir = waiting[0]
+                if pending and memory_in_use + book_memory[index] > memory_budget:
+                    break
+                waiting.pop(0)
+                pending[pool.submit(build_book_pdf, subdir, index)] = index
+                memory_in_use += book_memory[index]
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                memory_in_use -= book_memory[index]
+                try:
+                    results[index] = future.result()
+                    imagelog_writer.write_many(results[index]['imagelog'])
+                except Exception as e:
+                    logger.error("Error creating PDF for {}: {}".format(dict(book_jobs)[index], e))
+    return [results[index] for index, _ in book_jobs if index in results]
+
+# ワーカープロセスからimportされた場合は実行しない
+if __name__ == '__main__':
+    # ロスレスJP2が記録された画素ダイジェストどおりにデコードされるか確認
+    if args.verify_digest:
+        logger.debug('Verifying lossless JP2 files against recorded pixel digests.')  # ログメッセージの追加
+        info_print("Verifying lossless JP2 files against recorded pixel digests...")
+        jp2digest.print_verify_results(jp2digest.verify_folder(lossless_folder))
+
+    # lossless_folderとoptimized_folder内の各サブディレクトリをループ処理
+
+    # 本ごとにPDFを作成 (-Pならプロセスプールで並列に)
+    book_jobs = [(index, subdir) for index, subdir in enumerate(total_subdirs + total_optimized_subdirs, start=1) if subdir.is_dir()]
+    # 画像情報は実行ごとに1つのファイルへバックグラウンドでまとめて書き込む
+    with imagelog.ImageLogWriter(imagelog_folder) as imagelog_writer:
+        if args.processes is None:
+            book_results = []
+            for index, subdir in book_jobs:
+                book_results.append(build_book_pdf(subdir, index))
+                imagelog_writer.write_many(book_results[-1]['imagelog'])
+        else:
+            info_print("Creating PDFs with " + variable_str(num_processes) + " processes")
+            book_results = build_books_parallel(book_jobs, imagelog_writer)
+
+    # 簡易チェックの結果を本の順に集計
+    for book_result in book_results:
+        if not book_result['checked']:
+            continue
+        if book_result['kind'] == 'lossless':
+            total_lossless_pdfs += 1
+            if book_result['passed']:
+                successful_lossless_pdfs += 1
+            else:
+                failed_lossless_pdfs += 1
+        else:
+            total_optimized_pdfs += 1
+            if book_result['passed']:
+                successful_optimized_pdfs += 1
+            else:
+                failed_optimized_pdfs += 1
+
+    # 全てのPDFが作成された後の結果の表示
+    if args.simple_check == 1:
+        logging.info('Simple check results:')  # ログメッセージの追加
+        info_print("\nSimple check results:")
+        logging.info('Number of successfully created lossless PDFs: %s / %s', successful_lossless_pdfs, total_lossless_pdfs)  # ログメッセージの追加
+        info_print("Number of successfully created lossless PDFs: {} / {}".format(successful_lossless_pdfs, total_lossless_pdfs))
+        logging.info('Number of failed lossless PDFs: %s / %s', failed_lossless_pdfs, total_lossless_pdfs)  # ログメッセージの追加
+        info_print("Number of failed lossless PDFs: {} / {}".format(failed_lossless_pdfs, total_lossless_pdfs))
+        logging.info('Number of successfully created optimized PDFs: %s / %s', successful_optimized_pdfs, total_optimized_pdfs)  # ログメッセージの追加
+        info_print("Number of successfully created optimized PDFs: {} / {}".format(successful_optimized_pdfs, total_optimized_pdfs))
+        logging.info('Number of failed optimized PDFs: %s / %s', failed_optimized_pdfs, total_optimized_pdfs)  # ログメッセージの追加
+        info_print("Number of failed optimized PDFs: {} / {}".format(failed_optimized_pdfs, total_optimized_pdfs))
+        logging.info('Conversion completed.')  # ログメッセージの追加
+        info_print("\nConversion completed.")
+    else:
+        logging.info('Conversion completed. Simple check was skipped.')  # ログメッセージの追加
+        info_print("\nConversion completed. Simple check was skipped.")
\ No newline at end of file
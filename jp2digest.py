@@ -0,0 +1,176 @@
+import os
+import sys
+import shutil
+import tempfile
+import uuid
+import argparse
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import glymur
+from colorama import Fore, Style
+import powerlog
+from powerlog import verbose_print, error_print, warning_print, variable_str
+
+# 画素ダイジェストの計算に使うストリップの高さ (行数)。ダイジェストの値はストリップの高さに依存しない
+default_strip_height = 1024
+
+# ダイジェストのアルゴリズム名 (XMLなどに記録する用)
+digest_algorithm = 'blake2b-256'
+
+# 元画像とJP2で同じバイト列になるようにdtypeを揃える関数 (bool→uint8, ビッグエンディアン→リトルエンディアン)
+def canonical_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        return np.dtype(np.uint8)
+    if dtype.byteorder == '>':
+        return dtype.newbyteorder('<')
+    return dtype
+
+# 画像の形とdtypeを先頭に入れたダイジェストを作成する関数
+def new_pixel_digest(shape, dtype):
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(f"{tuple(shape)}:{canonical_dtype(dtype).str}".encode())
+    return digest
+
+# 行ストリップをダイジェストに追加する関数。ストリップは上から順に渡すこと
+def update_pixel_digest(digest, strip):
+    strip = np.ascontiguousarray(strip, dtype=canonical_dtype(strip.dtype))
+    digest.update(memoryview(strip).cast('B'))
+
+# デコード済みの配列のダイジェストをストリップ単位で計算する関数
+def array_digest(img_array, strip_height=default_strip_height):
+    digest = new_pixel_digest(img_array.shape, img_array.dtype)
+    for y0 in range(0, img_array.shape[0], strip_height):
+        update_pixel_digest(digest, img_array[y0:y0 + strip_height])
+    return digest.hexdigest()
+
+# JP2をストリップ単位で部分デコードしてダイジェストを計算する関数。画像全体はメモリに展開しない
+def jp2_digest(jp2_path, strip_height=default_strip_height):
+    jp2 = glymur.Jp2k(jp2_path)
+    digest = None
+    for y0 in range(0, jp2.shape[0], strip_height):
+        strip = jp2[y0:min(y0 + strip_height, jp2.shape[0]), :]
+        if digest is None:
+            digest = new_pixel_digest(jp2.shape, strip.dtype)
+        update_pixel_digest(digest, strip)
+    return digest.hexdigest()
+
+# glymurに日本語のパスを渡さないため、ASCII以外のパスは一時フォルダにリンク (できなければコピー) して渡す
+@contextmanager
+def ascii_path(jp2_path):
+    jp2_path = str(jp2_path)
+    if jp2_path.isascii():
+        yield jp2_path
+        return
+    tmp_filename = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()) + '_verify.jp2')
+    try:
+        os.link(jp2_path, tmp_filename)
+    except OSError:
+        shutil.copyfile(jp2_path, tmp_filename)
+    try:
+        yield tmp_filename
+    finally:
+        os.remove(tmp_filename)
+
+# JP2のXMLBoxに記録された情報を辞書で返す関数。記録がない項目はNone
+def read_jp2_info(jp2):
+    info = {'dpi': None, 'width': None, 'height': None, 'mode': None, 'content': None, 'digest': None, 'algorithm': None,
+            'lossless': None, 'output': None, 'cratios': None, 'rate': None}
+    for box in jp2.box:
+        if not isinstance(box, glymur.jp2box.XMLBox):
+            continue
+        root = box.xml.getroot()
+        info['dpi'] = root.findtext('.//dpi', info['dpi'])
+        source = root.find('.//source')
+        if source is not None:
+            info['width'] = int(source.findtext('width'))
+            info['height'] = int(source.findtext('height'))
+            info['mode'] = source.findtext('mode')
+            info['content'] = source.findtext('content')
+            digest = source.find('digest')
+            if digest is not None:
+                info['digest'] = digest.text
+                info['algorithm'] = digest.get('algorithm')
+        encoder = root.find('.//encoder')
+        if encoder is not None:
+            info['lossless'] = encoder.findtext('lossless') == 'true'
+            info['output'] = encoder.findtext('output')
+            cratios = encoder.findtext('cratios')
+            if cratios:
+                info['cratios'] = [float(cratio) for cratio in cratios.split(',')]
+            rate = encoder.find('rate')
+            if rate is not None:
+                info['rate'] = dict(rate.attrib)
+    return info
+
+# ファイルのパスからXMLBoxの情報を読む関数
+def read_jp2_file_info(jp2_path):
+    with ascii_path(jp2_path) as path:
+        return read_jp2_info(glymur.Jp2k(path))
+
+# ロスレスJP2が記録されたダイジェストどおりにデコードされるか確認する関数。元画像は使わない
+# 戻り値: (True/False, 理由)。ダイジェストが記録されていない、またはロスレスでない場合はNone
+def verify_jp2(jp2_path, strip_height=default_strip_height):
+    with ascii_path(jp2_path) as path:
+        jp2 = glymur.Jp2k(path)
+        info = read_jp2_info(jp2)
+        if info['digest'] is None or not info['lossless']:
+            return None, "no pixel digest recorded"
+        if info['algorithm'] != digest_algorithm:
+            return None, f"unsupported digest algorithm {info['algorithm']}"
+        if (jp2.shape[1], jp2.shape[0]) != (info['width'], info['height']):
+            return False, f"size {jp2.shape[1]} x {jp2.shape[0]} does not match recorded {info['width']} x {info['height']}"
+        if jp2_digest(path, strip_height) != info['digest']:
+            return False, "pixel digest does not match"
+    return True, "pixel digest matches"
+
+# フォルダ内の全てのJP2を並列に確認する関数。{パス: (結果, 理由)} を返す
+def verify_folder(folder, workers=None, strip_height=default_strip_height):
+    jp2_files = sorted(Path(folder).rglob('*.jp2'))
+    workers = workers or max(1, (os.cpu_count() or 1) // 2)
+    results = {}
+    # glymurとhashlibはGILを解放するのでスレッドで並列になる
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for jp2_path, result in zip(jp2_files, pool.map(lambda path: verify_jp2_safe(path, strip_height), jp2_files)):
+            results[jp2_path] = result
+    return results
+
+# 読めないファイルも失敗として扱う
+def verify_jp2_safe(jp2_path, strip_height=default_strip_height):
+    try:
+        return verify_jp2(jp2_path, strip_height)
+    except Exception as e:
+        return False, f"could not be decoded: {e}"
+
+# 確認結果を表示して (OK, NO, 記録なし) の数を返す関数
+def print_verify_results(results):
+    counts = {True: 0, False: 0, None: 0}
+    for jp2_path, (ok, reason) in results.items():
+        counts[ok] += 1
+        if ok:
+            verbose_print(f"Pixel digest for {jp2_path} verified!")
+        elif ok is None:
+            warning_print(f"Pixel digest for {jp2_path} skipped: {reason}")
+        else:
+            error_print(f"Pixel digest for {jp2_path}: Failed! ({reason})")
+    print(Fore.YELLOW + "Pixel digest " + Fore.GREEN + " OK " + variable_str(counts[True]) + Fore.WHITE + "/" + Fore.RED + "NO " + variable_str(counts[False]) + Fore.WHITE + "/" + Fore.MAGENTA + "Skipped " + variable_str(counts[None]) + Style.RESET_ALL)
+    return counts[True], counts[False], counts[None]
+
+if __name__ == '__main__':
+    # コマンドライン引数を解析する
+    parser = argparse.ArgumentParser(description='Verify lossless JP2 files against the pixel digest recorded in their XML box. The original images are not needed.')
+    parser.add_argument('folder', nargs='?', default='./TEMP/lossless', help='Folder to verify (searched recursively). Default: ./TEMP/lossless')
+    parser.add_argument('--workers', '-w', type=int, help='Number of verification threads. Default: cpu count // 2')
+    parser.add_argument('--strip-height', type=int, default=default_strip_height, help=f'Rows decoded at once. Default: {default_strip_height}')
+    parser.add_argument('--log-level', '-log', default='INFO', choices=['DEBUG', 'VERBOSE', 'INFO', 'WARNING'],
+                        help='Set the logging level (default: INFO)')
+    parser.add_argument('-debug', action='store_const', const='DEBUG', dest='log_level',
+                        help='Set the logging level to DEBUG')
+    args = parser.parse_args()
+    powerlog.set_log_level(args)
+
+    ok_count, no_count, skipped_count = print_verify_results(verify_folder(args.folder, args.workers, args.strip_height))
+    sys.exit(1 if no_count else 0)
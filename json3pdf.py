@@ -14,8 +14,9 @@ from reportlab.platypus import Paragraph
 from reportlab.lib.colors import Color
 import json
 import powerlog
+import pageindex
+import pdfinspect
 from powerlog import logger,verbose_print, info_print, error_print, variable_str, debug_print,warning_print
-from PyPDF2 import PdfReader
 import math
 import re
 from shapely.geometry import Polygon
@@ -326,20 +327,20 @@ for json_file in json_files:
         if args.page is not None:
             page_size = page_sizes[args.page]
         else:
-            if ocr_pdf_path.exists():
-                with open(ocr_pdf_path, 'rb') as f:
-                    pdf = PdfReader(f)
-                    page = pdf.pages[0]
-                    width_pt = page.mediabox[2]
-                    height_pt = page.mediabox[3]
-                    # ページサイズを辞書から探す
-                    for size, (w, h) in page_sizes.items():
-                        if abs(width_pt - w) < 1 and abs(height_pt - h) < 1:
-                            page_size = size
-                            break
             # ページサイズが見つからない場合はA5に設定
-            else:
-                page_size = 'A5'
+            page_size = page_sizes['A5']
+            if ocr_pdf_path.exists():
+                # j2k2pdfがインデックスに記録したページサイズを使う。記録がなければPDFを開いて読む
+                pdf_record = pageindex.lookup_pdf(ocr_pdf_path)
+                if pdf_record is not None:
+                    width_pt, height_pt = pdf_record['page_size']
+                else:
+                    width_pt, height_pt = pdfinspect.get_mediabox(ocr_pdf_path)[2:4]
+                # ページサイズを辞書から探す
+                for size, (w, h) in page_sizes.items():
+                    if abs(width_pt - w) < 1 and abs(height_pt - h) < 1:
+                        page_size = (w, h)
+                        break
 
         #元画像のフォルダ
         image_folder = optimized_folder / json_file.replace('.pdf.json', '')
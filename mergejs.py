@@ -6,6 +6,7 @@ import glob
 from datetime import datetime
 from PyPDF2 import PdfReader, PdfWriter,PdfMerger
 import powerlog
+import pdfinspect
 from powerlog import logger,verbose_print, info_print, error_print, variable_str, debug_print
 
 # コマンドライン引数を解析する
@@ -138,6 +139,12 @@ for text_pdf_file in text_pdf_files:
     output_pdf_path = os.path.join(output_folder, output_pdf_file)
 
     if os.path.exists(text_pdf_path) and os.path.exists(existing_pdf_path):
+        # 合成の前にページ数だけを軽く読んで照合する (合わないPDFはPdfReaderで全体を読まずに飛ばす)
+        existing_page_count = pdfinspect.count_pages(existing_pdf_path)
+        text_page_count = pdfinspect.count_pages(text_pdf_path)
+        if existing_page_count != text_page_count:
+            error_print(f'{text_pdf_file} のページ数 {text_page_count} が {existing_pdf_file} のページ数 {existing_page_count} と一致しません。page counts do not match, skipping')
+            continue
         text_pdf = PdfReader(text_pdf_path)
         existing_pdf = PdfReader(existing_pdf_path)
         merger = PdfMerger()
@@ -178,6 +185,10 @@ for text_pdf_file in text_pdf_files:
         with open(output_pdf_path, 'wb') as f:
             merger.write(f)
 
+        # 合成したPDFのページ数を確認
+        output_page_count = pdfinspect.count_pages(output_pdf_path)
+        if output_page_count != existing_page_count:
+            error_print(f'{output_pdf_file} のページ数 {output_page_count} が {existing_pdf_file} のページ数 {existing_page_count} と一致しません。')
         print(f'{output_pdf_file} の合成が完了しました。')
     else:
         print(f'{text_pdf_file} または {existing_pdf_file} が見つかりません。')
@@ -0,0 +1,301 @@
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import argparse
+import collections
+import tempfile
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+from colorama import Fore, Style
+import powerlog
+from powerlog import info_print, verbose_print, debug_print, variable_str
+import pdfinspect
+
+# Document Intelligence (prebuilt-read) の代わりに使うローカルのHTTPサーバー。APIの使用量を使わずにpdf3jsonを試すため
+# 解析の開始 (POST ...:analyze → 202とOperation-Location) と結果の取得 (GET .../analyzeResults/{id}) だけを実装し、
+# 送られたPDFのページ数とページサイズに合わせた、構造の正しい合成のanalyzeResultを返す
+# 解析にかかる時間、429 (スロットリング)、解析の失敗を設定できる
+# 使い方: python mockdi.py --port 5050 を実行し、DI_API_ENDPOINT=http://127.0.0.1:5050/ でpdf3jsonを実行する
+
+api_version = '2024-11-30'
+
+analyze_pattern = re.compile(r'/documentintelligence/documentModels/([^/:]+):analyze$')
+result_pattern = re.compile(r'/documentintelligence/documentModels/([^/:]+)/analyzeResults/([^/]+)$')
+
+# 合成の結果の1ページの行数と1行の単語数
+lines_per_page = 20
+words_per_line = 5
+
+# 実行中と終了した解析 {id: 解析の辞書} とカウンター (スレッドから使うのでロックで守る)
+operations = {}
+operations_lock = threading.Lock()
+counters = {'analyze': 0, 'poll': 0, 'throttled': 0, 'failed': 0, 'succeeded': 0, 'pages': 0, 'bytes': 0}
+
+def now_string():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def count(name, value=1):
+    with operations_lock:
+        counters[name] += value
+
+# 直前の1秒間に受けた要求の時刻 (POSTとGETを別々に数える)
+recent_requests = {'analyze': collections.deque(), 'poll': collections.deque()}
+
+# 直前の1秒間の要求が上限を超えるか (上限が0なら制限しない)
+def over_rate(kind):
+    limit = args.tps if kind == 'analyze' else args.poll_tps
+    if limit <= 0:
+        return False
+    now = time.monotonic()
+    with operations_lock:
+        requests = recent_requests[kind]
+        while requests and now - requests[0] >= 1.0:
+            requests.popleft()
+        if len(requests) >= limit:
+            return True
+        requests.append(now)
+        return False
+
+# 送られたPDFのページサイズ (インチ) のリストを返す関数。読めないPDFは1ページのA5として扱う
+def read_page_sizes(pdf_data):
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+        pdf_file.write(pdf_data)
+    try:
+        mediaboxes = pdfinspect.inspect_pdf(pdf_file.name, read_mediaboxes=True)['mediaboxes']
+        return [((box[2] - box[0]) / 72, (box[3] - box[1]) / 72) for box in mediaboxes]
+    except (pdfinspect.PdfInspectError, ValueError, KeyError, IndexError, TypeError) as e:
+        debug_print(f"Could not read the uploaded PDF: {e}")
+        return [(420 / 72, 595 / 72)]
+    finally:
+        os.remove(pdf_file.name)
+
+# 長方形のポリゴン (左上から時計回りの4点)
+def rectangle(x, y, width, height):
+    return [round(value, 4) for value in (x, y, x + width, y, x + width, y + height, x, y + height)]
+
+# ページサイズのリストから合成のanalyzeResultを作る関数
+# ページ、行、単語、段落のspanはcontentの中の位置で、実際の結果と同じく行は改行でつなぐ
+def build_analyze_result(model_id, page_sizes):
+    content = []
+    offset = 0
+    pages = []
+    paragraphs = []
+    for page_number, (width, height) in enumerate(page_sizes, start=1):
+        page_offset = offset
+        words = []
+        lines = []
+        line_height = height / (lines_per_page + 2)
+        word_width = width / (words_per_line + 2)
+        for line_number in range(lines_per_page):
+            y = line_height * (line_number + 1)
+            line_offset = offset
+            line_words = []
+            for word_number in range(words_per_line):
+                text = f"p{page_number}l{line_number + 1}w{word_number + 1}"
+                words.append({
+                    'content': text,
+                    'polygon': rectangle(word_width * (word_number + 1), y, word_width * 0.9, line_height * 0.8),
+                    'confidence': 0.99,
+                    'span': {'offset': offset, 'length': len(text)},
+                })
+                line_words.append(text)
+                offset += len(text) + 1
+            line_text = ' '.join(line_words)
+            lines.append({
+                'content': line_text,
+                'polygon': rectangle(word_width, y, word_width * words_per_line, line_height * 0.8),
+                'spans': [{'offset': line_offset, 'length': len(line_text)}],
+            })
+            content.append(line_text)
+        page_length = offset - page_offset - 1
+        pages.append({
+            'pageNumber': page_number,
+            'angle': 0,
+            'width': round(width, 4),
+            'height': round(height, 4),
+            'unit': 'inch',
+            'words': words,
+            'lines': lines,
+            'spans': [{'offset': page_offset, 'length': page_length}],
+        })
+        paragraphs.append({
+            'spans': [{'offset': page_offset, 'length': page_length}],
+            'boundingRegions': [{'pageNumber': page_number, 'polygon': rectangle(word_width, line_height, word_width * words_per_line, line_height * lines_per_page)}],
+            'content': '\n'.join(line['content'] for line in lines),
+        })
+    return {
+        'apiVersion': api_version,
+        'modelId': model_id,
+        'stringIndexType': 'textElements',
+        'content': '\n'.join(content),
+        'pages': pages,
+        'paragraphs': paragraphs,
+        'styles': [],
+        'contentFormat': 'text',
+    }
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *arguments):
+        debug_print(f"{self.address_string()} {format % arguments}")
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('apim-request-id', str(uuid.uuid4()))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, code, message, headers=None):
+        self.send_json(status, {'error': {'code': code, 'message': message}}, headers)
+
+    # キーがない要求は実際のサービスと同じく401 (キーの値は確認しない)
+    def check_key(self):
+        if self.headers.get('Ocp-Apim-Subscription-Key'):
+            return True
+        self.send_error_json(401, '401', 'Access denied due to missing subscription key.')
+        return False
+
+    # 設定した割合で429を返す。直前の1秒間の要求が--tps (POST) または--poll-tps (GET) を超えても429を返す
+    def throttle(self, kind):
+        if random.random() < args.throttle_rate or over_rate(kind):
+            count('throttled')
+            self.send_error_json(429, '429', 'Requests to the Document Intelligence API have exceeded the rate limit (mock).',
+                                 {'Retry-After': str(args.retry_after)})
+            return True
+        return False
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        match = analyze_pattern.search(path)
+        body = self.read_body()
+        if not match:
+            self.send_error_json(404, 'NotFound', f'Resource not found: {path}')
+            return
+        if not self.check_key() or self.throttle('analyze'):
+            return
+        model_id = match.group(1)
+        content_type = self.headers.get('Content-Type', '')
+        try:
+            if content_type.startswith('application/json'):
+                request = json.loads(body)
+                pdf_data = base64.b64decode(request['base64Source'])
+            else:
+                pdf_data = body
+        except (ValueError, KeyError) as e:
+            self.send_error_json(400, 'InvalidRequest', f'Invalid request body: {e}')
+            return
+        # 実際のサービスと同じく、大きすぎるファイルは解析を始めずに400
+        if args.max_mb and len(pdf_data) > args.max_mb * 2**20:
+            self.send_json(400, {'error': {'code': 'InvalidRequest', 'message': 'Invalid request.',
+                                           'innererror': {'code': 'InvalidContentLength', 'message': 'The input image is too large (mock).'}}})
+            return
+        page_sizes = read_page_sizes(pdf_data)
+        operation_id = str(uuid.uuid4())
+        operation = {
+            'model_id': model_id,
+            'created': now_string(),
+            'ready_at': time.monotonic() + args.latency + args.page_latency * len(page_sizes),
+            'fail': random.random() < args.failure_rate,
+            'page_sizes': page_sizes,
+        }
+        with operations_lock:
+            operations[operation_id] = operation
+            counters['analyze'] += 1
+            counters['bytes'] += len(pdf_data)
+        verbose_print(f"Accepted {len(page_sizes)} pages ({len(pdf_data)} bytes) as {operation_id}")
+        host = self.headers.get('Host', f'{args.host}:{args.port}')
+        operation_location = f'http://{host}/documentintelligence/documentModels/{model_id}/analyzeResults/{operation_id}?api-version={api_version}'
+        self.send_json(202, {}, {'Operation-Location': operation_location, 'Retry-After': str(args.poll_after)})
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        match = result_pattern.search(path)
+        if not match:
+            self.send_error_json(404, 'NotFound', f'Resource not found: {path}')
+            return
+        if not self.check_key() or self.throttle('poll'):
+            return
+        count('poll')
+        with operations_lock:
+            operation = operations.get(match.group(2))
+        if operation is None:
+            self.send_error_json(404, 'NotFound', 'Resource not found.')
+            return
+        body = {'status': 'running', 'createdDateTime': operation['created'], 'lastUpdatedDateTime': now_string()}
+        if time.monotonic() < operation['ready_at']:
+            self.send_json(200, body, {'Retry-After': str(args.poll_after)})
+            return
+        if operation['fail']:
+            if not operation.get('counted'):
+                operation['counted'] = True
+                count('failed')
+            body['status'] = 'failed'
+            body['error'] = {'code': 'InternalServerError', 'message': 'An unexpected error occurred (mock failure injection).'}
+            self.send_json(200, body)
+            return
+        if not operation.get('counted'):
+            operation['counted'] = True
+            count('succeeded')
+            count('pages', len(operation['page_sizes']))
+        body['status'] = 'succeeded'
+        body['analyzeResult'] = build_analyze_result(operation['model_id'], operation['page_sizes'])
+        self.send_json(200, body)
+
+def print_counters():
+    with operations_lock:
+        snapshot = dict(counters)
+    print(Fore.YELLOW + "Mock DI " + Fore.WHITE + "analyze " + variable_str(snapshot['analyze']) + Fore.WHITE + "/ polls " + variable_str(snapshot['poll'])
+          + Fore.WHITE + "/" + Fore.GREEN + " succeeded " + variable_str(snapshot['succeeded']) + Fore.WHITE + "/" + Fore.RED + " failed " + variable_str(snapshot['failed'])
+          + Fore.WHITE + "/" + Fore.MAGENTA + " throttled " + variable_str(snapshot['throttled']) + Fore.WHITE + "/ pages " + variable_str(snapshot['pages'])
+          + Fore.WHITE + "/ MB " + variable_str(round(snapshot['bytes'] / 2**20, 1)) + Style.RESET_ALL)
+
+if __name__ == '__main__':
+    # コマンドライン引数を解析する
+    parser = argparse.ArgumentParser(description='Local stand-in for the Document Intelligence prebuilt-read API. Set DI_API_ENDPOINT=http://127.0.0.1:<port>/ to use it from pdf3json.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Default: 127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050, help='Port to listen on. Default: 5050')
+    parser.add_argument('--latency', type=float, default=2.0, help='Seconds before an analyze operation finishes. Default: 2.0')
+    parser.add_argument('--page-latency', type=float, default=0.0, help='Additional seconds per page. Default: 0')
+    parser.add_argument('--poll-after', type=int, default=1, help='Retry-After seconds returned while an operation is running. Default: 1')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with 429. Default: 0')
+    parser.add_argument('--tps', type=float, default=0, help='Analyze requests per second above which 429 is returned. Default: 0 (no limit)')
+    parser.add_argument('--poll-tps', type=float, default=0, help='Polling requests per second above which 429 is returned. Default: 0 (no limit)')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds returned with 429. Default: 1')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of analyze operations that end with status failed. Default: 0')
+    parser.add_argument('--max-mb', type=float, default=0, help='Uploads larger than this many MB are rejected with 400 InvalidContentLength. Default: 0 (no limit)')
+    parser.add_argument('--seed', type=int, help='Random seed for throttling and failures')
+    parser.add_argument('--log-level', '-log', default='INFO', choices=['DEBUG', 'VERBOSE', 'INFO', 'WARNING'],
+                        help='Set the logging level (default: INFO)')
+    parser.add_argument('-debug', action='store_const', const='DEBUG', dest='log_level',
+                        help='Set the logging level to DEBUG')
+    args = parser.parse_args()
+    powerlog.set_log_level(args)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    info_print(f"Mock Document Intelligence listening on http://{args.host}:{args.port}/ (api-version {api_version})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print_counters()
@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+from powerlog import debug_print, warning_print
+
+# OCR結果のキャッシュ。送るPDFのバイト列のハッシュとモデル、APIバージョンをキーにして、成功した解析の結果をJSONで保存する
+# 同じPDFを送る前にキャッシュを見て、あればサービスに送らずにその結果を使う (json3pdfの設定を変えて再実行する場合など)
+# キャッシュの合計が上限を超えたら、最後に使った日時 (ファイルの更新日時) が古いものから消す (LRU)
+cache_folder = './TEMP/ocrcache'
+default_max_mb = 2048
+
+# ハッシュを計算するときに一度に読む大きさ
+read_block_size = 2**20
+
+# PDFのバイト列のハッシュ (BLAKE2b-256) をファイル全体をメモリに読まずに計算する関数
+def file_digest(file_path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(read_block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# キャッシュのキー。モデルやAPIバージョンが変われば結果も変わるので別のキーにする
+def cache_key(digest, model_id, api_version):
+    return hashlib.blake2b(f"{digest}:{model_id}:{api_version}".encode(), digest_size=32).hexdigest()
+
+class OcrCache:
+    def __init__(self, folder=cache_folder, max_bytes=default_max_mb * 2**20):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key):
+        return self.folder / f"{key}.json"
+
+    # キャッシュから結果を読む関数。なければNone。読んだら更新日時を今にする (LRUの順番)
+    def get(self, key):
+        cache_path = self.get_path(key)
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                result_dict = json.load(f)
+            os.utime(cache_path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            warning_print(f"Ignoring broken OCR cache entry {cache_path}: {e}")
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        debug_print(f"OCR cache hit {cache_path}")
+        return result_dict
+
+    # 結果をキャッシュに書く関数。途中で止まっても壊れないように一時ファイルから置き換え、上限を超えたら古いものを消す
+    def put(self, key, result_dict):
+        cache_path = self.get_path(key)
+        tmp_cache_path = cache_path.with_suffix('.tmp')
+        with open(tmp_cache_path, 'w', encoding='utf-8') as f:
+            json.dump(result_dict, f, ensure_ascii=False)
+        os.replace(tmp_cache_path, cache_path)
+        self.evict()
+
+    # 合計がmax_bytesを超えている間、最後に使った日時が古いものから消す関数
+    def evict(self):
+        with self.lock:
+            entries = []
+            for cache_path in self.folder.glob('*.json'):
+                try:
+                    stat = cache_path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, cache_path))
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, cache_path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    cache_path.unlink()
+                    total_bytes -= size
+                    debug_print(f"Evicted OCR cache entry {cache_path}")
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,356 @@
+import os
+import json
+import base64
+import time
+import random
+import asyncio
+import traceback
+from azure.core.exceptions import AzureError, HttpResponseError
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+from PyPDF2 import PdfReader, PdfWriter
+import ocrcache
+import ratelimit
+from powerlog import verbose_print, info_print, warning_print, error_print, debug_print
+
+# Document Intelligenceに分割PDF (またはPDF全体) を並行して送るasyncioのOCRエンジン
+# 全ての本の全ての分割を1つのイベントループで処理し、同時に実行中の解析 (max_in_flight) と
+# 同時にアップロードする数 (max_uploads、PDFを読んでbase64にしたデータをメモリに持つ数) を制限する
+# 分割の結果は終わった順にJSONに書き、本の分割が全て終わったらon_book_doneを呼ぶ (結合はそこで行う)
+# 失敗した分割だけを待ってから送り直し (指数バックオフ、Retry-Afterを守る)、大きすぎるなどで受け付けられない分割だけを半分に分けて送る
+# 送ったPDFの解析の操作 (継続トークンとOperation-Location) はPDFの隣の.operation.jsonに記録し、
+# 途中で止まった後に実行し直したときは送り直さずにその操作の結果を待つ
+# limiterを渡すと、送信とポーリングのリクエストの速度をratelimit.RateLimiterで制限し、月のページ数を記録する
+
+# 同時に実行中の解析の数と同時にアップロードする数の既定値
+default_max_in_flight = 4
+default_max_uploads = 2
+
+# 1つのPDFを送る回数の上限 (超えたら失敗にする) と、送り直すまでの待ち時間の基準と上限 (秒)
+default_max_attempts = 3
+base_backoff = 2.0
+max_backoff = 60.0
+
+# 使用するモデル (Readのみ対応) とAPIバージョン (キャッシュのキーに使うので固定する)
+model_id = "prebuilt-read"
+api_version = "2024-11-30"
+
+# サービスが解析の結果を保持する時間 (秒)。これより古い操作は再開せずに送り直す
+operation_lifetime = 24 * 60 * 60
+
+# 分割PDFのOCR結果のJSONのパス
+def get_result_path(part_path, output_folder):
+    return os.path.join(output_folder, f"{os.path.basename(part_path)}.json")
+
+# OCR結果をJSONに保存する関数
+def save_result(result_dict, part_path, output_folder):
+    json_file_path = get_result_path(part_path, output_folder)
+    if os.path.exists(json_file_path):
+        warning_print(f"Warning: {json_file_path} already exists and will be overwritten.")
+        os.remove(json_file_path)
+    with open(json_file_path, "w", encoding="utf-8") as json_file:
+        json.dump(result_dict, json_file, ensure_ascii=False, indent=4)
+    info_print(f"OCR result saved to {json_file_path}")
+
+# PDFを読んでbase64の文字列にする関数 (スレッドで実行する)
+def read_base64(part_path):
+    with open(part_path, "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+# 送ったPDFの解析の操作を記録するファイルのパス (PDFの隣)
+def get_handle_path(part_path):
+    return f"{part_path}.operation.json"
+
+# 解析の操作を記録する関数。途中で止まっても壊れないように一時ファイルから置き換える
+def save_operation_handle(part_path, handle):
+    handle_path = get_handle_path(part_path)
+    tmp_handle_path = f"{handle_path}.tmp"
+    with open(tmp_handle_path, "w", encoding="utf-8") as handle_file:
+        json.dump(handle, handle_file, ensure_ascii=False, indent=4)
+    os.replace(tmp_handle_path, handle_path)
+
+# 記録した解析の操作を読む関数。なければNone
+def load_operation_handle(part_path):
+    handle_path = get_handle_path(part_path)
+    try:
+        with open(handle_path, "r", encoding="utf-8") as handle_file:
+            return json.load(handle_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        warning_print(f"Ignoring broken operation record {handle_path}: {e}")
+        return None
+
+def remove_operation_handle(part_path):
+    try:
+        os.remove(get_handle_path(part_path))
+    except FileNotFoundError:
+        pass
+
+# 解析の操作のIDと結果のURL (Operation-Location) を返す関数。SDKの公開のdetailsから取り、取れなければ (None, None)
+# 再開には継続トークンだけを使うので、IDとURLは記録として残すだけ
+def get_operation(poller, endpoint):
+    try:
+        operation_id = poller.details['operation_id']
+    except (KeyError, AttributeError, TypeError, ValueError):
+        return None, None
+    return operation_id, f"{endpoint.rstrip('/')}/documentintelligence/documentModels/{model_id}/analyzeResults/{operation_id}?api-version={api_version}"
+
+# 分割PDFを半分に分ける関数。book_part3.pdf → book_part3_split1.pdf, book_part3_split2.pdf、book.pdf → book_split1.pdf, book_split2.pdf
+# j2k2pdfやpdf3jsonが書いた分割 (_partN) と同じ名前にならないようにする。1ページのPDFは分けられないのでNoneを返す
+def split_pdf(part_path, split_folder):
+    reader = PdfReader(part_path)
+    total_pages = len(reader.pages)
+    if total_pages < 2:
+        return None
+    stem = os.path.splitext(os.path.basename(part_path))[0]
+    names = [f"{stem}_split1.pdf", f"{stem}_split2.pdf"]
+    half = (total_pages + 1) // 2
+    split_paths = []
+    for name, (first_page, last_page) in zip(names, [(0, half), (half, total_pages)]):
+        writer = PdfWriter()
+        for page_number in range(first_page, last_page):
+            writer.add_page(reader.pages[page_number])
+        split_path = os.path.join(split_folder, name)
+        with open(split_path, "wb") as output_pdf:
+            writer.write(output_pdf)
+        split_paths.append(split_path)
+    return split_paths
+
+# 失敗の種類を判断する関数
+# 'retry': 同じPDFを待ってから送り直す (429、5xx、接続の失敗、解析の失敗)。送り直しても失敗したら分けずに失敗にする
+# 'split': 送り直しても同じなので半分に分ける (大きすぎる、読めないなどの400、413、415)
+# 'fatal': 分けても直らない (キー、エンドポイントの間違い、月のページ数の上限、Azure以外の例外)
+def classify_error(error):
+    if isinstance(error, ratelimit.QuotaExceededError) or not isinstance(error, AzureError):
+        return 'fatal'
+    if isinstance(error, HttpResponseError):
+        status_code = error.status_code
+        if status_code in (400, 413, 415):
+            return 'split'
+        if status_code in (401, 403, 404):
+            return 'fatal'
+    return 'retry'
+
+# 失敗した応答のRetry-After (秒)。なければNone
+def get_retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+# 送り直すまでの待ち時間 (指数バックオフとフルジッター)。Retry-Afterがあればそれより短くしない
+def backoff_delay(attempt, retry_after=None):
+    delay = random.uniform(0, min(max_backoff, base_backoff * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+# 分割の状態の辞書を作る関数
+def new_part(part_path, output_folder):
+    return {'path': part_path, 'output_folder': output_folder, 'status': 'pending', 'attempts': 0, 'error': None, 'children': []}
+
+# 分割とその子をすべて返す関数
+def iter_parts(parts):
+    for part in parts:
+        yield part
+        yield from iter_parts(part['children'])
+
+class OcrEngine:
+    # cacheはocrcache.OcrCache (Noneならキャッシュを使わない)。read_cacheがFalseならキャッシュを読まずに送り、結果だけ書く
+    # 1つのPDFはmax_attempts回まで送る。受け付けられないPDFはsplit_folderに半分に分けて、結果はsplit_output_folderに書く
+    def __init__(self, endpoint, credential, max_in_flight=default_max_in_flight, max_uploads=default_max_uploads, cache=None, read_cache=True,
+                 max_attempts=default_max_attempts, split_folder=None, split_output_folder=None, limiter=None):
+        self.endpoint = endpoint
+        self.credential = credential
+        self.max_in_flight = max_in_flight
+        self.max_uploads = max_uploads
+        self.cache = cache
+        self.read_cache = read_cache
+        self.max_attempts = max_attempts
+        self.split_folder = split_folder
+        self.split_output_folder = split_output_folder
+        self.limiter = limiter
+        self.resumed = 0
+
+    # 記録した操作を再開できるか (同じPDF、エンドポイント、モデル、APIバージョンで、結果がまだ保持されている)
+    def is_resumable(self, handle, digest):
+        return (handle.get('digest') == digest and handle.get('endpoint') == self.endpoint
+                and handle.get('model_id') == model_id and handle.get('api_version') == api_version
+                and time.time() - handle.get('submitted', 0) < operation_lifetime)
+
+    # 1つの分割を解析して結果を保存する。失敗したら例外をそのまま返す
+    # キャッシュに同じPDFの結果があれば、解析の枠を待たずにそれを保存する
+    # 前の実行で送ったままの操作が記録されていれば、送り直さずにその結果を待つ
+    async def analyze_part(self, client, part_path, output_folder):
+        digest = await asyncio.to_thread(ocrcache.file_digest, part_path)
+        key = None
+        if self.cache is not None:
+            key = ocrcache.cache_key(digest, model_id, api_version)
+            result_dict = await asyncio.to_thread(self.cache.get, key) if self.read_cache else None
+            if result_dict is not None:
+                verbose_print(f"Using cached OCR result for {part_path}")
+                await asyncio.to_thread(save_result, result_dict, part_path, output_folder)
+                await asyncio.to_thread(remove_operation_handle, part_path)
+                return
+        handle = await asyncio.to_thread(load_operation_handle, part_path)
+        if handle is not None and not self.is_resumable(handle, digest):
+            debug_print(f"Not resuming the recorded operation for {part_path}")
+            await asyncio.to_thread(remove_operation_handle, part_path)
+            handle = None
+        async with self.in_flight:
+            poller = None
+            if handle is not None:
+                try:
+                    poller = await client.begin_analyze_document(model_id, None, continuation_token=handle['continuation_token'])
+                    info_print(f"Resuming OCR of {part_path} (operation {handle.get('operation_id')})")
+                except Exception as e:
+                    warning_print(f"Cannot resume OCR of {part_path}: {e}. Sending it again")
+                    await asyncio.to_thread(remove_operation_handle, part_path)
+                    handle = None
+            if poller is None:
+                if self.limiter is not None:
+                    await asyncio.to_thread(self.limiter.check_pages)
+                async with self.uploads:
+                    base64_encoded_pdf = await asyncio.to_thread(read_base64, part_path)
+                    poller = await client.begin_analyze_document(model_id, {"base64Source": base64_encoded_pdf})
+                    del base64_encoded_pdf
+                # 受け付けられたらすぐに操作を記録する
+                operation_id, operation_location = get_operation(poller, self.endpoint)
+                await asyncio.to_thread(save_operation_handle, part_path, {
+                    'operation_id': operation_id,
+                    'operation_location': operation_location,
+                    'continuation_token': poller.continuation_token(),
+                    'digest': digest,
+                    'model_id': model_id,
+                    'api_version': api_version,
+                    'endpoint': self.endpoint,
+                    'submitted': time.time(),
+                })
+                verbose_print(f"Sent {part_path} to Document Intelligence for OCR. Waiting for results...")
+            try:
+                analyze_result = await poller.result()
+            except HttpResponseError as e:
+                # 操作が失敗したら記録を消す (次は送り直す)。接続の失敗などでは記録を残し、送り直すときに再開する
+                await asyncio.to_thread(remove_operation_handle, part_path)
+                if handle is None or e.status_code != 404:
+                    raise
+                analyze_result = None
+            if analyze_result is not None:
+                if handle is not None:
+                    self.resumed += 1
+                verbose_print(f"OCR completed for {part_path}")
+                result_dict = analyze_result.as_dict()
+                result_dict["status"] = poller.status()
+                if self.limiter is not None:
+                    await asyncio.to_thread(self.limiter.record_pages, len(result_dict.get("pages", [])))
+        if analyze_result is None:
+            # 再開した操作が見つからない (期限切れ) ときは解析の枠を返してから送り直す
+            warning_print(f"The recorded operation for {part_path} has expired. Sending it again")
+            return await self.analyze_part(client, part_path, output_folder)
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, result_dict)
+        await asyncio.to_thread(save_result, result_dict, part_path, output_folder)
+        await asyncio.to_thread(remove_operation_handle, part_path)
+
+    # 1つの分割を成功するまで処理する。失敗したら待って送り直し、受け付けられなければ半分に分けてそれぞれを処理する
+    # part: {'path', 'output_folder', 'status': 'pending'/'succeeded'/'split'/'failed', 'attempts', 'error', 'children'}
+    # 結果のJSONになる末端の分割をページ順に返す
+    async def run_part(self, client, part):
+        while True:
+            try:
+                await self.analyze_part(client, part['path'], part['output_folder'])
+                part['status'] = 'succeeded'
+                return [part]
+            except Exception as e:
+                part['attempts'] += 1
+                part['error'] = str(e)
+                error_kind = classify_error(e)
+                if error_kind == 'fatal':
+                    error_print(f"Failed to process {part['path']}: {e}")
+                    if not isinstance(e, (AzureError, ratelimit.QuotaExceededError)):
+                        error_print(traceback.format_exc())
+                    part['status'] = 'failed'
+                    return [part]
+                if error_kind == 'retry':
+                    if part['attempts'] >= self.max_attempts:
+                        # 429や5xx、接続の失敗は分けても直らないので分けない
+                        error_print(f"Failed to process {part['path']} after {part['attempts']} attempts: {e}")
+                        part['status'] = 'failed'
+                        return [part]
+                    delay = backoff_delay(part['attempts'], get_retry_after(e))
+                    warning_print(f"Failed to process {part['path']} (attempt {part['attempts']} / {self.max_attempts}): {e}. Retrying in {delay:.1f} s")
+                    await asyncio.sleep(delay)
+                    continue
+            # 受け付けられなかった分割だけを半分に分ける
+            split_paths = None
+            if self.split_folder is not None:
+                try:
+                    split_paths = await asyncio.to_thread(split_pdf, part['path'], self.split_folder)
+                except Exception as e:
+                    error_print(f"Failed to split {part['path']}: {e}")
+            if not split_paths:
+                error_print(f"Failed to process {part['path']}: {part['error']}")
+                part['status'] = 'failed'
+                return [part]
+            warning_print(f"Failed to process {part['path']}: {part['error']}. Sending it as {len(split_paths)} smaller parts")
+            part['status'] = 'split'
+            part['children'] = [new_part(split_path, self.split_output_folder) for split_path in split_paths]
+            results = await asyncio.gather(*(self.run_part(client, child) for child in part['children']))
+            return [leaf for leaves in results for leaf in leaves]
+
+    # 本の全ての分割を並行して処理し、終わったらon_book_done(book, failed_parts)をスレッドで呼ぶ
+    # book['result_files']に結果のJSONのパスをページ順に、book['split']に分割を分けたかを記録する
+    async def process_book(self, client, book, on_book_done):
+        book['part_jobs'] = [new_part(part_path, book['output_folder']) for part_path in book['parts']]
+        results = await asyncio.gather(*(self.run_part(client, part) for part in book['part_jobs']))
+        leaves = [leaf for leaves in results for leaf in leaves]
+        book['result_files'] = [get_result_path(leaf['path'], leaf['output_folder']) for leaf in leaves]
+        book['split'] = any(part['status'] == 'split' for part in book['part_jobs']) or len(leaves) > len(book['part_jobs'])
+        failed_parts = [leaf['path'] for leaf in leaves if leaf['status'] != 'succeeded']
+        debug_print(f"{book['name']}: {len(leaves) - len(failed_parts)} / {len(leaves)} parts done")
+        if on_book_done is not None:
+            await asyncio.to_thread(on_book_done, book, failed_parts)
+        return failed_parts
+
+    async def process_books(self, books, on_book_done):
+        # セマフォはイベントループの中で作る
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.uploads = asyncio.Semaphore(self.max_uploads)
+        policies = [ratelimit.RateLimitPolicy(self.limiter)] if self.limiter is not None else []
+        async with DocumentIntelligenceClient(self.endpoint, self.credential, api_version=api_version, per_retry_policies=policies) as client:
+            results = await asyncio.gather(*(self.process_book(client, book, on_book_done) for book in books), return_exceptions=True)
+        failed_books = {}
+        for book, result in zip(books, results):
+            if isinstance(result, BaseException):
+                error_print(f"Failed to process {book['name']}: {result}")
+                failed_books[book['name']] = book['parts']
+            elif result:
+                failed_books[book['name']] = result
+        return failed_books
+
+    # 本のリスト [{'name': 本の名前, 'parts': [PDFのパス], 'output_folder': 結果のフォルダ, ...}] を処理する関数
+    # 失敗した分割がある本を {本の名前: [失敗した分割のパス]} で返す
+    def run(self, books, on_book_done=None):
+        if not books:
+            return {}
+        part_count = sum(len(book['parts']) for book in books)
+        info_print(f"Sending {part_count} PDFs of {len(books)} books to Document Intelligence ({self.max_in_flight} in flight, {self.max_uploads} uploads)")
+        pending_count = sum(1 for book in books for part_path in book['parts'] if os.path.exists(get_handle_path(part_path)))
+        if pending_count:
+            info_print(f"Found {pending_count} operations left by a previous run. Resuming them instead of sending the PDFs again")
+        start_time = time.monotonic()
+        failed_books = asyncio.run(self.process_books(books, on_book_done))
+        elapsed_time = time.monotonic() - start_time
+        parts = [part for book in books for part in iter_parts(book.get('part_jobs', []))]
+        status_counts = {status: sum(1 for part in parts if part['status'] == status) for status in ('succeeded', 'split', 'failed')}
+        retry_count = sum(max(part['attempts'] - 1, 0) if part['status'] == 'succeeded' else part['attempts'] for part in parts)
+        info_print(f"OCR of {len(books) - len(failed_books)} / {len(books)} books finished in {elapsed_time:.1f} s ({status_counts['succeeded'] / max(elapsed_time, 0.001):.2f} PDFs/s): "
+                   f"{status_counts['succeeded']} PDFs succeeded, {status_counts['split']} split, {status_counts['failed']} failed, {retry_count} failed attempts, {self.resumed} resumed")
+        if self.cache is not None:
+            info_print(f"OCR cache: {self.cache.hits} hits, {self.cache.misses} misses")
+        if self.limiter is not None:
+            self.limiter.report()
+        return failed_books
@@ -0,0 +1,184 @@
+import os
+import json
+import glymur
+from PIL import Image
+import jp2digest
+from powerlog import debug_print, warning_print
+
+# 本ごとのヘッダー情報のインデックス (JSON Lines) のフォルダ
+# img2j2kが出力画像の行 (type: page) を書き、j2k2pdfが作成したPDFの行 (type: pdf) とOCR用の分割PDFの行 (type: parts) を追記する
+# 後の処理はファイルを開き直す代わりにこれを読む。サイズと更新日時が記録と違うファイルは開いて読む
+index_folder = './TEMP/index'
+
+# インデックスのパス (本ごとに1つ)
+def get_index_path(book):
+    return os.path.join(index_folder, book + '.jsonl')
+
+# ファイルの記録がいまのファイルと同じか (サイズと更新日時) 確認する関数
+def is_current(entry, file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+    return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']
+
+# 出力画像のヘッダーだけを読んでインデックスの行を作成する関数
+# dpiはPillowが読むDPI (記録がなければNone)、write_dpiはimg2j2kがXMLBoxに記録したDPI
+# codestreamはJP2のコードストリーム (jp2cボックス) のファイル内の位置と長さ
+def read_image_info(image_path, output):
+    stat = os.stat(image_path)
+    with Image.open(image_path) as img:
+        info = {
+            'type': 'page',
+            'output': output,
+            'file': os.path.basename(image_path),
+            'width': img.size[0],
+            'height': img.size[1],
+            'mode': img.mode,
+            'format': img.format,
+            'dpi': img.info.get('dpi'),
+            'write_dpi': None,
+            'lossless': output == 'lossless' and img.format != 'JPEG',
+            'cratios': None,
+            'rate': None,
+            'codestream': None,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+    if info['format'] == 'JPEG2000':
+        with jp2digest.ascii_path(image_path) as path:
+            jp2 = glymur.Jp2k(path)
+            jp2_info = jp2digest.read_jp2_info(jp2)
+            for box in jp2.box:
+                if box.box_id == 'jp2c':
+                    info['codestream'] = [box.offset, box.length]
+        info['write_dpi'] = int(jp2_info['dpi']) if jp2_info['dpi'] and jp2_info['dpi'].isdigit() else jp2_info['dpi']
+        info['cratios'] = jp2_info['cratios']
+        info['rate'] = jp2_info['rate']
+        if jp2_info['lossless'] is not None:
+            info['lossless'] = jp2_info['lossless']
+    return info
+
+# インデックスを書き込む関数。ページの行はファイル名順にページ番号 (1から) を振る
+# 途中で中断しても壊れないように一時ファイルから置き換える。PDFの行は画像が変わると古くなるので残さない
+def write_book_index(book, entries):
+    os.makedirs(index_folder, exist_ok=True)
+    index_path = get_index_path(book)
+    page_numbers = {}
+    tmp_index_path = index_path + '.tmp'
+    with open(tmp_index_path, 'w', encoding='utf-8') as index_file:
+        for entry in sorted(entries, key=lambda entry: (entry['output'], entry['file'])):
+            page_numbers[entry['output']] = page_numbers.get(entry['output'], 0) + 1
+            entry = dict(entry, page=page_numbers[entry['output']])
+            index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    os.replace(tmp_index_path, index_path)
+    debug_print(f"Wrote index {index_path}")
+
+# インデックスを読み込む関数。{'pages': {出力名: {ファイル名: 行}}, 'pdfs': {出力名: 行}, 'parts': {出力名: 行}} を返す
+# インデックスがない、または読めない場合は空
+def load_book_index(book):
+    book_index = {'pages': {}, 'pdfs': {}, 'parts': {}}
+    index_path = get_index_path(book)
+    if not os.path.exists(index_path):
+        return book_index
+    try:
+        with open(index_path, 'r', encoding='utf-8') as index_file:
+            for line in index_file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry['type'] == 'page':
+                    book_index['pages'].setdefault(entry['output'], {})[entry['file']] = entry
+                elif entry['type'] == 'pdf':
+                    book_index['pdfs'][entry['output']] = entry
+                elif entry['type'] == 'parts':
+                    book_index['parts'][entry['output']] = entry
+    except (OSError, ValueError, KeyError) as e:
+        warning_print(f"Could not read index {index_path}: {e}")
+        return {'pages': {}, 'pdfs': {}, 'parts': {}}
+    return book_index
+
+# 作成したPDFの行をインデックスに追記する関数 (ページ数とページサイズ [幅, 高さ] ポイント)
+def append_pdf_record(book, output, pdf_path, pages, page_size):
+    stat = os.stat(pdf_path)
+    entry = {
+        'type': 'pdf',
+        'output': output,
+        'file': os.path.basename(pdf_path),
+        'pages': pages,
+        'page_size': [float(page_size[0]), float(page_size[1])],
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+    os.makedirs(index_folder, exist_ok=True)
+    with open(get_index_path(book), 'a', encoding='utf-8') as index_file:
+        index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+# OCR用の分割PDFの行をインデックスに追記する関数。partsは [(分割PDFのパス, 最初のページ (1から), ページ数)]
+# 元のPDF (pdf_path) の記録と一緒に使い、元のPDFが作り直されたら分割PDFも古いとみなす
+def append_parts_record(book, output, pdf_path, parts):
+    pdf_stat = os.stat(pdf_path)
+    entry = {
+        'type': 'parts',
+        'output': output,
+        'pdf': os.path.basename(pdf_path),
+        'pdf_size': pdf_stat.st_size,
+        'pdf_mtime_ns': pdf_stat.st_mtime_ns,
+        'parts': [],
+    }
+    for part_path, first_page, pages in parts:
+        part_stat = os.stat(part_path)
+        entry['parts'].append({'file': os.path.basename(part_path), 'first_page': first_page, 'pages': pages,
+                               'size': part_stat.st_size, 'mtime_ns': part_stat.st_mtime_ns})
+    os.makedirs(index_folder, exist_ok=True)
+    with open(get_index_path(book), 'a', encoding='utf-8') as index_file:
+        index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+# PDFのOCR用の分割PDFのパスをページ順に返す関数。part_folderは分割PDFのフォルダ
+# 記録がない、元のPDFが記録と違う、または分割PDFが1つでも記録と違う場合はNone
+def lookup_parts(pdf_path, part_folder):
+    book = os.path.splitext(os.path.basename(pdf_path))[0]
+    for entry in load_book_index(book)['parts'].values():
+        if entry['pdf'] != os.path.basename(pdf_path):
+            continue
+        if not is_current({'size': entry['pdf_size'], 'mtime_ns': entry['pdf_mtime_ns']}, pdf_path):
+            return None
+        part_paths = [os.path.join(part_folder, part['file']) for part in entry['parts']]
+        if all(is_current(part, part_path) for part, part_path in zip(entry['parts'], part_paths)):
+            return part_paths
+    return None
+
+# PDFのパスからインデックスの行を探す関数 (本の名前はPDFのファイル名)。記録と違うPDFならNone
+def lookup_pdf(pdf_path):
+    book = os.path.splitext(os.path.basename(pdf_path))[0]
+    for entry in load_book_index(book)['pdfs'].values():
+        if entry['file'] == os.path.basename(pdf_path) and is_current(entry, pdf_path):
+            return entry
+    return None
+
+# インデックスの行をPillowの画像の代わりに使うクラス。ヘッダーで読める属性だけを持つ
+class IndexedImage:
+    def __init__(self, image_path, entry):
+        self.filename = str(image_path)
+        self.size = (entry['width'], entry['height'])
+        self.mode = entry['mode']
+        self.format = entry['format']
+        self.info = {}
+        if entry['dpi'] is not None:
+            self.info['dpi'] = tuple(entry['dpi'])
+        if self.format == 'JPEG2000' and not entry['lossless']:
+            self.info['irreversible'] = True
+        self.index_entry = entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+# インデックスに最新の記録があればIndexedImage、なければPillowで画像を開く関数
+def open_image(image_path, entries):
+    entry = entries.get(os.path.basename(image_path))
+    if entry is not None and is_current(entry, image_path):
+        return IndexedImage(image_path, entry)
+    return Image.open(image_path)
@@ -0,0 +1,77 @@
+import os
+import zlib
+import pageindex
+import pdfinspect
+from powerlog import debug_print, warning_print
+
+# OCRに送るPDFの分割を決める。ページごとのバイト数から、ページ数の上限とバイト数の上限の両方に収まるように続いたページを詰める
+# 分割の数は最小にしたうえで、一番大きい分割ができるだけ小さくなるように分ける (並行したアップロードが同じ頃に終わるように)
+# ページのバイト数は、インデックスの画像のサイズ (j2k2pdfが作ったPDFの記録が今のPDFと同じ場合)、PDFのxref (内容と画像のストリームの長さ)、
+# どちらも読めなければPDFの大きさをページ数で割ったもの
+
+# 1つの分割のページ数の上限 (Readモデルが1回に解析するページ数の上限)
+default_max_pages = 2000
+# 1つの分割の大きさの上限 (MB)。要求の上限の500MBにbase64 (4/3倍) で収まる大きさ
+default_max_mb = 350
+
+# ページの大きさに足すページごとのオブジェクト (ページ、コンテンツ、画像の辞書、xref) の大きさ
+page_overhead = 1024
+
+# ページを先頭から順に、上限を超えるまで詰める関数。分割を [(最初のページ, 最後のページの次)] (0から) で返す
+# 1ページで上限を超えるページはそれだけで1つの分割にする
+def pack_pages(page_sizes, max_pages, max_bytes):
+    page_ranges = []
+    start = 0
+    part_bytes = 0
+    for page, size in enumerate(page_sizes):
+        if page > start and (page - start >= max_pages or (max_bytes and part_bytes + size > max_bytes)):
+            page_ranges.append((start, page))
+            start = page
+            part_bytes = 0
+        part_bytes += size
+    if page_sizes:
+        page_ranges.append((start, len(page_sizes)))
+    return page_ranges
+
+# ページのバイト数から分割を決める関数。max_bytesが0ならページ数だけで分ける
+# 詰めたときの分割の数を変えずに、一番大きい分割のバイト数の上限を二分探索で下げて分割の大きさをそろえる
+def plan_parts(page_sizes, max_pages=default_max_pages, max_bytes=default_max_mb * 2**20):
+    page_ranges = pack_pages(page_sizes, max_pages, max_bytes)
+    if len(page_ranges) < 2:
+        return page_ranges
+    if max_bytes:
+        for page, size in enumerate(page_sizes, start=1):
+            if size > max_bytes:
+                warning_print(f"Page {page} is {size / 2**20:.1f} MB, larger than the part size limit of {max_bytes / 2**20:.1f} MB. It is sent as a part by itself")
+    low = max(page_sizes)
+    high = max(sum(page_sizes[start:end]) for start, end in page_ranges)
+    while low < high:
+        middle = (low + high) // 2
+        if len(pack_pages(page_sizes, max_pages, middle)) <= len(page_ranges):
+            high = middle
+        else:
+            low = middle + 1
+    return pack_pages(page_sizes, max_pages, high)
+
+# インデックスに記録したページの画像のサイズを返す関数。PDFの記録が今のPDFと違う、またはページが足りなければNone
+def get_indexed_page_sizes(pdf_path):
+    pdf_record = pageindex.lookup_pdf(pdf_path)
+    if pdf_record is None:
+        return None
+    book = os.path.splitext(os.path.basename(pdf_path))[0]
+    entries = sorted(pageindex.load_book_index(book)['pages'].get(pdf_record['output'], {}).values(), key=lambda entry: entry['page'])
+    if len(entries) != pdf_record['pages'] or not all('size' in entry for entry in entries):
+        return None
+    return [entry['size'] for entry in entries]
+
+# PDFのページごとのバイト数 (ページごとのオブジェクトを含む) と、その取り方 ('index', 'xref', 'average') を返す関数
+def get_page_sizes(pdf_path):
+    page_sizes = get_indexed_page_sizes(pdf_path)
+    if page_sizes is not None:
+        return [size + page_overhead for size in page_sizes], 'index'
+    try:
+        return [size + page_overhead for size in pdfinspect.page_byte_sizes(pdf_path)], 'xref'
+    except (pdfinspect.PdfInspectError, OSError, ValueError, KeyError, IndexError, TypeError, zlib.error) as e:
+        debug_print(f"Could not read the page sizes of {pdf_path}: {e}")
+    total_pages = pdfinspect.count_pages(pdf_path)
+    return [os.path.getsize(pdf_path) // max(total_pages, 1)] * total_pages, 'average'
@@ -2,14 +2,18 @@ from dotenv import load_dotenv
 import os
 import argparse
 from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
 import json
 import powerlog
+import pageindex
+import ocrengine
+import ocrcache
+import ratelimit
+import partplan
 from powerlog import logger,verbose_print, info_print,warning_print, error_print, variable_str, debug_print
 from PyPDF2 import PdfReader, PdfWriter
-import base64
 import shutil
 import math
+import re
 
 # コマンドライン引数を解析する
 parser = powerlog.create_parser()
@@ -19,16 +23,40 @@ parser.add_argument('--log-level', '-log', default='INFO', choices=['DEBUG', 'VE
 parser.add_argument('-debug', action='store_const', const='DEBUG', dest='log_level',
                     help='Set the logging level to DEBUG')
 dividing = parser.add_mutually_exclusive_group()
-dividing.add_argument('-p', '--pages', type=int, help='divide the PDF into specified number of pages. Default:300')
-dividing.add_argument('--no-divide', action='store_true', help='Overrides auto divide of 300 pages and will try to process whole PDF')
+dividing.add_argument('-p', '--pages', type=int, help='divide the PDF into specified number of pages. Default: divide by --max-part-pages and --max-part-mb')
+dividing.add_argument('--no-divide', action='store_true', help='Overrides auto divide and will try to process whole PDF')
 dividing.add_argument('--divide','-d', type=int, help='divide the PDF into specified number of parts. Default:1')
-default_max_pages = 300
+parser.add_argument('--max-part-pages', type=int, default=partplan.default_max_pages,
+                    help=f'Auto divide: maximum pages of each part. Default: {partplan.default_max_pages}')
+parser.add_argument('--max-part-mb', type=float, default=partplan.default_max_mb,
+                    help=f'Auto divide: maximum size of each part in MB, estimated from the page image sizes. 0 divides by pages only. Default: {partplan.default_max_mb}')
 
 #divide default 3 for Test↑
-parser.add_argument('--attempts', type=int, default=3,
-                    help='the maximum number of attempts. Default: 3')
+parser.add_argument('--attempts', type=int, default=ocrengine.default_max_attempts,
+                    help=f'the maximum number of attempts for each PDF part. A part that the service rejects as too large or unreadable is split in half and only its halves are sent. Default: {ocrengine.default_max_attempts}')
 parser.add_argument('--no-delete', action='store_true',help='Do not delete files')
+parser.add_argument('--concurrency', type=int, default=ocrengine.default_max_in_flight,
+                    help=f'Number of analyze operations in flight at once, across all parts and books. Default: {ocrengine.default_max_in_flight}')
+parser.add_argument('--upload-concurrency', type=int, default=ocrengine.default_max_uploads,
+                    help=f'Number of PDFs read and uploaded at once. Default: {ocrengine.default_max_uploads}')
+parser.add_argument('--no-cache', action='store_true', help='Do not use cached OCR results (results are still cached)')
+parser.add_argument('--cache-mb', type=int, default=ocrcache.default_max_mb,
+                    help=f'Maximum size of the OCR result cache in {ocrcache.cache_folder} in MB. Least recently used results are removed first. 0 disables the cache. Default: {ocrcache.default_max_mb}')
+parser.add_argument('--tps', type=float, default=ratelimit.default_submit_rate,
+                    help=f'Maximum analyze requests per second. Lowered automatically while the service answers 429. Default: {ratelimit.default_submit_rate:g}')
+parser.add_argument('--poll-tps', type=float, default=ratelimit.default_poll_rate,
+                    help=f'Maximum result polling requests per second. Default: {ratelimit.default_poll_rate:g}')
+parser.add_argument('--shared-limit', action='store_true',
+                    help=f'Share the request rate with other pdf3json processes through {ratelimit.quota_file}')
+parser.add_argument('--monthly-pages', type=int, default=0,
+                    help='Do not send more PDFs once this many pages were analyzed this month (all processes). Default: 0 (no limit)')
 args = parser.parse_args()
+if args.concurrency < 1:
+    parser.error("--concurrency must be at least 1")
+if args.upload_concurrency < 1:
+    parser.error("--upload-concurrency must be at least 1")
+if args.tps <= 0 or args.poll_tps <= 0:
+    parser.error("--tps and --poll-tps must be greater than 0")
 
 powerlog.set_log_level(args)
 
@@ -36,7 +64,6 @@ powerlog.set_log_level(args)
 load_dotenv('diAPI.env')
 endpoint = os.getenv('DI_API_ENDPOINT')
 credential = AzureKeyCredential(os.getenv('DI_API_KEY'))
-document_intelligence_client = DocumentIntelligenceClient(endpoint, credential)
 
 #Define input/output folder
 optpdf_folder = './OptimizedPDF'
@@ -81,37 +108,29 @@ def divide_pdf(file_path, divide_value):
             writer.add_page(reader.pages[sub_page])
         yield writer
 
-# Function to process PDF and send to Document Intelligence API and receive OCR results and save to JSON file
-def process_pdf(file_path, client, output_folder):
-    try:
-        # Send PDF to Document Intelligence for OCR
-        with open(file_path, "rb") as f:
-            base64_encoded_pdf = base64.b64encode(f.read()).decode()
-            poller = client.begin_analyze_document("prebuilt-read", {"base64Source": base64_encoded_pdf})
-        verbose_print(f"Sent {file_path} to Document Intelligence for OCR. Waiting for results...")
-
-        # Wait for OCR results
-        analyze_result = poller.result()
-        verbose_print(f"OCR completed for {file_path}")
-
-        # Create dictionary from OCR results and add status
-        result_dict = analyze_result.as_dict()
-        result_dict["status"] = poller.status()
+# 分割 [(最初のページ, 最後のページの次)] (0から) ごとにPDFを分ける関数 (partplanが決めた分割)
+def divide_pdf_by_ranges(file_path, page_ranges):
+    info_print(f"Dividing {file_path} into {len(page_ranges)} parts of {', '.join(str(end - start) for start, end in page_ranges)} pages")
+    reader = PdfReader(file_path)
+    for start, end in page_ranges:
+        debug_print(f"Processing pages {start} to {end}")
+        writer = PdfWriter()
+        for sub_page in range(start, end):
+            writer.add_page(reader.pages[sub_page])
+        yield writer
 
-        # Save OCR results to JSON file
-        json_file_path = os.path.join(output_folder, f"{os.path.basename(file_path)}.json")
-        if os.path.exists(json_file_path):
-            warning_print(f"Warning: {json_file_path} already exists and will be overwritten.")
-            os.remove(json_file_path)
-        with open(json_file_path, "w", encoding="utf-8") as json_file:
-            json.dump(result_dict, json_file, ensure_ascii=False, indent=4)
-        
-        info_print(f"OCR result saved to {json_file_path}")
-    except Exception as e:
-        print(f"Failed to process {file_path}: {e}")
+# 分割PDFのファイル名からpart番号を取り出す関数。OCRエンジンが半分に分けた分割 (_part3_split1) は (3, 1)
+# 分割していない本を分けたもの (_split1) は (0, 1)。番号がなければ (0,)
+def part_number(filename):
+    stem = filename.split('.pdf')[0]
+    numbers = re.findall(r'_(part|split)(\d+)', stem)
+    if not numbers:
+        return (0,)
+    return tuple(([0] if numbers[0][0] == 'split' else []) + [int(number) for _, number in numbers])
 
 # Function to merge OCR results from divided PDFs
-def merge_ocr_results(base_name, divjson_folder, json_folder):
+# part_filesはdivjson_folderの中の結果のファイル名 (ページ順)。Noneならdivjson_folderの本の結果を全て使う
+def merge_ocr_results(base_name, divjson_folder, json_folder, part_files=None):
     merged_results = {
         "apiVersion": "",
         "modelId": "",
@@ -124,7 +143,9 @@ def merge_ocr_results(base_name, divjson_folder, json_folder):
         "status": []
     }
 
-    part_files = sorted([f for f in os.listdir(divjson_folder) if f.startswith(base_name) and f.endswith('.json')])
+    # _part10が_part2より前にならないようにpart番号で並べる
+    if part_files is None:
+        part_files = sorted([f for f in os.listdir(divjson_folder) if f.startswith((base_name + '_part', base_name + '_split')) and f.endswith('.json')], key=part_number)
 
     if len(part_files) == 1:
         os.rename(os.path.join(divjson_folder, part_files[0]), os.path.join(json_folder, base_name + '.pdf.json'))
@@ -212,8 +233,11 @@ def merge_ocr_results(base_name, divjson_folder, json_folder):
 
     return merged_results
 
-def divide_and_process_pdf(pdf_file_path, divide_value, div_pages,base_name, document_intelligence_client, divpdf_folder, divjson_folder, json_folder):
-    if args.divide:
+# Function to divide PDF and write the parts to divpdf_folder. Returns the paths of the parts
+def divide_pdf_to_parts(pdf_file_path, divide_value, div_pages, base_name, divpdf_folder, page_ranges=None):
+    if page_ranges:
+        pdf_parts = list(divide_pdf_by_ranges(pdf_file_path, page_ranges))
+    elif args.divide:
         pdf_parts = list(divide_pdf(pdf_file_path, divide_value))
         debug_print(f"Divide value: {divide_value}, Divide pages: {div_pages} function is divide_pdf")
     elif args.pages:
@@ -222,12 +246,17 @@ def divide_and_process_pdf(pdf_file_path, divide_value, div_pages,base_name, doc
     else:
         pdf_parts = list(divide_pdf(pdf_file_path, divide_value))
         debug_print(f"Divide value: {divide_value}, Divide pages: {div_pages} function is divide_pdf")
+    part_paths = []
     for i, pdf_part in enumerate(pdf_parts, start=1):  # start parameter set to 1
         output_pdf_path = os.path.join(divpdf_folder, f"{base_name}_part{i}.pdf")
         with open(output_pdf_path, "wb") as output_pdf:
             pdf_part.write(output_pdf)
-        process_pdf(output_pdf_path, document_intelligence_client, divjson_folder)
-    merged_results = merge_ocr_results(base_name, divjson_folder, json_folder)
+        part_paths.append(output_pdf_path)
+    return part_paths
+
+# Function to merge the OCR results of divided PDFs (written by divide_pdf_to_parts or by j2k2pdf --ocr-parts) and delete the parts
+def merge_and_save(base_name, divpdf_folder, divjson_folder, json_folder, part_files=None):
+    merged_results = merge_ocr_results(base_name, divjson_folder, json_folder, part_files)
     if os.path.exists(os.path.join(json_folder, base_name + '.pdf.json')):
         warning_print(f"{base_name}.pdf.json already exists and will be overwritten.")
         os.remove(os.path.join(json_folder, base_name + '.pdf.json'))
@@ -237,14 +266,14 @@ def divide_and_process_pdf(pdf_file_path, divide_value, div_pages,base_name, doc
 
     # If not in debug mode, delete part files
     if not args.no_delete:
-        part_files = [f for f in os.listdir(divpdf_folder) if f.startswith(base_name + "_part")]
+        part_files = [f for f in os.listdir(divpdf_folder) if f.startswith((base_name + "_part", base_name + "_split"))]
         for part_file in part_files:
             try:
                 os.remove(os.path.join(divpdf_folder, part_file))
                 warning_print(f"Deleted {part_file} in {divpdf_folder}")
             except Exception as e:
                 error_print(f"Failed to delete {part_file} in {divpdf_folder}. Reason: {e}")
-        part_files = [f for f in os.listdir(divjson_folder) if f.startswith(base_name + "_part")]
+        part_files = [f for f in os.listdir(divjson_folder) if f.startswith((base_name + "_part", base_name + "_split"))]
         for part_file in part_files:
             try:
                 os.remove(os.path.join(divjson_folder, part_file))
@@ -252,20 +281,51 @@ def divide_and_process_pdf(pdf_file_path, divide_value, div_pages,base_name, doc
             except Exception as e:
                 error_print(f"Failed to delete {part_file} in {divpdf_folder}. Reason: {e}")
 
+# 本をOCRに送るPDFのリストを決める関数 (j2k2pdfの分割PDF、PDF全体、またはPyPDF2で分割したPDF)
+def plan_book(book):
+    if book['premade_parts']:
+        info_print(f"Using {len(book['premade_parts'])} OCR parts written by j2k2pdf for {book['pdf_file']}")
+        book['parts'] = book['premade_parts']
+        book['divided'] = True
+    elif book['divide_value'] == 1 and not args.pages:
+        book['parts'] = [book['pdf_file_path']]
+        book['divided'] = False
+    else:
+        book['parts'] = divide_pdf_to_parts(book['pdf_file_path'], book['divide_value'], book['div_pages'], book['name'], divpdf_folder, book['page_ranges'])
+        book['divided'] = True
+    book['output_folder'] = divjson_folder if book['divided'] else json_folder
+
+# 本の全てのPDFのOCRが終わったときにOCRエンジンから呼ばれる関数。分割した本 (OCRエンジンが分けた本を含む) は結果を結合する
+# 送り直しても分けても失敗した分割がある本は結合しない (--no-deleteなら成功した分割の結果は残る)
+def on_book_done(book, failed_parts):
+    if failed_parts:
+        error_print(f"OCR failed for {len(failed_parts)} parts of {book['pdf_file']}. The results are not merged.")
+        return
+    if book['divided'] or book['split']:
+        try:
+            merge_and_save(book['name'], divpdf_folder, divjson_folder, json_folder, [os.path.basename(result_file) for result_file in book['result_files']])
+        except Exception as e:
+            error_print(f"Failed to merge OCR results for {book['pdf_file']}: {e}")
 
-# Process each PDF file
+
+# 本ごとの分割の設定を決める
+books = []
 for pdf_file in pdf_files:
     pdf_file_path = os.path.join(optpdf_folder, pdf_file)
     base_name = pdf_file.rsplit('.', 1)[0]
-    with open(pdf_file_path, "rb") as file:
-        pdf = PdfReader(file)
-        total_pages = len(pdf.pages)
 
-    # specify method and numbur of parts to divide, depending on options and page nunbers
+    # j2k2pdf --ocr-partsが画像から直接書いた分割PDFがあれば、PDFを読み直して分割せずにそのまま送る
+    # 分割の指定 (--divide, --pages, --no-divide) がある場合と、元のPDFが作り直された場合は使わない
+    premade_parts = None
+    if not (args.divide or args.pages or args.no_divide):
+        premade_parts = pageindex.lookup_parts(pdf_file_path, divpdf_folder)
+
+    # specify method and numbur of parts to divide, depending on options and page sizes
     divide_value = 1
-    div_pages = default_max_pages
+    div_pages = args.max_part_pages
+    page_ranges = None
     if args.pages:
-        if args.pages >= default_max_pages:
+        if args.pages >= args.max_part_pages:
             args.pages = None
     if args.no_divide:
         divide_value = 1
@@ -273,39 +333,31 @@ for pdf_file in pdf_files:
         divide_value = args.divide
     elif args.pages:
         div_pages = args.pages
-    else:
-        if total_pages <= default_max_pages:
-            divide_value = 1
-        else:
-            if total_pages % default_max_pages == 0:
-                divide_value = total_pages // default_max_pages
-            else:
-                divide_value = total_pages // default_max_pages + 1
+    elif not premade_parts:
+        # ページごとのバイト数 (インデックスの画像のサイズ、なければPDFのxref) から、ページ数と大きさの上限に収まるように分ける
+        page_sizes, size_source = partplan.get_page_sizes(pdf_file_path)
+        page_ranges = partplan.plan_parts(page_sizes, args.max_part_pages, int(args.max_part_mb * 2**20))
+        divide_value = len(page_ranges) or 1
+        debug_print(f"{pdf_file}: {len(page_sizes)} pages, {sum(page_sizes) / 2**20:.1f} MB (page sizes from {size_source}), "
+                    f"parts of {[round(sum(page_sizes[start:end]) / 2**20, 1) for start, end in page_ranges]} MB")
     debug_print(f"Divide value: {divide_value}, Divide pages: {div_pages}")
-        
 
+    books.append({'name': base_name, 'pdf_file': pdf_file, 'pdf_file_path': pdf_file_path, 'divide_value': divide_value,
+                  'div_pages': div_pages, 'page_ranges': page_ranges, 'premade_parts': premade_parts})
+
+# 全ての本の全てのPDFを並行してOCRに送る。失敗したPDFだけを送り直し、受け付けられないPDFだけを半分に分けて送る
+ocr_cache = ocrcache.OcrCache(ocrcache.cache_folder, args.cache_mb * 2**20) if args.cache_mb > 0 else None
+ocr_engine = ocrengine.OcrEngine(endpoint, credential, args.concurrency, args.upload_concurrency, ocr_cache, not args.no_cache,
+                                 args.attempts, divpdf_folder, divjson_folder,
+                                 ratelimit.RateLimiter(args.tps, args.poll_tps, args.shared_limit, ratelimit.quota_file, args.monthly_pages))
+planned_books = []
+for book in books:
     try:
-        attempt = 0
-        max_attempts = args.attempts
-        #If proccesing fails divide into smaller parts and process
-        while attempt < max_attempts:
-            if divide_value == 1 and not args.pages:
-                try:
-                    process_pdf(pdf_file_path, document_intelligence_client, json_folder)
-                    break
-                except Exception as e:
-                    error_print(f"Failed to process {pdf_file}: {e}")
-                    error_print(f"Attempting to divide {pdf_file} into smaller parts")
-                    attempt += 1
-                    divide_value += 1
-            else:
-                try:
-                    divide_and_process_pdf(pdf_file_path, divide_value, div_pages, base_name, document_intelligence_client, divpdf_folder, divjson_folder, json_folder)
-                    break
-                except Exception as e:
-                    error_print(f"Failed to process {pdf_file}: {e}")
-                    error_print(f"Attempting to divide {pdf_file} into smaller parts")
-                    attempt += 1
-                    divide_value += 1
+        plan_book(book)
+        planned_books.append(book)
     except Exception as e:
-        powerlog.debug_print(f"Error processing {pdf_file}: {e}")
\ No newline at end of file
+        error_print(f"Failed to process {book['pdf_file']}: {e}")
+failed_books = ocr_engine.run(planned_books, on_book_done)
+for book in books:
+    if book not in planned_books or book['name'] in failed_books:
+        error_print(f"Giving up on {book['pdf_file']}")
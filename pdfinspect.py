@@ -0,0 +1,432 @@
+import os
+import re
+import mmap
+import zlib
+from collections import namedtuple
+from PyPDF2 import PdfReader
+from powerlog import debug_print
+
+# PDFのページ数やページサイズを確認するためだけにPdfReaderで全体を解析しないための軽量な読み取り
+# 末尾のstartxrefからxref (表とxrefストリーム、/Prevの更新履歴) とトレーラーを読み、
+# カタログ → ページツリーの/Countと、必要ならページごとの/MediaBoxだけを読む。ページの内容や画像は読まない
+# ファイルはmmapで必要な部分だけ読むので、大きなロスレスのPDFでもメモリを使わない
+# 読めない構造 (暗号化、壊れたxrefなど) ではPdfInspectErrorを出す。count_pagesとget_mediaboxはその場合PdfReaderで読む
+
+# 間接参照 (n g R)
+Ref = namedtuple('Ref', 'num gen')
+
+# ストリームのオブジェクト (辞書とファイル内のデータの位置)
+Stream = namedtuple('Stream', 'dictionary offset length')
+
+class PdfInspectError(ValueError):
+    pass
+
+whitespace = b'\x00\t\n\x0c\r '
+delimiters = b'()<>[]{}/%'
+number_pattern = re.compile(rb'[+-]?(\d+\.?\d*|\.\d+)')
+reference_pattern = re.compile(rb'\s+(\d+)\s+R(?=[\s()<>\[\]{}/%]|$)')
+object_header_pattern = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+xref_entry_pattern = re.compile(rb'\s*(\d{10})\s(\d{5})\s([nf])')
+xref_subsection_pattern = re.compile(rb'\s*(\d+)\s+(\d+)')
+
+# 空白とコメントを読み飛ばす関数
+def skip_whitespace(buffer, pos):
+    while pos < len(buffer):
+        c = buffer[pos:pos + 1]
+        if c in whitespace and c:
+            pos += 1
+        elif c == b'%':
+            while pos < len(buffer) and buffer[pos:pos + 1] not in (b'\r', b'\n'):
+                pos += 1
+        else:
+            break
+    return pos
+
+# オブジェクトを1つ読む関数。(値, 次の位置) を返す
+# 辞書はdict (キーは'/Type'のような名前)、配列はlist、名前はstr、文字列はbytes、参照はRef
+def parse_object(buffer, pos):
+    pos = skip_whitespace(buffer, pos)
+    c = buffer[pos:pos + 1]
+    if c == b'':
+        raise PdfInspectError("unexpected end of file")
+    if buffer[pos:pos + 2] == b'<<':
+        dictionary = {}
+        pos += 2
+        while True:
+            pos = skip_whitespace(buffer, pos)
+            if buffer[pos:pos + 2] == b'>>':
+                return dictionary, pos + 2
+            key, pos = parse_object(buffer, pos)
+            if not isinstance(key, str):
+                raise PdfInspectError(f"dictionary key is not a name at {pos}")
+            value, pos = parse_object(buffer, pos)
+            dictionary[key] = value
+    if c == b'[':
+        array = []
+        pos += 1
+        while True:
+            pos = skip_whitespace(buffer, pos)
+            if buffer[pos:pos + 1] == b']':
+                return array, pos + 1
+            value, pos = parse_object(buffer, pos)
+            array.append(value)
+    if c == b'/':
+        end = pos + 1
+        while end < len(buffer) and buffer[end:end + 1] not in whitespace and buffer[end:end + 1] not in delimiters:
+            end += 1
+        name = re.sub(rb'#([0-9A-Fa-f]{2})', lambda match: bytes([int(match.group(1), 16)]), buffer[pos:end])
+        return name.decode('latin-1'), end
+    if c == b'(':
+        # 文字列は中身を使わないので括弧の対応とエスケープだけを見る
+        depth = 0
+        end = pos
+        while end < len(buffer):
+            ch = buffer[end:end + 1]
+            if ch == b'\\':
+                end += 2
+                continue
+            if ch == b'(':
+                depth += 1
+            elif ch == b')':
+                depth -= 1
+                if depth == 0:
+                    return bytes(buffer[pos + 1:end]), end + 1
+            end += 1
+        raise PdfInspectError("unterminated string")
+    if c == b'<':
+        end = buffer.find(b'>', pos)
+        if end < 0:
+            raise PdfInspectError("unterminated hex string")
+        return bytes.fromhex(re.sub(rb'\s', b'', buffer[pos + 1:end]).decode('ascii').ljust(2, '0')), end + 1
+    match = number_pattern.match(buffer, pos)
+    if match:
+        token = match.group(0)
+        if b'.' in token:
+            return float(token), match.end()
+        # 整数の後に「g R」が続けば参照
+        reference = reference_pattern.match(buffer, match.end())
+        if reference:
+            return Ref(int(token), int(reference.group(1))), reference.end()
+        return int(token), match.end()
+    for keyword, value in ((b'true', True), (b'false', False), (b'null', None)):
+        if buffer[pos:pos + len(keyword)] == keyword:
+            return value, pos + len(keyword)
+    raise PdfInspectError(f"unexpected token {bytes(buffer[pos:pos + 10])!r} at {pos}")
+
+# PNG予測子 (xrefストリームでよく使われる) を戻す関数
+def undo_png_predictor(data, columns):
+    rows = []
+    previous = bytearray(columns)
+    for start in range(0, len(data), columns + 1):
+        filter_type = data[start]
+        row = bytearray(data[start + 1:start + 1 + columns])
+        for i in range(len(row)):
+            left = row[i - 1] if i > 0 else 0
+            up = previous[i]
+            if filter_type == 1:
+                row[i] = (row[i] + left) & 0xff
+            elif filter_type == 2:
+                row[i] = (row[i] + up) & 0xff
+            elif filter_type == 3:
+                row[i] = (row[i] + (left + up) // 2) & 0xff
+            elif filter_type == 4:
+                upper_left = previous[i - 1] if i > 0 else 0
+                p = left + up - upper_left
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - upper_left)
+                row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else upper_left)) & 0xff
+        rows.append(bytes(row))
+        previous = row
+    return b''.join(rows)
+
+# PDFファイルを開いてxrefとトレーラーを読むクラス
+class PdfInspector:
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+        self.file = open(pdf_path, 'rb')
+        try:
+            if os.fstat(self.file.fileno()).st_size == 0:
+                raise PdfInspectError("empty file")
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        self.xref = {}
+        self.trailer = {}
+        self.objects = {}
+        self.object_streams = {}
+        try:
+            self.read_xref_chain()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    # ヘッダーのPDFバージョン
+    def version(self):
+        match = re.match(rb'%PDF-(\d\.\d)', self.buffer[:16])
+        if not match:
+            raise PdfInspectError("no PDF header")
+        return match.group(1).decode('ascii')
+
+    # 末尾のstartxrefから/Prevをたどってxrefを読む関数。新しい更新の記録を優先する
+    def read_xref_chain(self):
+        tail_start = max(0, len(self.buffer) - 2048)
+        startxref = self.buffer.rfind(b'startxref', tail_start)
+        if startxref < 0:
+            raise PdfInspectError("startxref not found")
+        offset, _ = parse_object(self.buffer, startxref + len(b'startxref'))
+        visited = set()
+        while offset is not None and offset not in visited:
+            visited.add(offset)
+            trailer = self.read_xref_section(offset)
+            # 表とxrefストリームを両方持つファイル (/XRefStm)
+            if isinstance(trailer.get('/XRefStm'), int):
+                self.read_xref_section(trailer['/XRefStm'])
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            offset = trailer.get('/Prev')
+        if '/Root' not in self.trailer:
+            raise PdfInspectError("trailer has no /Root")
+        if '/Encrypt' in self.trailer:
+            raise PdfInspectError("encrypted PDF")
+
+    # 1つのxref (表またはxrefストリーム) を読み、トレーラーの辞書を返す関数
+    def read_xref_section(self, offset):
+        pos = skip_whitespace(self.buffer, offset)
+        if self.buffer[pos:pos + 4] == b'xref':
+            pos += 4
+            while True:
+                subsection = xref_subsection_pattern.match(self.buffer, pos)
+                if not subsection:
+                    break
+                start, count = int(subsection.group(1)), int(subsection.group(2))
+                pos = subsection.end()
+                for num in range(start, start + count):
+                    entry = xref_entry_pattern.match(self.buffer, pos)
+                    if not entry:
+                        raise PdfInspectError(f"broken xref entry at {pos}")
+                    pos = entry.end()
+                    if entry.group(3) == b'n':
+                        self.xref.setdefault(num, ('n', int(entry.group(1))))
+                    else:
+                        self.xref.setdefault(num, ('f', 0))
+            pos = skip_whitespace(self.buffer, pos)
+            if self.buffer[pos:pos + 7] != b'trailer':
+                raise PdfInspectError("trailer not found")
+            trailer, _ = parse_object(self.buffer, pos + 7)
+            return trailer
+        # xrefストリーム
+        stream = self.parse_indirect_object(offset)
+        if not isinstance(stream, Stream) or stream.dictionary.get('/Type') != '/XRef':
+            raise PdfInspectError(f"no xref at {offset}")
+        data = self.read_stream(stream)
+        widths = stream.dictionary['/W']
+        index = stream.dictionary.get('/Index', [0, stream.dictionary['/Size']])
+        pos = 0
+        for start, count in zip(index[0::2], index[1::2]):
+            for num in range(start, start + count):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(data[pos:pos + width], 'big') if width else None)
+                    pos += width
+                entry_type = 1 if fields[0] is None else fields[0]
+                if entry_type == 1:
+                    self.xref.setdefault(num, ('n', fields[1]))
+                elif entry_type == 2:
+                    self.xref.setdefault(num, ('c', fields[1], fields[2] or 0))
+                else:
+                    self.xref.setdefault(num, ('f', 0))
+        if pos > len(data):
+            raise PdfInspectError("xref stream is too short")
+        return stream.dictionary
+
+    # ファイル内の位置にある「n g obj」のオブジェクトを読む関数
+    def parse_indirect_object(self, offset):
+        header = object_header_pattern.match(self.buffer, offset)
+        if not header:
+            raise PdfInspectError(f"no object at {offset}")
+        value, pos = parse_object(self.buffer, header.end())
+        if isinstance(value, dict):
+            pos = skip_whitespace(self.buffer, pos)
+            if self.buffer[pos:pos + 6] == b'stream':
+                pos += 6
+                if self.buffer[pos:pos + 2] == b'\r\n':
+                    pos += 2
+                elif self.buffer[pos:pos + 1] in (b'\n', b'\r'):
+                    pos += 1
+                return Stream(value, pos, value.get('/Length'))
+        return value
+
+    # ストリームのデータを読み、FlateDecodeと予測子を戻す関数 (xrefストリームとオブジェクトストリーム用)
+    def read_stream(self, stream):
+        length = self.resolve(stream.length)
+        if not isinstance(length, int):
+            raise PdfInspectError("stream has no length")
+        data = bytes(self.buffer[stream.offset:stream.offset + length])
+        filters = stream.dictionary.get('/Filter')
+        filters = filters if isinstance(filters, list) else [filters] if filters else []
+        if filters not in ([], ['/FlateDecode']):
+            raise PdfInspectError(f"unsupported filter {filters}")
+        if filters:
+            data = zlib.decompress(data)
+        parameters = self.resolve(stream.dictionary.get('/DecodeParms')) or {}
+        if isinstance(parameters, list):
+            parameters = parameters[0] or {}
+        predictor = parameters.get('/Predictor', 1)
+        if predictor >= 10:
+            data = undo_png_predictor(data, parameters.get('/Columns', 1) * parameters.get('/Colors', 1) * parameters.get('/BitsPerComponent', 8) // 8)
+        elif predictor != 1:
+            raise PdfInspectError(f"unsupported predictor {predictor}")
+        return data
+
+    # 参照ならオブジェクトを読み、そうでなければそのまま返す関数
+    def resolve(self, value):
+        if not isinstance(value, Ref):
+            return value
+        if value.num in self.objects:
+            return self.objects[value.num]
+        entry = self.xref.get(value.num)
+        if entry is None or entry[0] == 'f':
+            obj = None
+        elif entry[0] == 'n':
+            obj = self.parse_indirect_object(entry[1])
+        else:
+            obj = self.read_compressed_object(entry[1], entry[2])
+        self.objects[value.num] = obj
+        return obj
+
+    # オブジェクトストリームに圧縮されたオブジェクトを読む関数
+    def read_compressed_object(self, stream_num, index):
+        if stream_num not in self.object_streams:
+            stream = self.resolve(Ref(stream_num, 0))
+            if not isinstance(stream, Stream):
+                raise PdfInspectError(f"object stream {stream_num} not found")
+            self.object_streams[stream_num] = (stream.dictionary, self.read_stream(stream))
+        dictionary, data = self.object_streams[stream_num]
+        pos = 0
+        offsets = []
+        for _ in range(dictionary['/N']):
+            _, pos = parse_object(data, pos)
+            offset, pos = parse_object(data, pos)
+            offsets.append(offset)
+        value, _ = parse_object(data, dictionary['/First'] + offsets[index])
+        return value
+
+    # ページツリーの/Count
+    def page_count(self):
+        catalog = self.resolve(self.trailer['/Root'])
+        pages = self.resolve(catalog.get('/Pages')) if isinstance(catalog, dict) else None
+        if not isinstance(pages, dict) or not isinstance(self.resolve(pages.get('/Count')), int):
+            raise PdfInspectError("page tree has no /Count")
+        return self.resolve(pages['/Count'])
+
+    # ページツリーをたどり、ページごとに (ページの辞書, /MediaBox, /Resources) (親から継承したものを含む) のリストを返す関数
+    def pages(self):
+        catalog = self.resolve(self.trailer['/Root'])
+        pages = []
+        stack = [(catalog['/Pages'], None, None)]
+        visited = set()
+        while stack:
+            node_ref, inherited_mediabox, inherited_resources = stack.pop()
+            if isinstance(node_ref, Ref):
+                if node_ref.num in visited:
+                    raise PdfInspectError("page tree has a cycle")
+                visited.add(node_ref.num)
+            node = self.resolve(node_ref)
+            if not isinstance(node, dict):
+                raise PdfInspectError("broken page tree")
+            mediabox = self.resolve(node.get('/MediaBox', inherited_mediabox))
+            resources = node.get('/Resources', inherited_resources)
+            if node.get('/Type') == '/Pages' or '/Kids' in node:
+                # 先頭のページから順になるように逆順に積む
+                for kid in reversed(self.resolve(node['/Kids'])):
+                    stack.append((kid, mediabox, resources))
+            else:
+                pages.append((node, mediabox, resources))
+        return pages
+
+    # ページごとの/MediaBox [x0, y0, x1, y1] のリストを返す関数
+    def mediaboxes(self):
+        return [[float(self.resolve(value)) for value in mediabox] if mediabox else None for _, mediabox, _ in self.pages()]
+
+    # ストリームのデータの長さ (ストリームでなければ0)
+    def stream_length(self, value):
+        stream = self.resolve(value)
+        if not isinstance(stream, Stream):
+            return 0
+        length = self.resolve(stream.length)
+        return length if isinstance(length, int) else 0
+
+    # ページが使うストリーム (内容と/XObjectの画像やフォーム) のデータの長さの合計を返す関数。データは読まない
+    def page_byte_size(self, page, resources):
+        contents = self.resolve(page.get('/Contents'))
+        total = sum(self.stream_length(content) for content in (contents if isinstance(contents, list) else [page.get('/Contents')]))
+        visited = set()
+        stack = [resources]
+        while stack:
+            resources = self.resolve(stack.pop())
+            xobjects = self.resolve(resources.get('/XObject')) if isinstance(resources, dict) else None
+            if not isinstance(xobjects, dict):
+                continue
+            for xobject_ref in xobjects.values():
+                if isinstance(xobject_ref, Ref):
+                    if xobject_ref.num in visited:
+                        continue
+                    visited.add(xobject_ref.num)
+                xobject = self.resolve(xobject_ref)
+                if isinstance(xobject, Stream):
+                    total += self.stream_length(xobject)
+                    # フォームの中で使う画像も数える
+                    if xobject.dictionary.get('/Subtype') == '/Form':
+                        stack.append(xobject.dictionary.get('/Resources'))
+        return total
+
+# PDFの構造を確認して {'version', 'pages', 'mediaboxes', 'objects', 'size'} を返す関数
+# read_mediaboxesの場合はページツリーの全ページをたどり、葉の数が/Countと一致するか確認する
+def inspect_pdf(pdf_path, read_mediaboxes=False):
+    with PdfInspector(pdf_path) as inspector:
+        info = {
+            'version': inspector.version(),
+            'pages': inspector.page_count(),
+            'mediaboxes': None,
+            'objects': len(inspector.xref),
+            'size': len(inspector.buffer),
+        }
+        if read_mediaboxes:
+            info['mediaboxes'] = inspector.mediaboxes()
+            if len(info['mediaboxes']) != info['pages']:
+                raise PdfInspectError(f"page tree has {len(info['mediaboxes'])} pages but /Count is {info['pages']}")
+    return info
+
+# ページごとのバイト数 (内容と画像のストリームの長さの合計) のリストを返す関数。読めない構造ではPdfInspectErrorなど
+def page_byte_sizes(pdf_path):
+    with PdfInspector(pdf_path) as inspector:
+        return [inspector.page_byte_size(page, resources) for page, _, resources in inspector.pages()]
+
+# PDFのページ数を返す関数。軽量な読み取りができなければPdfReaderで数える
+def count_pages(pdf_path):
+    try:
+        return inspect_pdf(pdf_path)['pages']
+    except (PdfInspectError, OSError, ValueError, KeyError, IndexError, TypeError, zlib.error) as e:
+        debug_print(f"Falling back to PdfReader for {pdf_path}: {e}")
+    with open(pdf_path, 'rb') as pdf_file:
+        return len(PdfReader(pdf_file).pages)
+
+# ページの/MediaBox [x0, y0, x1, y1] を返す関数。軽量な読み取りができなければPdfReaderで読む
+def get_mediabox(pdf_path, page_number=0):
+    try:
+        return inspect_pdf(pdf_path, read_mediaboxes=True)['mediaboxes'][page_number]
+    except (PdfInspectError, OSError, ValueError, KeyError, IndexError, TypeError, zlib.error) as e:
+        debug_print(f"Falling back to PdfReader for {pdf_path}: {e}")
+    with open(pdf_path, 'rb') as pdf_file:
+        return [float(value) for value in PdfReader(pdf_file).pages[page_number].mediabox]
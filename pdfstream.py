@@ -0,0 +1,154 @@
+import os
+from datetime import datetime
+import img2pdf
+from powerlog import debug_print, warning_print
+
+# img2pdf.convertはPDF全体を1つのbytesとしてメモリ上に作るので、ページ数の多いロスレスの本ではメモリが本のサイズだけ必要になる
+# ここではページごとに画像を読み、画像・コンテンツ・ページのオブジェクトをすぐファイルに書き、最後にページツリーとxrefを書く
+# メモリは1ページ分だけで、本のサイズに比例しない。ページのレイアウトはimg2pdfと同じ (read_imagesとlayout_funを使う)
+
+# ストリーミングで書ける拡張子 (コードストリームをそのまま埋め込むJPEGとJPEG2000)
+stream_extensions = ('.jpeg', '.jpg', '.jpe', '.jif', '.jfif', '.jfi', '.jp2', '.j2k', '.jpf', '.jpx', '.jpm', '.mj2')
+
+# ストリーミングで書けない画像 (PNGのビットマップや色数の少ないパレットなど)
+class UnsupportedImageError(ValueError):
+    pass
+
+# 全ての画像をストリーミングで書けるか拡張子で確認する関数
+def can_stream(image_files):
+    return all(str(image_file).lower().endswith(stream_extensions) for image_file in image_files)
+
+# PDFの数値の書式 (整数はそのまま、小数は4桁)
+def format_number(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return f"{value:.4f}".rstrip('0')
+
+# オブジェクトの位置を記録しながらPDFを書くクラス
+class StreamingPdfWriter:
+    def __init__(self, output_file, version):
+        self.output_file = output_file
+        self.offsets = {}
+        # 1はカタログ、2はページツリー。最後に書く
+        self.next_id = 3
+        self.page_ids = []
+        self.position = 0
+        self.write(f"%PDF-{version}\n".encode('ascii') + b"%\xe2\xe3\xcf\xd3\n")
+
+    def write(self, data):
+        self.output_file.write(data)
+        self.position += len(data)
+
+    def new_id(self):
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    # 辞書のオブジェクトを書く関数。辞書は書式済みの文字列
+    def write_object(self, object_id, dictionary):
+        self.offsets[object_id] = self.position
+        self.write(f"{object_id} 0 obj\n{dictionary}\nendobj\n".encode('latin-1'))
+
+    # ストリームのオブジェクトを書く関数。/Lengthはここで付ける
+    def write_stream(self, object_id, dictionary, data):
+        self.offsets[object_id] = self.position
+        self.write(f"{object_id} 0 obj\n<<{dictionary} /Length {len(data)}>>\nstream\n".encode('latin-1'))
+        self.write(data)
+        self.write(b"\nendstream\nendobj\n")
+
+    # 画像1枚を1ページとして書く関数
+    def add_image_page(self, color, imgwidthpx, imgheightpx, imgformat, imgdata, imgwidthpdf, imgheightpdf, pagewidth, pageheight, userunit, rotation, depth, iccp):
+        if imgformat is img2pdf.ImageFormat.JPEG:
+            image_filter = '/DCTDecode'
+        elif imgformat is img2pdf.ImageFormat.JPEG2000:
+            image_filter = '/JPXDecode'
+        else:
+            raise UnsupportedImageError(f"unsupported image format: {imgformat.name}")
+
+        color_name = color.name
+        if color_name in ('1', 'L', 'LA'):
+            colorspace = '/DeviceGray'
+        elif color_name == 'RGBA' and imgformat is img2pdf.ImageFormat.JPEG2000:
+            # JPXDecodeは色空間をコードストリームから読むので省略できる
+            colorspace = None
+        elif color_name in ('RGB', 'RGBA'):
+            colorspace = '/DeviceRGB'
+        elif color_name in ('CMYK', 'CMYK;I'):
+            colorspace = '/DeviceCMYK'
+        else:
+            raise UnsupportedImageError(f"unsupported color space: {color_name}")
+
+        if iccp is not None and colorspace is not None:
+            icc_id = self.new_id()
+            components = {'/DeviceGray': 1, '/DeviceRGB': 3, '/DeviceCMYK': 4}[colorspace]
+            self.write_stream(icc_id, f"/Alternate {colorspace} /N {components}", iccp)
+            colorspace = f"[/ICCBased {icc_id} 0 R]"
+
+        image_id = self.new_id()
+        image_dictionary = f"/Type /XObject /Subtype /Image /Filter {image_filter} /Width {imgwidthpx} /Height {imgheightpx} /BitsPerComponent {depth}"
+        if colorspace is not None:
+            image_dictionary += f" /ColorSpace {colorspace}"
+        if color_name == 'CMYK;I':
+            image_dictionary += " /Decode [1 0 1 0 1 0 1 0]"
+        self.write_stream(image_id, image_dictionary, imgdata)
+
+        # 画像は常にページの中央に置く (img2pdfと同じ)
+        imgxpdf = (pagewidth - imgwidthpdf) / 2.0
+        imgypdf = (pageheight - imgheightpdf) / 2.0
+        content_id = self.new_id()
+        content = ("q\n%0.4f 0 0 %0.4f %0.4f %0.4f cm\n/Im0 Do\nQ" % (imgwidthpdf, imgheightpdf, imgxpdf, imgypdf)).encode('ascii')
+        self.write_stream(content_id, "", content)
+
+        page_id = self.new_id()
+        page_dictionary = f"<</Type /Page /Parent 2 0 R /MediaBox [0 0 {format_number(pagewidth)} {format_number(pageheight)}] /Resources <</XObject <</Im0 {image_id} 0 R>>>> /Contents {content_id} 0 R"
+        if userunit is not None:
+            page_dictionary += f" /UserUnit {format_number(userunit)}"
+        if rotation:
+            page_dictionary += f" /Rotate {rotation}"
+        self.write_object(page_id, page_dictionary + ">>")
+        self.page_ids.append(page_id)
+
+    # ページツリー、カタログ、情報、xref、トレーラーを書く関数
+    def finish(self):
+        kids = ' '.join(f"{page_id} 0 R" for page_id in self.page_ids)
+        self.write_object(2, f"<</Type /Pages /Kids [{kids}] /Count {len(self.page_ids)}>>")
+        self.write_object(1, "<</Type /Catalog /Pages 2 0 R>>")
+        info_id = self.new_id()
+        creation_date = datetime.now().strftime("D:%Y%m%d%H%M%S")
+        self.write_object(info_id, f"<</Producer (img2pdf {img2pdf.__version__} streaming) /CreationDate ({creation_date}) /ModDate ({creation_date})>>")
+
+        xref_offset = self.position
+        size = self.next_id
+        xref = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for object_id in range(1, size):
+            xref.append(f"{self.offsets[object_id]:010d} 00000 n \n")
+        xref.append(f"trailer\n<</Size {size} /Root 1 0 R /Info {info_id} 0 R>>\nstartxref\n{xref_offset}\n%%EOF\n")
+        self.write(''.join(xref).encode('ascii'))
+
+# 画像のリストからPDFをストリーミングで書く関数。layout_funはimg2pdf.get_layout_funで作ったもの
+# PNGなど書けない画像があればUnsupportedImageError (書きかけのファイルは呼び出し側で作り直す)
+def write_pdf(image_files, pdf_path, layout_fun):
+    version = '1.5' if any(str(image_file).lower().endswith(('.jp2', '.j2k', '.jpf', '.jpx', '.jpm', '.mj2')) for image_file in image_files) else '1.3'
+    with open(pdf_path, 'wb') as output_file:
+        writer = StreamingPdfWriter(output_file, version)
+        for image_file in image_files:
+            # 1ページ分だけ読み込む
+            with open(image_file, 'rb') as image_input:
+                rawdata = image_input.read()
+            for color, ndpi, imgformat, imgdata, smaskdata, imgwidthpx, imgheightpx, palette, inverted, depth, rotation, iccp in img2pdf.read_images(rawdata, None):
+                if smaskdata is not None:
+                    raise UnsupportedImageError(f"{image_file} needs a soft mask")
+                pagewidth, pageheight, imgwidthpdf, imgheightpdf = layout_fun(imgwidthpx, imgheightpx, ndpi)
+                userunit = None
+                if pagewidth < 3.00 or pageheight < 3.00:
+                    warning_print("pdf width or height is below 3.00 - too small for some viewers!")
+                elif pagewidth > 14400.0 or pageheight > 14400.0:
+                    userunit = img2pdf.find_scale(pagewidth, pageheight)
+                    pagewidth /= userunit
+                    pageheight /= userunit
+                    imgwidthpdf /= userunit
+                    imgheightpdf /= userunit
+                writer.add_image_page(color, imgwidthpx, imgheightpx, imgformat, imgdata, imgwidthpdf, imgheightpdf, pagewidth, pageheight, userunit, rotation, depth, iccp)
+            del rawdata
+        writer.finish()
+    debug_print(f"Streamed {len(image_files)} pages to {pdf_path} ({os.path.getsize(pdf_path)} bytes)")
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+from azure.core.pipeline.policies import AsyncHTTPPolicy
+from powerlog import debug_print, warning_print, info_print
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# Document Intelligenceへのリクエストの速度を制限するトークンバケット
+# 解析の送信 (POST) とポーリング (GET) を別々のバケットで制限し、クライアントの全てのリクエスト (SDKの送り直しを含む) がトークンを待つ
+# 429を受けたら速度を下げて、Retry-Afterの間は全てのリクエストを止める。その後は時間とともに上限まで戻す
+# sharedにすると、バケットの状態をファイルに置いてロックファイルで守り、同時に実行している他のpdf3jsonと上限を分け合う
+# 解析したページ数は月ごとに同じファイルに記録し、月のページ数の上限を超えたら送らない
+quota_file = './TEMP/ocrquota.json'
+
+# 毎秒のリクエスト数の既定値 (S0の解析の送信とポーリングの上限)
+default_submit_rate = 15.0
+default_poll_rate = 50.0
+
+# 429を受けたときに速度に掛ける割合、速度の下限、下げた速度が上限まで戻るまでの時間 (秒)
+throttle_factor = 0.5
+min_rate = 0.1
+recovery_time = 30.0
+
+# 429にRetry-Afterがないときに止める時間 (秒)
+default_retry_after = 1.0
+
+class QuotaExceededError(Exception):
+    pass
+
+# 他のプロセスと共有するファイルのロック (Windowsではmsvcrt、それ以外ではfcntl)
+@contextmanager
+def locked_file(lock_path):
+    with open(lock_path, 'a+b') as lock_file:
+        if os.name == 'nt':
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def read_state(state_path):
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        warning_print(f"Ignoring broken rate limiter state {state_path}: {e}")
+        return {}
+
+def write_state(state_path, state):
+    tmp_state_path = f"{state_path}.tmp"
+    with open(tmp_state_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_state_path, state_path)
+
+def new_bucket(max_rate, now):
+    return {'tokens': max(1.0, max_rate), 'rate': max_rate, 'updated': now, 'blocked_until': 0.0}
+
+# バケットにトークンを足して1つ取る関数。取れたら0、取れなければ次に取れるまでの秒数を返す
+# 一度に送れる数 (バケットの大きさ) は1秒分。速度は下限 (上限がそれより低ければ上限) より下げない
+def take_token(bucket, max_rate, now):
+    elapsed = max(0.0, now - bucket['updated'])
+    bucket['rate'] = min(max_rate, max(min_rate, bucket['rate'] + max_rate * elapsed / recovery_time))
+    bucket['tokens'] = min(max(1.0, max_rate), bucket['tokens'] + bucket['rate'] * elapsed)
+    bucket['updated'] = now
+    if now < bucket['blocked_until']:
+        return bucket['blocked_until'] - now
+    if bucket['tokens'] >= 1.0:
+        bucket['tokens'] -= 1.0
+        return 0.0
+    return (1.0 - bucket['tokens']) / bucket['rate']
+
+# 429を受けたバケットの速度を下げて、Retry-Afterの間止める関数
+def throttle_bucket(bucket, retry_after, now):
+    bucket['rate'] = max(min_rate, bucket['rate'] * throttle_factor)
+    bucket['tokens'] = 0.0
+    bucket['blocked_until'] = max(bucket['blocked_until'], now + (retry_after if retry_after is not None else default_retry_after))
+
+class RateLimiter:
+    # submit_rate, poll_rate: 毎秒のリクエスト数の上限。monthly_pages: 月に解析するページ数の上限 (0なら制限しない)
+    def __init__(self, submit_rate=default_submit_rate, poll_rate=default_poll_rate, shared=False, state_path=quota_file, monthly_pages=0):
+        self.max_rates = {'submit': submit_rate, 'poll': poll_rate}
+        self.shared = shared
+        self.state_path = state_path
+        self.lock_path = f"{state_path}.lock"
+        self.monthly_pages = monthly_pages
+        Path(state_path).parent.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        self.buckets = {kind: new_bucket(max_rate, now) for kind, max_rate in self.max_rates.items()}
+        self.lock = threading.Lock()
+        self.start_time = now
+        self.counts = {'submit': 0, 'poll': 0, 'throttled': 0, 'pages': 0}
+        self.waited = 0.0
+
+    # 共有する状態をロックして読み、抜けるときに書く
+    @contextmanager
+    def shared_state(self):
+        with self.lock, locked_file(self.lock_path):
+            state = read_state(self.state_path)
+            yield state
+            write_state(self.state_path, state)
+
+    def get_bucket(self, state, kind, now):
+        buckets = state.setdefault('buckets', {})
+        if kind not in buckets:
+            buckets[kind] = new_bucket(self.max_rates[kind], now)
+        return buckets[kind]
+
+    # トークンを1つ取る。取れたら0、取れなければ待つ秒数
+    def take(self, kind):
+        now = time.time()
+        if not self.shared:
+            with self.lock:
+                return take_token(self.buckets[kind], self.max_rates[kind], now)
+        with self.shared_state() as state:
+            bucket = self.get_bucket(state, kind, now)
+            wait = take_token(bucket, self.max_rates[kind], now)
+            self.buckets[kind] = dict(bucket)
+            return wait
+
+    # トークンが取れるまで待つ
+    async def acquire(self, kind):
+        while True:
+            wait = await asyncio.to_thread(self.take, kind) if self.shared else self.take(kind)
+            if wait <= 0:
+                self.counts[kind] += 1
+                return
+            self.waited += wait
+            await asyncio.sleep(wait)
+
+    def throttled(self, kind, retry_after=None):
+        now = time.time()
+        if not self.shared:
+            with self.lock:
+                self.counts['throttled'] += 1
+                throttle_bucket(self.buckets[kind], retry_after, now)
+                rate = self.buckets[kind]['rate']
+        else:
+            with self.shared_state() as state:
+                self.counts['throttled'] += 1
+                bucket = self.get_bucket(state, kind, now)
+                throttle_bucket(bucket, retry_after, now)
+                self.buckets[kind] = dict(bucket)
+                rate = bucket['rate']
+        debug_print(f"Throttled ({kind}), slowing down to {rate:.2f} requests/s")
+
+    # 今月解析したページ数 (全てのプロセスの合計)
+    def month_pages(self):
+        with self.shared_state() as state:
+            return state.get('pages', {}).get(datetime.now().strftime('%Y-%m'), 0)
+
+    # 月のページ数の上限を超えていたら送らない
+    def check_pages(self):
+        if self.monthly_pages <= 0:
+            return
+        used_pages = self.month_pages()
+        if used_pages >= self.monthly_pages:
+            raise QuotaExceededError(f"Monthly page quota reached ({used_pages} / {self.monthly_pages} pages)")
+
+    def record_pages(self, page_count):
+        self.counts['pages'] += page_count
+        with self.shared_state() as state:
+            month = datetime.now().strftime('%Y-%m')
+            pages = state.setdefault('pages', {})
+            pages[month] = pages.get(month, 0) + page_count
+
+    # 使った速度と月のページ数を表示する
+    def report(self):
+        elapsed_time = max(time.time() - self.start_time, 0.001)
+        submit_rate = self.counts['submit'] / elapsed_time
+        info_print(f"Rate limiter: {self.counts['submit']} analyze requests ({submit_rate:.2f}/s, {submit_rate / self.max_rates['submit']:.0%} of {self.max_rates['submit']:g}/s), "
+                   f"{self.counts['poll']} polls ({self.counts['poll'] / elapsed_time:.2f}/s of {self.max_rates['poll']:g}/s), "
+                   f"{self.counts['throttled']} throttled, requests waited {self.waited:.1f} s in total")
+        month_pages = self.month_pages()
+        if self.monthly_pages > 0:
+            info_print(f"Pages analyzed: {self.counts['pages']} in this run, {month_pages} / {self.monthly_pages} this month ({month_pages / self.monthly_pages:.0%})")
+        else:
+            info_print(f"Pages analyzed: {self.counts['pages']} in this run, {month_pages} this month")
+
+# クライアントのパイプラインに入れるポリシー。SDKの送り直しの後に置くので、送り直しとポーリングもトークンを待つ
+class RateLimitPolicy(AsyncHTTPPolicy):
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+    async def send(self, request):
+        kind = 'submit' if request.http_request.method == 'POST' else 'poll'
+        await self.limiter.acquire(kind)
+        response = await self.next.send(request)
+        if response.http_response.status_code == 429:
+            try:
+                retry_after = float(response.http_response.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                retry_after = None
+            # 共有するときはファイルのロックを待つのでスレッドで行う (他の解析を止めない)
+            if self.limiter.shared:
+                await asyncio.to_thread(self.limiter.throttled, kind, retry_after)
+            else:
+                self.limiter.throttled(kind, retry_after)
+        return response